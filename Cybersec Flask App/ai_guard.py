@@ -1,63 +1,342 @@
+import hashlib
 import json
-from typing import Dict, Any
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from openai import AsyncOpenAI, OpenAI
+
+from breaker import CircuitBreaker, CircuitOpenError, remaining
+from cache import TTLCache
+from singleflight import AsyncSingleFlight, SingleFlight
+
+UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I)
+DIGITS_RE = re.compile(r"\d+")
+
+
+def _normalize(value: str) -> str:
+    return DIGITS_RE.sub('0', UUID_RE.sub('<uuid>', value))
+
+
+def fingerprint(features: Dict[str, Any]) -> str:
+    """Stable key for requests the classifier should judge identically.
+
+    Drops the client IP, sorts query parameters and values, and collapses
+    UUIDs and digit runs, so a scanner replaying one payload against many
+    ids (or from many addresses) maps to a single key.
+    """
+    query = sorted(
+        (_normalize(k), sorted(_normalize(str(v)) for v in vals))
+        for k, vals in (features.get('query') or {}).items()
+    )
+    # The surface repeats the raw query (in arrival order) and the IP;
+    # keep only the remaining lines (method, path, UA, body).
+    surface = "\n".join(
+        line for line in (features.get('surface') or '').split("\n")
+        if not line.startswith(('ip=', 'query='))
+    )
+    canonical = json.dumps([
+        features.get('method'),
+        _normalize(features.get('path') or ''),
+        query,
+        sorted((k.lower(), _normalize(v)) for k, v in (features.get('headers') or {}).items()),
+        _normalize(surface),
+    ], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+SYSTEM_PROMPT = (
+    "You are a web security classifier. Classify HTTP requests as BENIGN or MALICIOUS. "
+    "Consider categories: SQLI, XSS, LFI, RCE, SSRF, SCANNER, AUTH_BRUTE_FORCE, OTHER. "
+    "Be conservative: only return MALICIOUS if you are reasonably confident."
+)
+
+
+def _verdict(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'verdict': data.get('verdict', 'UNKNOWN'),
+        'confidence': float(data.get('confidence', 0.0)),
+        'categories': data.get('categories', []) or [],
+        'explanation': data.get('explanation', ''),
+    }
+
+
+def _single_prompt(features: Dict[str, Any]) -> str:
+    return (
+        "Analyze this request. Return compact JSON with keys: verdict (BENIGN|MALICIOUS), "
+        "confidence (0..1), categories (array of strings), explanation (<=30 words).\n\n"
+        f"RequestFeatures:\n{json.dumps(features, ensure_ascii=False)}"
+    )
+
+
+def _unknown(explanation: str) -> Dict[str, Any]:
+    return {
+        'verdict': 'UNKNOWN',
+        'confidence': 0.0,
+        'categories': [],
+        'explanation': explanation,
+    }
+
+
+class _Waiter:
+    __slots__ = ('features', 'result', 'done')
+
+    def __init__(self, features):
+        self.features = features
+        self.result = None
+        self.done = threading.Event()
+
+
+class AIBatcher:
+    """Micro-batches concurrent classifications into single API calls.
+
+    Callers block in `submit` while a collector thread gathers pending
+    requests for up to `max_wait` seconds or until `max_batch` are queued,
+    then sends them through `send_batch(list_of_features) -> list_of_results`
+    on one of `max_inflight` sender threads and hands each caller its own
+    result. During a flood this turns hundreds of completions per second
+    into a handful.
+    """
+
+    def __init__(self, send_batch, max_batch: int = 16, max_wait: float = 0.01,
+                 max_inflight: int = 4, timeout: float = 60.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.batches = 0
+        self.items = 0
+        self._send_batch = send_batch
+        self._queue = []
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_inflight, thread_name_prefix='ai-batch')
+        self._collector = None
+
+    def submit(self, features: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        waiter = _Waiter(features)
+        with self._cond:
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect, name='ai-batch-collector', daemon=True)
+                self._collector.start()
+            self._queue.append(waiter)
+            self._cond.notify()
+        if not waiter.done.wait(self.timeout if timeout is None else min(timeout, self.timeout)):
+            return _unknown('AI error: batched classification timed out')
+        return waiter.result
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.max_wait
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+            self.batches += 1
+            self.items += len(batch)
+            self._senders.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        try:
+            results = self._send_batch([w.features for w in batch])
+        except Exception as e:
+            results = [_unknown(f'AI error: {e}')] * len(batch)
+        for waiter, result in zip(batch, results):
+            waiter.result = result
+            waiter.done.set()
+
+    def stats(self) -> dict:
+        return {'batches': self.batches, 'items': self.items, 'queued': len(self._queue)}
 
-from openai import OpenAI
 
 class AIGuard:
-    def __init__(self, api_key: str, model: str, min_confidence: float = 0.65):
+    def __init__(self, api_key: str, model: str, min_confidence: float = 0.65,
+                 cache: Optional[TTLCache] = None, base_url: Optional[str] = None,
+                 batch_size: int = 0, batch_wait: float = 0.01,
+                 breaker: Optional[CircuitBreaker] = None, call_timeout: float = 10.0,
+                 singleflight: Optional[SingleFlight] = None):
         self.model = model
         self.min_confidence = min_confidence
-        self.client = OpenAI(api_key=api_key) if api_key else None
+        self.client = OpenAI(api_key=api_key, base_url=base_url or None) if api_key else None
+        # For classify_async; created on first use, inside the serving loop
+        self._async_args = {'api_key': api_key, 'base_url': base_url or None}
+        self._async_client = None
+        self.cache = cache
+        self.breaker = breaker
+        self.call_timeout = call_timeout
+        self.singleflight = singleflight
+        self.async_singleflight = AsyncSingleFlight() if singleflight is not None else None
+        self.batcher = AIBatcher(self._request_batch, max_batch=batch_size, max_wait=batch_wait) \
+            if self.client and batch_size > 1 else None
 
-    def classify(self, features: Dict[str, Any]) -> Dict[str, Any]:
+    def classify(self, features: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
         """Use OpenAI to classify a request as BENIGN or MALICIOUS and explain why.
         Returns: { verdict, confidence, categories, explanation }.
         If API unavailable, returns a neutral verdict with low confidence.
+        Definitive verdicts are cached by request fingerprint when a cache is set.
+        With single-flight, concurrent requests with the same fingerprint
+        share one upstream call; a waiter whose time runs out first gets an
+        UNKNOWN verdict, leaving the decision to the heuristics.
+        `deadline` (time.monotonic()) caps how long the call may take.
         """
+        if self.cache is None and self.singleflight is None:
+            return self._classify(features, deadline)
+        key = fingerprint(features)
+        result = self.cache.get(key) if self.cache is not None else None
+        if result is None:
+            if self.singleflight is None:
+                result = self._classify_and_cache(key, features, deadline)
+            else:
+                try:
+                    result = self.singleflight.do(
+                        key, lambda: self._classify_and_cache(key, features, deadline),
+                        timeout=remaining(self.call_timeout, deadline))
+                except TimeoutError:
+                    result = _unknown('AI result for an identical request not ready in time; heuristics only.')
+        return dict(result)
+
+    def _classify_and_cache(self, key: str, features: Dict[str, Any],
+                            deadline: Optional[float] = None) -> Dict[str, Any]:
+        result = self._classify(features, deadline)
+        # Cached before the flight lands, so no later request misses both
+        if self.cache is not None and result['verdict'] in ('BENIGN', 'MALICIOUS'):
+            self.cache.set(key, result)
+        return result
+
+    async def classify_async(self, features: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+        """classify() for asyncio callers (the ASGI guard), over AsyncOpenAI.
+        Shares the verdict cache and circuit breaker with classify();
+        single-flight applies per event loop. Requests are not micro-batched:
+        waiting costs a coroutine here, not a thread."""
+        key = fingerprint(features)
+        result = self.cache.get(key) if self.cache is not None else None
+        if result is None:
+            if self.async_singleflight is None:
+                result = await self._classify_and_cache_async(key, features, deadline)
+            else:
+                try:
+                    result = await self.async_singleflight.do(
+                        key, lambda: self._classify_and_cache_async(key, features, deadline),
+                        timeout=remaining(self.call_timeout, deadline))
+                except TimeoutError:
+                    result = _unknown('AI result for an identical request not ready in time; heuristics only.')
+                except Exception:
+                    # The leader failed or was cancelled (its client went away)
+                    result = _unknown('AI call for an identical request did not complete; heuristics only.')
+        return dict(result)
+
+    async def _classify_and_cache_async(self, key: str, features: Dict[str, Any],
+                                        deadline: Optional[float] = None) -> Dict[str, Any]:
         if not self.client:
-            return {
-                'verdict': 'UNKNOWN',
-                'confidence': 0.0,
-                'categories': [],
-                'explanation': 'AI disabled (no API key).',
-            }
-
-        system = (
-            "You are a web security classifier. Classify HTTP requests as BENIGN or MALICIOUS. "
-            "Consider categories: SQLI, XSS, LFI, RCE, SSRF, SCANNER, AUTH_BRUTE_FORCE, OTHER. "
-            "Be conservative: only return MALICIOUS if you are reasonably confident."
-        )
+            return _unknown('AI disabled (no API key).')
+        if self.breaker and self.breaker.rejects():
+            return _unknown('AI skipped: circuit open, heuristics only.')
+        try:
+            result = _verdict(await self._complete_async(_single_prompt(features), deadline))
+        except CircuitOpenError:
+            return _unknown('AI skipped: circuit open, heuristics only.')
+        except Exception as e:
+            return _unknown(f'AI error: {e}')
+        if self.cache is not None and result['verdict'] in ('BENIGN', 'MALICIOUS'):
+            self.cache.set(key, result)
+        return result
+
+    def _classify(self, features: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+        if not self.client:
+            return _unknown('AI disabled (no API key).')
+        if self.breaker and self.breaker.rejects():
+            return _unknown('AI skipped: circuit open, heuristics only.')
+        if self.batcher:
+            return self.batcher.submit(features, timeout=remaining(self.call_timeout, deadline))
+        return self._request_one(features, deadline)
+
+    def _admit(self, deadline: Optional[float]) -> float:
+        """Timeout for the next call, or raise if it must not be made."""
+        timeout = remaining(self.call_timeout, deadline)
+        if timeout <= 0:
+            raise TimeoutError('latency budget exhausted')
+        if self.breaker and not self.breaker.allow():
+            raise CircuitOpenError('circuit open')
+        return timeout
+
+    def _completion_args(self, user: str) -> Dict[str, Any]:
+        return {
+            'model': self.model,
+            'messages': [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user},
+            ],
+            'temperature': 0.1,
+            'response_format': {"type": "json_object"},
+        }
+
+    def _complete(self, user: str, deadline: Optional[float] = None) -> Dict[str, Any]:
+        timeout = self._admit(deadline)
+        try:
+            resp = self.client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                **self._completion_args(user))
+        except Exception:
+            if self.breaker:
+                self.breaker.record_failure()
+            raise
+        if self.breaker:
+            self.breaker.record_success()
+        return json.loads(resp.choices[0].message.content)
+
+    async def _complete_async(self, user: str, deadline: Optional[float] = None) -> Dict[str, Any]:
+        timeout = self._admit(deadline)
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(**self._async_args)
+        try:
+            resp = await self._async_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+                **self._completion_args(user))
+        except Exception:
+            if self.breaker:
+                self.breaker.record_failure()
+            raise
+        if self.breaker:
+            self.breaker.record_success()
+        return json.loads(resp.choices[0].message.content)
+
+    def _request_one(self, features: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+        try:
+            return _verdict(self._complete(_single_prompt(features), deadline))
+        except CircuitOpenError:
+            return _unknown('AI skipped: circuit open, heuristics only.')
+        except Exception as e:
+            return _unknown(f'AI error: {e}')
+
+    def _request_batch(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if len(batch) == 1:
+            return [self._request_one(batch[0])]
         user = (
-            "Analyze this request. Return compact JSON with keys: verdict (BENIGN|MALICIOUS), "
-            "confidence (0..1), categories (array of strings), explanation (<=30 words).\n\n"
-            f"RequestFeatures:\n{json.dumps(features, ensure_ascii=False)}"
+            "Analyze each request independently. Return compact JSON of the form "
+            "{\"results\": [...]} with one object per request, each with keys: id (as given), "
+            "verdict (BENIGN|MALICIOUS), confidence (0..1), categories (array of strings), "
+            "explanation (<=30 words).\n\n"
+            "RequestFeaturesBatch:\n"
+            f"{json.dumps([dict(f, id=i) for i, f in enumerate(batch)], ensure_ascii=False)}"
         )
-
         try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": user},
-                ],
-                temperature=0.1,
-                response_format={"type": "json_object"}
-            )
-            content = resp.choices[0].message.content
-            data = json.loads(content)
-            return {
-                'verdict': data.get('verdict', 'UNKNOWN'),
-                'confidence': float(data.get('confidence', 0.0)),
-                'categories': data.get('categories', []) or [],
-                'explanation': data.get('explanation', ''),
-            }
+            items = self._complete(user).get('results') or []
+        except CircuitOpenError:
+            return [_unknown('AI skipped: circuit open, heuristics only.')] * len(batch)
         except Exception as e:
-            return {
-                'verdict': 'UNKNOWN',
-                'confidence': 0.0,
-                'categories': [],
-                'explanation': f'AI error: {e}',
-            }
+            return [_unknown(f'AI error: {e}')] * len(batch)
+        by_id = {}
+        for item in items:
+            try:
+                by_id[int(item.get('id'))] = _verdict(item)
+            except (TypeError, ValueError, AttributeError):
+                continue
+        return [by_id.get(i) or _unknown('AI error: no verdict for request in batch')
+                for i in range(len(batch))]
 
     def should_block(self, ai_result: Dict[str, Any]) -> bool:
-        return ai_result.get('verdict') == 'MALICIOUS' and ai_result.get('confidence', 0.0) >= self.min_confidence
\ No newline at end of file
+        return ai_result.get('verdict') == 'MALICIOUS' and ai_result.get('confidence', 0.0) >= self.min_confidence
@@ -1,19 +1,33 @@
 import os
 import time
+import uuid
+import atexit
 import sqlite3
 from functools import wraps
 from datetime import datetime, timedelta
 
 from flask import (
-    Flask, request, render_template, redirect, url_for, abort, g, jsonify, flash
+    Flask, Response, request, render_template, redirect, url_for, abort, g, jsonify, flash
 )
 from dotenv import load_dotenv
 
 from config import Config
-from detectors import extract_surface, heuristic_assess
-from rate_limit import TokenBucketLimiter
+from detectors import scan_request
+from rate_limit import make_limiter
+from blocklist import Blocklist, parse_target
+from shared_state import SqliteTokenBucketLimiter, SqliteBlocklist
+from rule_packs import RulePackStore
 from ai_guard import AIGuard
-from firewall import MitigationGenerator
+from cache import TTLCache
+from singleflight import SingleFlight
+from breaker import CircuitBreaker
+from firewall import MitigationGenerator, ScriptCache
+from pipeline import AIPipeline
+from profiler import BehaviorProfiler
+from incident_log import IncidentWriter, ROLLUP_SCHEMA, rebuild_rollups
+from retention import IncidentArchive, Compactor
+from events import EventBus, format_sse
+from metrics import Metrics
 
 # Setup 
 load_dotenv()
@@ -21,22 +35,88 @@ config = Config()
 app = Flask(__name__)
 app.config.from_object(config)
 
-limiter = TokenBucketLimiter(
-    per_minute=config.RATE_LIMIT_PER_MIN,
-    burst=config.RATE_LIMIT_BURST,
+if config.SHARED_STATE_PATH:
+    if config.RATE_LIMIT_ALGORITHM != 'token_bucket':
+        raise ValueError("SHARED_STATE_PATH only supports RATE_LIMIT_ALGORITHM=token_bucket")
+    limiter = SqliteTokenBucketLimiter(
+        config.SHARED_STATE_PATH,
+        per_minute=config.RATE_LIMIT_PER_MIN,
+        burst=config.RATE_LIMIT_BURST,
+        lease=config.RATE_LIMIT_SHARED_LEASE,
+        lease_ttl=config.RATE_LIMIT_SHARED_LEASE_TTL,
+        max_keys=config.RATE_LIMIT_MAX_KEYS,
+    )
+    blocklist = SqliteBlocklist(config.SHARED_STATE_PATH)
+else:
+    limiter = make_limiter(
+        config.RATE_LIMIT_ALGORITHM,
+        per_minute=config.RATE_LIMIT_PER_MIN,
+        burst=config.RATE_LIMIT_BURST,
+        max_keys=config.RATE_LIMIT_MAX_KEYS,
+        shards=config.RATE_LIMIT_SHARDS,
+    )
+    blocklist = Blocklist()
+ai_breaker = CircuitBreaker(
+    failure_threshold=config.AI_BREAKER_FAILURES,
+    reset_timeout=config.AI_BREAKER_RESET_SECONDS,
 )
 ai_guard = AIGuard(
     api_key=config.OPENAI_API_KEY,
     model=config.AI_MODEL,
     min_confidence=config.AI_MIN_CONFIDENCE,
+    cache=TTLCache(config.AI_CACHE_SIZE, config.AI_CACHE_TTL) if config.AI_CACHE_SIZE else None,
+    base_url=config.OPENAI_BASE_URL,
+    batch_size=config.AI_BATCH_SIZE,
+    batch_wait=config.AI_BATCH_WAIT_MS / 1000.0,
+    breaker=ai_breaker,
+    call_timeout=config.AI_CALL_TIMEOUT_MS / 1000.0,
+    singleflight=SingleFlight() if config.AI_SINGLEFLIGHT else None,
 )
 mitigator = MitigationGenerator(
     api_key=config.OPENAI_API_KEY,
     model=config.AI_MODEL,
+    base_url=config.OPENAI_BASE_URL,
+    breaker=ai_breaker,
+    call_timeout=config.AI_CALL_TIMEOUT_MS / 1000.0,
+    cache=ScriptCache(
+        config.MITIGATION_CACHE_SIZE,
+        config.MITIGATION_CACHE_TTL,
+        config.MITIGATION_CACHE_PATH,
+    ) if config.MITIGATION_CACHE_SIZE else None,
+    singleflight=SingleFlight() if config.AI_SINGLEFLIGHT else None,
+)
+pipeline = AIPipeline(
+    max_workers=config.AI_WORKERS,
+    max_pending=config.AI_QUEUE_SIZE,
+) if config.AI_ASYNC else None
+if pipeline:
+    atexit.register(pipeline.shutdown)
+if config.LOCAL_MODEL_PATH:
+    # numpy is only needed when a local model is configured
+    from local_model import LocalModel, LocalGuard
+    local_guard = LocalGuard(
+        LocalModel.load(config.LOCAL_MODEL_PATH),
+        low=config.LOCAL_MODEL_LOW,
+        high=config.LOCAL_MODEL_HIGH,
+    )
+else:
+    local_guard = None
+profiler = BehaviorProfiler(
+    max_profiles=config.PROFILE_MAX_IPS,
+    idle_seconds=config.PROFILE_IDLE_SECONDS,
+    scan_paths=config.PROFILE_SCAN_PATHS,
+    auth_failures=config.PROFILE_AUTH_FAILURES,
+    rate_per_sec=config.PROFILE_RATE_PER_SEC,
+    window=config.PROFILE_WINDOW_SECONDS,
+    network_scale=config.PROFILE_NETWORK_SCALE or None,
+) if config.PROFILE_MAX_IPS else None
+events = EventBus(config.EVENT_BUFFER_SIZE)
+rules = RulePackStore(
+    config.RULE_PACK_PATH,
+    check_interval=config.RULE_PACK_CHECK_SECONDS,
 )
 
-BLOCKLIST = {}  # ip -> unblock_time (epoch seconds)
-DB_PATH = os.path.join(os.path.dirname(__file__), 'incidents.db')
+DB_PATH = config.INCIDENT_DB_PATH or os.path.join(os.path.dirname(__file__), 'incidents.db')
 
 # DB
 
@@ -71,38 +151,112 @@ with app.app_context():
             ai_categories TEXT,
             ai_explanation TEXT,
             action TEXT,
-            mitigation_script TEXT
+            mitigation_script TEXT,
+            ref TEXT
         );
         """
     )
+    # Databases created before incidents could be updated after the fact
+    if 'ref' not in {row['name'] for row in db.execute("PRAGMA table_info(incidents)")}:
+        db.execute("ALTER TABLE incidents ADD COLUMN ref TEXT")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_incidents_ref ON incidents(ref)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_incidents_ts ON incidents(ts)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_incidents_ip ON incidents(ip)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_incidents_action ON incidents(action)")
+    db.executescript(ROLLUP_SCHEMA)
+    # Backfill rollups for incidents logged before they existed
+    if (db.execute("SELECT 1 FROM incidents LIMIT 1").fetchone()
+            and not db.execute("SELECT 1 FROM rollup_minute LIMIT 1").fetchone()):
+        rebuild_rollups(db)
+    db.execute("PRAGMA journal_mode=WAL")
     db.commit()
 
+# Incidents are written behind the request by a dedicated thread
+GUARD_STAGES = (
+    'rate_limit', 'scan', 'profile', 'local_model', 'ai_classify', 'mitigation', 'log_incident',
+)
+if config.METRICS_ENABLED:
+    metrics = Metrics()
+    stage = {
+        name: metrics.histogram(f'guard_{name}_seconds', f'Time spent in the guard {name} stage.')
+        for name in GUARD_STAGES
+    }
+    incidents_total = metrics.counter('incidents_total', 'Incidents logged, by action.', label='action')
+else:
+    metrics = None
+
+incident_writer = IncidentWriter(
+    DB_PATH,
+    batch_size=config.INCIDENT_BATCH_SIZE,
+    flush_interval=config.INCIDENT_FLUSH_MS / 1000.0,
+    max_queue=config.INCIDENT_QUEUE_SIZE,
+    overflow=config.INCIDENT_OVERFLOW,
+    sample_rate=config.INCIDENT_SAMPLE_RATE,
+)
+# Older incidents are moved to per-day archive files
+archive = IncidentArchive(config.INCIDENT_ARCHIVE_DIR or os.path.join(os.path.dirname(DB_PATH), 'archive'))
+compactor = Compactor(
+    DB_PATH,
+    archive,
+    hot_hours=config.INCIDENT_HOT_HOURS,
+    retention_days=config.INCIDENT_RETENTION_DAYS,
+    max_bytes=int(config.INCIDENT_ARCHIVE_MAX_MB * 1024 * 1024),
+    max_rollup_ips=config.INCIDENT_ROLLUP_MAX_IPS,
+    interval=config.INCIDENT_COMPACT_SECONDS,
+)
+if config.INCIDENT_COMPACT_SECONDS:
+    compactor.start()
+
+if metrics:
+    metrics.gauge('ai_breaker', ai_breaker.stats, 'AI circuit breaker.')
+    metrics.gauge('incident_log', incident_writer.stats, 'Write-behind incident queue.')
+    metrics.gauge('events', events.stats, 'Dashboard event bus.')
+    metrics.gauge('retention', compactor.stats, 'Incident archive and compactor.')
+    metrics.gauge('rate_limit_keys', lambda: len(limiter), 'IPs tracked by the rate limiter.')
+    metrics.gauge('rule_pack_reloads', lambda: rules.reloads, 'Rule pack reloads since start.')
+    if isinstance(blocklist, Blocklist):
+        metrics.gauge('blocklist_entries', lambda: len(blocklist), 'Blocked addresses and prefixes.')
+    if ai_guard.cache:
+        metrics.gauge('ai_cache', ai_guard.cache.stats, 'AI verdict cache.')
+    if mitigator.cache:
+        metrics.gauge('mitigation_cache', mitigator.cache.stats, 'Mitigation script template cache.')
+    if ai_guard.singleflight:
+        metrics.gauge('ai_singleflight', ai_guard.singleflight.stats, 'Shared in-flight AI classifications.')
+    if mitigator.singleflight:
+        metrics.gauge('mitigation_singleflight', mitigator.singleflight.stats, 'Shared in-flight mitigation templates.')
+    if ai_guard.batcher:
+        metrics.gauge('ai_batcher', ai_guard.batcher.stats, 'AI micro-batcher.')
+    if profiler:
+        metrics.gauge('profiles', profiler.stats, 'Per-IP behavior profiles.')
+    if pipeline:
+        metrics.gauge('ai_pipeline', pipeline.stats, 'Async AI pipeline.')
+    if local_guard:
+        metrics.gauge('local_model', local_guard.stats, 'Local classifier decisions.')
+
 #  Helpers
 
 def is_blocked(ip: str) -> bool:
-    now = time.time()
-    until = BLOCKLIST.get(ip)
-    if until and now < until:
-        return True
-    elif until and now >= until:
-        BLOCKLIST.pop(ip, None)
-    return False
+    return blocklist.is_blocked(ip)
 
 
 def block_ip(ip: str):
-    BLOCKLIST[ip] = time.time() + app.config['BLOCK_DURATION_SECONDS']
+    duration = app.config['BLOCK_DURATION_SECONDS']
+    blocklist.block(ip, duration)
+    events.publish('block', {'ip': ip, 'until': time.time() + duration})
+
+
+# Sent to the live dashboard with each new incident; the surface is clipped
+# so one oversized request cannot bloat every connected stream.
+STREAM_SURFACE_CHARS = 2000
 
 
 def log_incident(**kwargs):
-    db = get_db()
-    db.execute(
-        """INSERT INTO incidents (
-            ts, ip, path, method, user_agent, surface,
-            heuristic_score, heuristic_hits, ai_verdict, ai_confidence,
-            ai_categories, ai_explanation, action, mitigation_script
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+    t = time.perf_counter_ns() if metrics else 0
+    ts = datetime.utcnow().isoformat()
+    kwargs.setdefault('ref', uuid.uuid4().hex)
+    incident_writer.insert(
         (
-            datetime.utcnow().isoformat(),
+            ts,
             kwargs.get('ip'),
             kwargs.get('path'),
             kwargs.get('method'),
@@ -116,50 +270,177 @@ def log_incident(**kwargs):
             kwargs.get('ai_explanation'),
             kwargs.get('action'),
             kwargs.get('mitigation_script'),
+            kwargs.get('ref'),
         )
     )
-    db.commit()
+    event = dict(kwargs, ts=ts)
+    event['surface'] = (event.get('surface') or '')[:STREAM_SURFACE_CHARS]
+    events.publish('incident', event)
+    if metrics:
+        stage['log_incident'].since(t)
+        incidents_total.inc(kwargs.get('action'))
+
+
+def update_incident(ref: str, **fields):
+    """Update an incident logged earlier, from any thread (no app context)."""
+    if 'ai_categories' in fields:
+        fields['ai_categories'] = ",".join(fields['ai_categories'] or [])
+    incident_writer.update(ref, fields)
+    events.publish('update', {'ref': ref, 'fields': fields})
+
+
+def resolve_incident(ref: str, features: dict, incident: dict, blocked: bool):
+    """Background half of the async guard: classify, block retroactively if
+    the AI says so, generate the mitigation script and update the incident."""
+    t = time.perf_counter_ns() if metrics else 0
+    ai_result = ai_guard.classify(features)
+    if metrics:
+        t = stage['ai_classify'].since(t)
+    fields = {
+        'ai_verdict': ai_result.get('verdict'),
+        'ai_confidence': ai_result.get('confidence'),
+        'ai_categories': ai_result.get('categories'),
+        'ai_explanation': ai_result.get('explanation'),
+    }
+    if blocked or ai_guard.should_block(ai_result):
+        if not blocked:
+            block_ip(incident['ip'])
+        fields['action'] = 'blocked'
+        fields['mitigation_script'] = mitigator.generate(dict(incident, ai=ai_result))
+        if metrics:
+            stage['mitigation'].since(t)
+    update_incident(ref, **fields)
+
+# Decision helpers, shared with the ASGI guard
+
+# Set in the WSGI environ by asgi_guard.py for requests it has screened
+GUARDED_ENVIRON_KEY = 'aiguard.guarded'
+
+
+def block_rate_limited(ip: str, path: str, method: str, user_agent: str):
+    block_ip(ip)
+    log_incident(
+        ip=ip,
+        path=path,
+        method=method,
+        user_agent=user_agent,
+        surface='(rate limit exceeded)',
+        heuristic_score=1.0,
+        heuristic_hits=['RATE_LIMIT'],
+        ai_verdict='MALICIOUS',
+        ai_confidence=1.0,
+        ai_categories=['RATE_LIMIT'],
+        ai_explanation='Excessive requests from single IP.',
+        action='blocked',
+        mitigation_script='(auto) temporary IP block',
+    )
+
+
+def behavior_verdict(behavior: dict) -> dict:
+    """AIGuard-shaped verdict for a client blocked on its behavior profile."""
+    return {
+        'verdict': 'MALICIOUS',
+        'confidence': behavior['score'],
+        'categories': behavior['hits'],
+        'explanation': (
+            f"Behavior profile: {behavior['paths']} distinct paths, {behavior['not_found']} not found, "
+            f"{behavior['auth_failures']} auth failures, {behavior['rate']} req/s."
+        ),
+    }
+
+
+def should_block(heur: dict, behavior_block: bool, ai_result: dict) -> bool:
+    return heur['score'] >= 0.8 or behavior_block or ai_guard.should_block(ai_result)
+
+
+def log_decision(incident: dict, surface: str, heur: dict, action: str, script: str) -> str:
+    """Log a guard decision and return the incident's ref; `incident`
+    carries ip, path, method, user_agent and the verdict under 'ai'."""
+    ai_result = incident['ai']
+    ref = uuid.uuid4().hex
+    log_incident(
+        ref=ref,
+        ip=incident['ip'],
+        path=incident['path'],
+        method=incident['method'],
+        user_agent=incident['user_agent'],
+        surface=surface,
+        heuristic_score=heur['score'],
+        heuristic_hits=heur['hits'],
+        ai_verdict=ai_result.get('verdict'),
+        ai_confidence=ai_result.get('confidence'),
+        ai_categories=ai_result.get('categories'),
+        ai_explanation=ai_result.get('explanation'),
+        action=action,
+        mitigation_script=script,
+    )
+    return ref
+
+
+def resolve_mitigation(ref: str, incident: dict):
+    """Background mitigation script for an incident already blocked and
+    logged with a pending one."""
+    t = time.perf_counter_ns() if metrics else 0
+    script = mitigator.generate(incident)
+    if metrics:
+        stage['mitigation'].since(t)
+    update_incident(ref, mitigation_script=script)
 
 # Security Middleware 
 
 @app.before_request
 def guard_request():
-    # Skip for health/static/dashboard endpoints to avoid locking yourself out
-    safe_paths = {'/dashboard', '/static', '/blocked'}
+    # Skip for health/static/dashboard/metrics endpoints to avoid locking yourself out
+    safe_paths = {'/dashboard', '/static', '/blocked', '/metrics'}
     if any(request.path.startswith(p) for p in safe_paths):
         return
+    # Already screened by the ASGI guard (asgi_guard.py) in front of us
+    if request.environ.get(GUARDED_ENVIRON_KEY):
+        return
 
+    # With metrics on, `t` is the end of the previous stage, so each stage
+    # costs one clock read
+    t = time.perf_counter_ns() if metrics else 0
     ip = request.headers.get('X-Forwarded-For', request.remote_addr)
     if is_blocked(ip):
         return redirect(url_for('blocked'))
 
-    # Rate limiting
-    if not limiter.allow(ip):
-        block_ip(ip)
-        log_incident(
-            ip=ip,
-            path=request.path,
-            method=request.method,
-            user_agent=request.headers.get('User-Agent','-'),
-            surface='(rate limit exceeded)',
-            heuristic_score=1.0,
-            heuristic_hits=['RATE_LIMIT'],
-            ai_verdict='MALICIOUS',
-            ai_confidence=1.0,
-            ai_categories=['RATE_LIMIT'],
-            ai_explanation='Excessive requests from single IP.',
-            action='blocked',
-            mitigation_script='(auto) temporary IP block',
-        )
+    # Rate limiting (timed together with the blocklist lookup)
+    allowed = limiter.allow(ip)
+    if metrics:
+        t = stage['rate_limit'].since(t)
+    if not allowed:
+        block_rate_limited(ip, request.path, request.method, request.headers.get('User-Agent','-'))
         return redirect(url_for('blocked'))
 
     # Heuristic prefilter
-    surface = extract_surface(request)
-    heur = heuristic_assess(surface, request.headers.get('User-Agent','-'))
+    surface, heur = scan_request(
+        request,
+        engine=rules.current(),
+        max_body=app.config['BODY_SCAN_LIMIT'],
+        chunk_size=app.config['BODY_CHUNK_SIZE'],
+    )
+    if metrics:
+        t = stage['scan'].since(t)
+
+    # Cross-request behavior: path enumeration, auth failures, request rate
+    behavior_block = False
+    if profiler:
+        behavior = profiler.observe(ip, request.path)
+        g.profiled_ip = ip
+        behavior_block = behavior['score'] >= app.config['PROFILE_BLOCK_SCORE']
+        if metrics:
+            t = stage['profile'].since(t)
 
-    # If clearly suspicious or random sample, ask AI to classify
+    # If clearly suspicious or random sample, ask AI to classify, spending
+    # at most the latency budget on AI calls for this request
+    deadline = time.monotonic() + app.config['AI_LATENCY_BUDGET_MS'] / 1000.0
     ai_result = {'verdict': 'UNKNOWN', 'confidence': 0.0, 'categories': [], 'explanation': ''}
-    if heur['score'] >= 0.35 or request.args.get('force_ai') == '1':
+    if behavior_block:
+        # Conclusive on its own, whatever this request contains
+        heur = dict(heur, hits=heur['hits'] + behavior['hits'])
+        ai_result = behavior_verdict(behavior)
+    elif heur['score'] >= 0.35 or request.args.get('force_ai') == '1':
         features = {
             'ip': ip,
             'method': request.method,
@@ -169,14 +450,23 @@ def guard_request():
             'body_len': request.content_length or 0,
             'surface': surface[:1500],
         }
-        ai_result = ai_guard.classify(features)
+        # The local model settles confident cases; the rest go to the LLM.
+        # It scores the untruncated surface, as stored for training.
+        local = None
+        if local_guard:
+            local = local_guard.classify(surface, heur['hits'])
+            if metrics:
+                t = stage['local_model'].since(t)
+        if local is not None:
+            ai_result = local
+        elif pipeline:
+            return guard_async(ip, surface, heur, features)
+        else:
+            ai_result = ai_guard.classify(features, deadline=deadline)
+            if metrics:
+                t = stage['ai_classify'].since(t)
 
-    # Decide action
-    action = 'allow'
-    if heur['score'] >= 0.8 or ai_guard.should_block(ai_result):
-        action = 'block'
-
-    if action == 'block':
+    if should_block(heur, behavior_block, ai_result):
         block_ip(ip)
         # Ask AI to produce a small mitigation script for incident response
         incident = {
@@ -187,41 +477,69 @@ def guard_request():
             'heuristic_hits': heur['hits'],
             'ai': ai_result,
         }
-        script = mitigator.generate(incident)
-        log_incident(
-            ip=ip,
-            path=request.path,
-            method=request.method,
-            user_agent=request.headers.get('User-Agent','-'),
-            surface=surface,
-            heuristic_score=heur['score'],
-            heuristic_hits=heur['hits'],
-            ai_verdict=ai_result.get('verdict'),
-            ai_confidence=ai_result.get('confidence'),
-            ai_categories=ai_result.get('categories'),
-            ai_explanation=ai_result.get('explanation'),
-            action='blocked',
-            mitigation_script=script,
-        )
+        if pipeline:
+            # Blocked already; the script follows from the pipeline
+            ref = log_decision(incident, surface, heur, 'blocked', '(pending)')
+            if not pipeline.submit(resolve_mitigation, ref, incident):
+                update_incident(ref, mitigation_script='(auto) temporary IP block')
+            return redirect(url_for('blocked'))
+        script = mitigator.generate(incident, deadline=deadline)
+        if metrics:
+            t = stage['mitigation'].since(t)
+        log_decision(incident, surface, heur, 'blocked', script)
         return redirect(url_for('blocked'))
 
     # Otherwise allow and optionally log suspicious-but-allowed
     if heur['score'] >= 0.35:
-        log_incident(
-            ip=ip,
-            path=request.path,
-            method=request.method,
-            user_agent=request.headers.get('User-Agent','-'),
-            surface=surface,
-            heuristic_score=heur['score'],
-            heuristic_hits=heur['hits'],
-            ai_verdict=ai_result.get('verdict'),
-            ai_confidence=ai_result.get('confidence'),
-            ai_categories=ai_result.get('categories'),
-            ai_explanation=ai_result.get('explanation'),
-            action='allowed',
-            mitigation_script='',
+        log_decision(
+            {'ip': ip, 'path': request.path, 'method': request.method,
+             'user_agent': request.headers.get('User-Agent','-'), 'ai': ai_result},
+            surface, heur, 'allowed', '')
+
+
+def guard_async(ip, surface, heur, features):
+    """AI_ASYNC mode: decide with heuristics now, log the incident as PENDING
+    and let the pipeline classify, block and update it later."""
+    blocked = heur['score'] >= 0.8
+    if blocked:
+        block_ip(ip)
+    ref = uuid.uuid4().hex
+    incident = {
+        'ip': ip,
+        'path': request.path,
+        'method': request.method,
+        'user_agent': request.headers.get('User-Agent','-'),
+    }
+    log_incident(
+        ref=ref,
+        surface=surface,
+        heuristic_score=heur['score'],
+        heuristic_hits=heur['hits'],
+        ai_verdict='PENDING',
+        ai_explanation='Queued for AI classification.',
+        action='blocked' if blocked else 'allowed',
+        mitigation_script='(pending)' if blocked else '',
+        **incident,
+    )
+    queued = pipeline.submit(
+        resolve_incident, ref, features, dict(incident, heuristic_hits=heur['hits']), blocked)
+    if not queued:
+        update_incident(
+            ref,
+            ai_verdict='UNKNOWN',
+            ai_explanation='AI queue full; decided by heuristics only.',
+            mitigation_script='(auto) temporary IP block' if blocked else '',
         )
+    if blocked:
+        return redirect(url_for('blocked'))
+
+@app.after_request
+def profile_response(response):
+    # Status codes feed the 404 / auth-failure counts of the client's profile
+    ip = g.pop('profiled_ip', None)
+    if ip is not None:
+        profiler.record_status(ip, response.status_code)
+    return response
 
 # ----------- Routes -----------
 
@@ -233,18 +551,115 @@ def index():
 def blocked():
     return render_template('blocked.html')
 
+DASHBOARD_PAGE_SIZE = 50
+# Large text columns (surface, mitigation_script) are loaded on demand
+INCIDENT_LIST_COLUMNS = (
+    "id, ref, ts, ip, path, method, heuristic_score, heuristic_hits, "
+    "ai_verdict, ai_confidence, ai_categories, action"
+)
+
+
 @app.route('/dashboard')
 def dashboard():
     db = get_db()
-    rows = db.execute("SELECT * FROM incidents ORDER BY id DESC LIMIT 200").fetchall()
-    return render_template('dashboard.html', rows=rows, blocklist=BLOCKLIST)
+    # Taken before the query: the live stream resumes from here, and the
+    # page drops rows it already shows
+    last_event = events.last_id
+    # Keyset pagination on the primary key: every page is an index range scan
+    before = request.args.get('before', type=int)
+    rows = db.execute(
+        f"SELECT {INCIDENT_LIST_COLUMNS} FROM incidents WHERE id < ? ORDER BY id DESC LIMIT ?",
+        (before or 2**63 - 1, DASHBOARD_PAGE_SIZE),
+    ).fetchall()
+    older = rows[-1]['id'] if len(rows) == DASHBOARD_PAGE_SIZE else None
+    top_ips = db.execute(
+        "SELECT ip, incidents, blocked, last_ts FROM rollup_ip ORDER BY incidents DESC LIMIT 10").fetchall()
+    categories = db.execute(
+        "SELECT category, incidents FROM rollup_category ORDER BY incidents DESC LIMIT 20").fetchall()
+    since = (datetime.utcnow() - timedelta(minutes=60)).isoformat()[:16]
+    minutes = db.execute(
+        "SELECT minute, incidents, blocked FROM rollup_minute WHERE minute >= ? ORDER BY minute DESC",
+        (since,)).fetchall()
+    return render_template(
+        'dashboard.html', rows=rows, older=older, live=before is None, last_event=last_event,
+        page_size=DASHBOARD_PAGE_SIZE, top_ips=top_ips, categories=categories,
+        minutes=minutes, peak=max([m['incidents'] for m in minutes], default=1),
+        blocklist=blocklist, rule_pack=rules.current(),
+        ai_cache=ai_guard.cache.stats() if ai_guard.cache else None,
+        mitigation_cache=mitigator.cache.stats() if mitigator.cache else None,
+        ai_pipeline=pipeline.stats() if pipeline else None,
+        ai_breaker=ai_breaker.stats(),
+        local_model=local_guard.stats() if local_guard else None,
+        incident_log=incident_writer.stats(),
+    )
 
-@app.route('/dashboard/unblock/<ip>', methods=['POST'])
+@app.route('/dashboard/incident/<int:incident_id>')
+def incident_detail(incident_id):
+    row = get_db().execute(
+        "SELECT surface, mitigation_script FROM incidents WHERE id = ?", (incident_id,)).fetchone()
+    if row is None:
+        # Moved out of the hot table by the compactor
+        row = archive.get(incident_id)
+        if row is None:
+            abort(404)
+    return jsonify({'surface': row['surface'], 'mitigation_script': row['mitigation_script']})
+
+@app.route('/dashboard/stream')
+def dashboard_stream():
+    """Server-Sent Events: new incidents, verdict updates and blocklist
+    changes, resumable via Last-Event-ID. Never touches the database."""
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id', '')
+    last_id = int(last_id) if last_id.isdigit() else events.last_id
+    heartbeat = app.config['EVENT_HEARTBEAT_SECONDS']
+
+    def stream(last_id):
+        yield 'retry: 3000\n\n'
+        pending = events.since(last_id)
+        while True:
+            if pending is None:
+                # Fell behind the ring buffer: the client reloads the page
+                last_id = events.last_id
+                yield format_sse(last_id, 'reset', '{}')
+            elif pending:
+                for event_id, kind, payload in pending:
+                    yield format_sse(event_id, kind, payload)
+                last_id = pending[-1][0]
+            else:
+                yield ': keep-alive\n\n'
+            pending = events.wait(last_id, heartbeat)
+
+    return Response(stream(last_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/dashboard/block', methods=['POST'])
+def block_target():
+    # An address or a CIDR prefix such as 203.0.113.0/24
+    target = request.form.get('target', '').strip()
+    if parse_target(target) is None:
+        flash(f"Not an IP address or prefix: {target!r}")
+    else:
+        try:
+            block_ip(target)
+            flash(f"Blocked {target}")
+        except ValueError as e:
+            flash(str(e))
+    return redirect(url_for('dashboard'))
+
+@app.route('/dashboard/unblock/<path:ip>', methods=['POST'])
 def unblock(ip):
-    BLOCKLIST.pop(ip, None)
+    blocklist.unblock(ip)
+    events.publish('unblock', {'ip': ip})
     flash(f"Unblocked {ip}")
     return redirect(url_for('dashboard'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    if metrics is None:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/echo')
 def echo():
     # innocuous endpoint to test rate limiting / AI analysis
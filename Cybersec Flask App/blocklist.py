@@ -0,0 +1,282 @@
+import heapq
+import ipaddress
+import itertools
+import socket
+import threading
+import time
+
+
+def parse_target(target: str):
+    """Parse an IP or CIDR prefix into (width, network int, prefix length).
+
+    Returns None for anything that is not an address (e.g. a raw
+    X-Forwarded-For list); those are blocked as opaque exact strings.
+    """
+    if '/' in target:
+        try:
+            net = ipaddress.ip_network(target.strip(), strict=False)
+        except ValueError:
+            return None
+        return net.max_prefixlen, int(net.network_address), net.prefixlen
+    return _parse_host(target)
+
+
+def _parse_host(ip: str):
+    # inet_pton is several times faster than ipaddress.ip_address
+    width, family = (128, socket.AF_INET6) if ':' in ip else (32, socket.AF_INET)
+    try:
+        return width, int.from_bytes(socket.inet_pton(family, ip), 'big'), width
+    except OSError:
+        return None
+
+
+def format_target(width: int, net: int, plen: int) -> str:
+    addr = ipaddress.ip_address(net) if width == 32 else ipaddress.IPv6Address(net)
+    return str(addr) if plen == width else f"{addr}/{plen}"
+
+
+class _Node:
+    """Patricia trie node: a prefix (`net`, `plen`) and its two subtrees,
+    chosen by the bit right after the prefix. `until` is set when the
+    prefix itself is blocked. `shift` and `bit` are precomputed for the
+    lookup loop."""
+
+    __slots__ = ('net', 'plen', 'shift', 'bit', 'left', 'right', 'until')
+
+    def __init__(self, width, net, plen, until=None):
+        self.net = net
+        self.plen = plen
+        self.shift = width - plen
+        self.bit = max(width - 1 - plen, 0)  # full-length nodes have no children
+        self.left = None
+        self.right = None
+        self.until = until
+
+    def child(self, bit):
+        return self.right if bit else self.left
+
+    def set_child(self, bit, node):
+        if bit:
+            self.right = node
+        else:
+            self.left = node
+
+
+class PrefixTrie:
+    """Compressed binary radix (patricia) trie over `width`-bit addresses
+    with longest-prefix match. Only branching and blocked nodes exist, so
+    depth is bounded by the number of distinct branch points rather than
+    the address width.
+
+    Writers must be serialized by the caller. `match` needs no lock: nodes
+    are fully built before they are linked in and unlinking is a single
+    attribute store, so a concurrent reader sees the trie either before or
+    after each change.
+    """
+
+    def __init__(self, width: int):
+        self.width = width
+        self.root = _Node(width, 0, 0)
+        self.size = 0
+
+    def _bit(self, addr, pos):
+        return (addr >> (self.width - 1 - pos)) & 1
+
+    def match(self, addr: int, now: float):
+        """Longest unexpired prefix containing `addr`, as its node, or None."""
+        node, best = self.root, None
+        # Follow address bits and only compare prefixes at blocked nodes: a
+        # mismatch above them shows up there too, since descendants extend
+        # their ancestors' prefixes.
+        while node is not None:
+            until = node.until
+            if until is not None:
+                if (addr ^ node.net) >> node.shift:
+                    break
+                if until > now:
+                    best = node
+            node = node.right if (addr >> node.bit) & 1 else node.left
+        return best
+
+    def insert(self, net: int, plen: int, until: float):
+        width = self.width
+        net &= ~((1 << (width - plen)) - 1)
+        node = self.root
+        while True:
+            if node.plen == plen:
+                if node.until is None:
+                    self.size += 1
+                node.until = until
+                return
+            bit = self._bit(net, node.plen)
+            child = node.child(bit)
+            if child is None:
+                node.set_child(bit, _Node(width, net, plen, until))
+                self.size += 1
+                return
+            diff = (child.net ^ net).bit_length()
+            common = min(width - diff, child.plen, plen)
+            if common == child.plen:
+                node = child
+                continue
+            if common == plen:
+                # New prefix sits above `child`
+                new = _Node(width, net, plen, until)
+                new.set_child(self._bit(child.net, plen), child)
+            else:
+                # Split at the first differing bit
+                new = _Node(width, net & ~((1 << (width - common)) - 1), common)
+                new.set_child(self._bit(child.net, common), child)
+                new.set_child(self._bit(net, common), _Node(width, net, plen, until))
+            node.set_child(bit, new)
+            self.size += 1
+            return
+
+    def remove(self, net: int, plen: int, until: float = None) -> bool:
+        """Unblock a prefix; with `until`, only if it still expires then
+        (so a stale expiry cannot undo a later re-block)."""
+        width = self.width
+        net &= ~((1 << (width - plen)) - 1)
+        path, node = [], self.root
+        while node is not None and node.plen < plen:
+            if (net ^ node.net) >> (width - node.plen):
+                return False
+            bit = self._bit(net, node.plen)
+            path.append((node, bit))
+            node = node.child(bit)
+        if node is None or node.plen != plen or node.net != net or node.until is None:
+            return False
+        if until is not None and node.until != until:
+            return False
+        node.until = None
+        self.size -= 1
+        # Splice out nodes that no longer block anything or branch
+        while path and node.until is None and not (node.left and node.right):
+            parent, bit = path.pop()
+            parent.set_child(bit, node.left or node.right)
+            node = parent
+        return True
+
+    def items(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.until is not None:
+                yield node.net, node.plen, node.until
+            stack.extend(c for c in (node.left, node.right) if c is not None)
+
+
+class Blocklist:
+    """In-process IP blocklist accepting single addresses and IPv4/IPv6
+    CIDR prefixes (e.g. "203.0.113.0/24").
+
+    Single IPv4 addresses live in a dict keyed by the address string, so
+    the common lookup is one hash probe; prefixes and IPv6 addresses live in
+    per-family patricia tries with longest-prefix match. A min-heap of expiry times removes
+    entries in O(log n) when they lapse, whether or not the address is seen
+    again. State is private to the worker process; see
+    shared_state.SqliteBlocklist for a host-wide (exact-address) variant.
+    """
+
+    def __init__(self):
+        self._hosts = {}
+        self._tries = {32: PrefixTrie(32), 128: PrefixTrie(128)}
+        # (until, seq, key); key is a host string or (width, net, plen)
+        self._expiry = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hosts) + sum(t.size for t in self._tries.values())
+
+    def is_blocked(self, ip: str) -> bool:
+        now = time.time()
+        if self._expiry and self._expiry[0][0] <= now and self._lock.acquire(blocking=False):
+            try:
+                self._expire(now)
+            finally:
+                self._lock.release()
+        if self._hosts.get(ip, 0) > now:
+            return True
+        return self._match(ip, now) is not None
+
+    def match(self, ip: str):
+        """Most specific blocked prefix containing `ip`, as "net/plen", or None."""
+        found = self._match(ip, time.time())
+        return None if found is None else format_target(found[0], found[1].net, found[1].plen)
+
+    def _match(self, ip, now):
+        if not (self._tries[32].size or self._tries[128].size):
+            return None
+        host = _parse_host(ip)
+        if host is None:
+            return None
+        width, addr, _ = host
+        node = self._tries[width].match(addr, now)
+        return None if node is None else (width, node)
+
+    def block(self, target: str, duration: float):
+        until = time.time() + duration
+        key = self._key(target)
+        with self._lock:
+            if isinstance(key, str):
+                self._hosts[key] = until
+            else:
+                self._tries[key[0]].insert(key[1], key[2], until)
+            heapq.heappush(self._expiry, (until, next(self._seq), key))
+            self._expire(time.time())
+            self._compact()
+
+    def unblock(self, target: str):
+        key = self._key(target)
+        with self._lock:
+            if isinstance(key, str):
+                self._hosts.pop(key, None)
+            else:
+                self._tries[key[0]].remove(key[1], key[2])
+            self._compact()
+
+    def items(self):
+        now = time.time()
+        out = [(ip, until) for ip, until in list(self._hosts.items()) if until > now]
+        for width, trie in self._tries.items():
+            with self._lock:
+                entries = list(trie.items())
+            out.extend((format_target(width, net, plen), until)
+                       for net, plen, until in entries if until > now)
+        return out
+
+    def _key(self, target: str):
+        parsed = parse_target(target)
+        if parsed is None:
+            return target
+        width, net, plen = parsed
+        if width == 32 and plen == width:
+            # Dotted quads accepted by inet_pton are already canonical
+            return format_target(width, net, plen) if '/' in target else target
+        # IPv6 has many spellings of one address, so IPv6 hosts go in the
+        # trie as /128s rather than in the string-keyed dict
+        return parsed
+
+    # Both helpers run with self._lock held.
+
+    def _expire(self, now: float):
+        heap = self._expiry
+        while heap and heap[0][0] <= now:
+            until, _, key = heapq.heappop(heap)
+            if isinstance(key, str):
+                if self._hosts.get(key) == until:
+                    del self._hosts[key]
+            else:
+                self._tries[key[0]].remove(key[1], key[2], until)
+
+    def _compact(self):
+        # Re-blocks and unblocks leave stale heap entries behind (skipped on
+        # expiry); rebuild once they outnumber the live ones.
+        if len(self._expiry) <= 2 * len(self) + 64:
+            return
+        heap = [(until, next(self._seq), ip) for ip, until in self._hosts.items()]
+        for width, trie in self._tries.items():
+            heap.extend((until, next(self._seq), (width, net, plen)) for net, plen, until in trie.items())
+        heapq.heapify(heap)
+        self._expiry = heap
@@ -0,0 +1,101 @@
+import threading
+import time
+from typing import Optional
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling upstream while the breaker is open."""
+
+
+def remaining(call_timeout: float, deadline: Optional[float]) -> float:
+    """Seconds a call may take: its own timeout, capped by the request's
+    latency budget (a time.monotonic() deadline) when there is one."""
+    if deadline is None:
+        return call_timeout
+    return min(call_timeout, deadline - time.monotonic())
+
+
+class CircuitBreaker:
+    """Shared circuit breaker for calls to the OpenAI API.
+
+    closed     calls go through; `failure_threshold` consecutive failures
+               (errors or timeouts) open the circuit.
+    open       calls are refused (`allow()` is False) for `reset_timeout`
+               seconds, so callers fall back immediately instead of each
+               waiting out a timeout.
+    half-open  a single probe call is let through; success closes the
+               circuit, failure opens it for another `reset_timeout`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def rejects(self) -> bool:
+        """True while calls would be refused outright (open, not yet due for
+        a probe); counted as a skipped call. Lets callers bail out before
+        doing any work without claiming the half-open probe."""
+        if self.state != self.OPEN:
+            return False
+        with self._lock:
+            self.rejected += 1
+        return True
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # Half-open: admit exactly one probe until it reports back.
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'opened': self.opened,
+        }
@@ -5,13 +5,130 @@ class Config:
 
     # OpenAI
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")  # e.g. a local stub_openai.py
     AI_MODEL = os.getenv("AI_MODEL", "gpt-4o-mini")
     AI_MIN_CONFIDENCE = float(os.getenv("AI_MIN_CONFIDENCE", "0.65"))
+    # Verdict cache keyed on normalized request fingerprints (0 disables)
+    AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "10000"))
+    AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "600"))
+    # Concurrent classifications with the same fingerprint, and mitigation
+    # template misses with the same signature, share one call
+    AI_SINGLEFLIGHT = os.getenv("AI_SINGLEFLIGHT", "1") == "1"
+    # Mitigation script templates keyed on incident signatures (0 disables);
+    # MITIGATION_CACHE_PATH also keeps them in a SQLite file across restarts
+    MITIGATION_CACHE_SIZE = int(os.getenv("MITIGATION_CACHE_SIZE", "1000"))
+    MITIGATION_CACHE_TTL = float(os.getenv("MITIGATION_CACHE_TTL", "86400"))
+    MITIGATION_CACHE_PATH = os.getenv("MITIGATION_CACHE_PATH", "")
+    # Decide inline with heuristics and run AI classification/mitigation in
+    # a bounded background pool, applying blocks when verdicts arrive.
+    AI_ASYNC = os.getenv("AI_ASYNC", "0") == "1"
+    AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
+    AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "256"))
+    # Coalesce concurrent classifications into one completion of up to
+    # AI_BATCH_SIZE requests, waiting at most AI_BATCH_WAIT_MS (0/1 = off).
+    AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "0"))
+    AI_BATCH_WAIT_MS = float(os.getenv("AI_BATCH_WAIT_MS", "10"))
+    # Per-call deadlines, a per-request budget for all AI work, and a circuit
+    # breaker shared by AIGuard and MitigationGenerator.
+    AI_CALL_TIMEOUT_MS = float(os.getenv("AI_CALL_TIMEOUT_MS", "5000"))
+    AI_LATENCY_BUDGET_MS = float(os.getenv("AI_LATENCY_BUDGET_MS", "8000"))
+    AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+    AI_BREAKER_RESET_SECONDS = float(os.getenv("AI_BREAKER_RESET_SECONDS", "30"))
+    # Local n-gram model trained with `python local_model.py train`. When
+    # set, it decides requests itself and only escalates to the LLM when its
+    # probability falls inside [LOCAL_MODEL_LOW, LOCAL_MODEL_HIGH].
+    LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", "")
+    LOCAL_MODEL_LOW = float(os.getenv("LOCAL_MODEL_LOW", "0.1"))
+    LOCAL_MODEL_HIGH = float(os.getenv("LOCAL_MODEL_HIGH", "0.9"))
 
     # Basic guard knobs
     RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "120"))
     RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "30"))
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+    RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+    # token_bucket | gcra | sliding_window (see rate_limit.LIMITERS)
+    RATE_LIMIT_ALGORITHM = os.getenv("RATE_LIMIT_ALGORITHM", "token_bucket")
     BLOCK_DURATION_SECONDS = int(os.getenv("BLOCK_DURATION_SECONDS", "900"))
 
+    # Per-IP behavior profiles (distinct paths, status codes, request rate)
+    # for at most PROFILE_MAX_IPS clients (0 disables). A client whose
+    # behavior score reaches PROFILE_BLOCK_SCORE is blocked without an AI
+    # call; see profiler.BehaviorProfiler for how the thresholds combine.
+    PROFILE_MAX_IPS = int(os.getenv("PROFILE_MAX_IPS", "100000"))
+    PROFILE_IDLE_SECONDS = float(os.getenv("PROFILE_IDLE_SECONDS", "3600"))
+    PROFILE_SCAN_PATHS = int(os.getenv("PROFILE_SCAN_PATHS", "50"))
+    PROFILE_AUTH_FAILURES = int(os.getenv("PROFILE_AUTH_FAILURES", "20"))
+    PROFILE_RATE_PER_SEC = float(os.getenv("PROFILE_RATE_PER_SEC", "5"))
+    # Paths and status codes count towards a score for this long
+    PROFILE_WINDOW_SECONDS = float(os.getenv("PROFILE_WINDOW_SECONDS", "600"))
+    # Also score each IPv4 /24 with thresholds this many times higher and
+    # let its addresses inherit that score (0 disables)
+    PROFILE_NETWORK_SCALE = float(os.getenv("PROFILE_NETWORK_SCALE", "0"))
+    PROFILE_BLOCK_SCORE = float(os.getenv("PROFILE_BLOCK_SCORE", "0.8"))
+
+    # Shared SQLite file for rate-limit buckets and the blocklist, so all
+    # worker processes on a host enforce one budget. Empty = per-process.
+    # The shared limiter is always a token bucket. Taking tokens from it is
+    # a write transaction (~25us) under SQLite's single database-wide write
+    # lock, which serializes every worker: past roughly 20-40k bucket writes
+    # per second per host, workers queue on the lock. Each worker therefore
+    # leases RATE_LIMIT_SHARED_LEASE tokens of a client per write and spends
+    # them locally for up to RATE_LIMIT_SHARED_LEASE_TTL seconds, cutting
+    # writes by about that factor; a client may then be denied up to
+    # (workers - 1) * (lease - 1) requests early. 1 = one write per request.
+    SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")
+    RATE_LIMIT_SHARED_LEASE = int(os.getenv("RATE_LIMIT_SHARED_LEASE", "4"))
+    RATE_LIMIT_SHARED_LEASE_TTL = float(os.getenv("RATE_LIMIT_SHARED_LEASE_TTL", "1.0"))
+
+    # Request bodies are streamed through the signature engine in chunks of
+    # BODY_CHUNK_SIZE bytes, up to BODY_SCAN_LIMIT bytes per request.
+    BODY_SCAN_LIMIT = int(os.getenv("BODY_SCAN_LIMIT", str(1024 * 1024)))
+    BODY_CHUNK_SIZE = int(os.getenv("BODY_CHUNK_SIZE", str(16 * 1024)))
+
+    # Signature rule pack (hot-reloaded when the file changes)
+    RULE_PACK_PATH = os.getenv(
+        "RULE_PACK_PATH", os.path.join(os.path.dirname(__file__), "rules", "default.json"))
+    RULE_PACK_CHECK_SECONDS = float(os.getenv("RULE_PACK_CHECK_SECONDS", "2"))
+
+    # Write-behind incident logging: rows are committed in batches of up to
+    # INCIDENT_BATCH_SIZE every INCIDENT_FLUSH_MS. When INCIDENT_QUEUE_SIZE
+    # rows are pending, new ones are dropped ("drop"), or from 3/4 full only
+    # a INCIDENT_SAMPLE_RATE fraction is kept ("sample").
+    # INCIDENT_DB_PATH defaults to incidents.db next to app.py.
+    INCIDENT_DB_PATH = os.getenv("INCIDENT_DB_PATH", "")
+    INCIDENT_BATCH_SIZE = int(os.getenv("INCIDENT_BATCH_SIZE", "500"))
+    INCIDENT_FLUSH_MS = float(os.getenv("INCIDENT_FLUSH_MS", "5"))
+    INCIDENT_QUEUE_SIZE = int(os.getenv("INCIDENT_QUEUE_SIZE", "50000"))
+    INCIDENT_OVERFLOW = os.getenv("INCIDENT_OVERFLOW", "drop")
+    INCIDENT_SAMPLE_RATE = float(os.getenv("INCIDENT_SAMPLE_RATE", "0.1"))
+
+    # Retention: incidents older than INCIDENT_HOT_HOURS move out of the
+    # incidents table into one archive file per day (surfaces compressed,
+    # mitigation scripts stored once). Archive days older than
+    # INCIDENT_RETENTION_DAYS are deleted, and the oldest ones whenever the
+    # archive exceeds INCIDENT_ARCHIVE_MAX_MB (0 = no limit for either).
+    # The per-IP dashboard rollup keeps the INCIDENT_ROLLUP_MAX_IPS busiest
+    # addresses seen within the retention window (0 = no cap).
+    # INCIDENT_COMPACT_SECONDS=0 leaves compaction to `python retention.py`.
+    INCIDENT_ARCHIVE_DIR = os.getenv("INCIDENT_ARCHIVE_DIR", "")  # default: archive/ next to the DB
+    INCIDENT_HOT_HOURS = float(os.getenv("INCIDENT_HOT_HOURS", "24"))
+    INCIDENT_RETENTION_DAYS = int(os.getenv("INCIDENT_RETENTION_DAYS", "30"))
+    INCIDENT_ARCHIVE_MAX_MB = float(os.getenv("INCIDENT_ARCHIVE_MAX_MB", "2048"))
+    INCIDENT_ROLLUP_MAX_IPS = int(os.getenv("INCIDENT_ROLLUP_MAX_IPS", "10000"))
+    INCIDENT_COMPACT_SECONDS = float(os.getenv("INCIDENT_COMPACT_SECONDS", "300"))
+
+    # Live dashboard stream: events kept for Last-Event-ID resume, and the
+    # keep-alive interval for idle connections
+    EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "1000"))
+    EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+
+    # asgi_guard.py: threads running the Flask app behind the ASGI guard.
+    # Requests waiting on the AI there do not hold one.
+    ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "64"))
+
+    # Counters, per-stage latency histograms and gauges on /metrics
+    # (Prometheus text format). 0 removes the instrumentation entirely.
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
     # Misc
     ENV = os.getenv("FLASK_ENV", "production")
\ No newline at end of file
@@ -1,58 +1,409 @@
+import codecs
+import io
+import json
+import os
 import re
-from urllib.parse import unquote
-
-# Lightweight signature patterns (heuristic pre-filter)
-SQLI = re.compile(r"(\bOR\b|\bAND\b).*?=|\bUNION\b|--|#|/\*|\bSELECT\b|\bDROP\b|\bINSERT\b|\bUPDATE\b", re.I)
-XSS = re.compile(r"<\s*script|onerror\s*=|onload\s*=|javascript:\\S|<\s*img|<\s*svg|<\s*iframe", re.I)
-LFI = re.compile(r"\.\./|\.\.\\|/etc/passwd|\\boot\.ini", re.I)
-RCE = re.compile(r"(;|\|\||&&)\s*(cat|ls|id|uname|curl|wget|sh|bash)\b|`[^`]+`|\$\([^\)]+\)", re.I)
-SSRF = re.compile(r"https?://(127\.0\.0\.1|0\.0\.0\.0|localhost|169\.254\.169\.254|\[::1\])", re.I)
-SCANNER_UA = re.compile(r"sqlmap|nikto|nmap|curl|wget|acunetix|nessus", re.I)
-
-CATEGORIES = {
-    'SQLI': SQLI,
-    'XSS': XSS,
-    'LFI': LFI,
-    'RCE': RCE,
-    'SSRF': SSRF,
-}
-
-
-def extract_surface(request):
-    """Extracts string surface from Flask request for heuristic and AI analysis."""
-    parts = [
-        f"method={request.method}",
-        f"path={request.path}",
-        f"query={request.query_string.decode('utf-8', 'ignore')}",
-        f"ip={request.remote_addr}",
-        f"ua={request.headers.get('User-Agent','-')}",
-    ]
-    # Safely include body (only small bodies)
+import tempfile
+from urllib.parse import unquote, unquote_to_bytes
+
+from werkzeug.http import parse_options_header
+from werkzeug.exceptions import HTTPException
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NEED_DATA
+
+
+def _words(*words):
+    """Whole-word alternation. The leading word boundary is checked with a
+    look-behind so the regex keeps a literal prefix to scan for."""
+    return "|".join(rf"{w}\b(?<=\b{w})" for w in words)
+
+
+DEFAULT_RULE_PACK = os.path.join(os.path.dirname(__file__), 'rules', 'default.json')
+
+
+class SignatureEngine:
+    """Compiled matcher that scores a request surface with anchor prefiltering.
+
+    Built from a rule pack (see rules/default.json) and immutable once
+    constructed, so a request holding a reference keeps a consistent view
+    while a newer pack is swapped in.
+
+    The surface is lower-cased once, then each signature is gated by its
+    literal anchors (one substring search per anchor, so a surface is
+    scanned a few dozen times, not once); its regex only runs when an
+    anchor is present, and a category stops being checked after its first
+    hit. Every check is linear in the surface length.
+    """
+
+    def __init__(self, categories, scanner_ua=(), scanner_weight=0.0, name=None, version=None):
+        # categories: name -> (weight, [(anchors, pattern, pair)]), where pair
+        # is None or (closer, gap, one_line) and pattern is then the opener.
+        self.categories = tuple(
+            (cat, float(weight), tuple(
+                (tuple(anchors), re.compile(pattern) if pattern else None, pair)
+                for anchors, pattern, pair in sigs
+            ))
+            for cat, (weight, sigs) in categories.items()
+        )
+        self.scanner_ua = tuple(scanner_ua)
+        self.scanner_weight = float(scanner_weight)
+        self.name = name
+        self.version = version
+
+    @classmethod
+    def from_pack(cls, pack: dict) -> 'SignatureEngine':
+        """Compile a parsed rule pack. Raises ValueError if it is malformed.
+
+        Signatures are written against the lower-cased surface. A signature
+        with `anchors` and no `pattern` matches on the anchor alone; `words`
+        is shorthand for a whole-word pattern anchored on those words. Pairs
+        match an opener followed by `closer` at least `gap` characters later
+        (on the same line with `one_line`), replacing `a.*?b`-style regexes
+        that backtrack quadratically. Patterns must stay bounded.
+        """
+        try:
+            categories = {}
+            for cat, spec in pack['categories'].items():
+                sigs = []
+                for sig in spec.get('signatures', []):
+                    words = sig.get('words')
+                    pattern = _words(*words) if words else sig.get('pattern')
+                    sigs.append((sig.get('anchors') or words, pattern, None))
+                for pair in spec.get('pairs', []):
+                    words = pair.get('words')
+                    opener = _words(*words) if words else pair['opener']
+                    sigs.append((pair.get('anchors') or words, opener,
+                                 (pair['closer'], int(pair.get('gap', 0)), bool(pair.get('one_line', False)))))
+                if not all(anchors for anchors, _, _ in sigs):
+                    raise ValueError(f"category {cat}: every signature needs anchors or words")
+                categories[cat] = (spec['weight'], sigs)
+            scanner = pack.get('scanner', {})
+            return cls(
+                categories,
+                scanner_ua=scanner.get('agents', ()),
+                scanner_weight=scanner.get('weight', 0.0),
+                name=pack.get('name'),
+                version=pack.get('version'),
+            )
+        except (KeyError, TypeError, AttributeError, re.error) as e:
+            raise ValueError(f"Invalid rule pack: {e!r}") from e
+
+    @classmethod
+    def from_file(cls, path: str) -> 'SignatureEngine':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_pack(json.load(f))
+
+    @staticmethod
+    def _pair_hit(text, opener, closer, gap, one_line):
+        # Closer and line-end positions are cached across openers, so each
+        # stretch of the surface is searched at most once.
+        closer_at = -1
+        line_end = -1
+        for m in opener.finditer(text):
+            end = m.end()
+            if closer_at < end:
+                closer_at = text.find(closer, end)
+                if closer_at < 0:
+                    return False
+            if one_line and line_end < end:
+                line_end = text.find('\n', end)
+                if line_end < 0:
+                    line_end = len(text)
+            if closer_at - end >= gap and (not one_line or closer_at < line_end):
+                return True
+        return False
+
+    def _category_hit(self, text, sigs):
+        for anchors, regex, pair in sigs:
+            if not any(a in text for a in anchors):
+                continue
+            if regex is None:
+                return True
+            if pair is None:
+                if regex.search(text):
+                    return True
+            elif self._pair_hit(text, regex, *pair):
+                return True
+        return False
+
+    def match(self, text: str, found: set):
+        """Add to `found` every category matching the lower-cased `text`,
+        skipping categories already in it (for chunk-by-chunk scanning)."""
+        for name, _, sigs in self.categories:
+            if name not in found and self._category_hit(text, sigs):
+                found.add(name)
+
+    def assess(self, surface: str, user_agent: str) -> dict:
+        found = set()
+        self.match(surface.lower(), found)
+        return self.score(found, user_agent)
+
+    def score(self, found: set, user_agent: str) -> dict:
+        hits = []
+        score = 0.0
+        for name, weight, _ in self.categories:
+            if name in found:
+                hits.append(name)
+                score += weight
+
+        ua = (user_agent or "").lower()
+        if any(s in ua for s in self.scanner_ua):
+            hits.append('SCANNER')
+            score += self.scanner_weight
+
+        # Normalize score to 0..1
+        return {
+            'score': min(1.0, score),
+            'hits': hits,
+        }
+
+
+ENGINE = SignatureEngine.from_file(DEFAULT_RULE_PACK)
+
+
+# Streaming body inspection. The body is read in CHUNK_SIZE pieces up to a
+# cap, decoded on the fly and matched chunk by chunk; only the first
+# SURFACE_BODY_CHARS decoded characters are kept for logging and the AI.
+CHUNK_SIZE = 16 * 1024
+MAX_BODY_SCAN = 1024 * 1024
+SURFACE_BODY_CHARS = 4096
+# Text carried over between chunks so signatures split across a chunk
+# boundary still match. Pairs whose opener and closer are further apart
+# than this across a boundary are missed.
+SCAN_OVERLAP = 512
+# Bytes read for inspection are spooled for the view; past this they spill
+# to a temporary file.
+SPOOL_MEMORY = 64 * 1024
+
+
+class _PercentDecoder:
+    """Incremental percent-decoding that holds back an escape split across
+    chunks. With `plus`, '+' is a space (form encoding)."""
+
+    def __init__(self, plus=False):
+        self.plus = plus
+        self._pending = b''
+
+    def feed(self, data: bytes, final=False) -> bytes:
+        data = self._pending + data
+        cut = data.find(b'%', max(len(data) - 2, 0))
+        if cut >= 0 and not final:
+            data, self._pending = data[:cut], data[cut:]
+        else:
+            self._pending = b''
+        if self.plus:
+            data = data.replace(b'+', b' ')
+        return unquote_to_bytes(data)
+
+
+_JSON_ESCAPE_RE = re.compile(rb'\\(?:u([0-9a-fA-F]{4})|(["\\/bfnrt]))')
+_JSON_SIMPLE = {b'"': b'"', b'\\': b'\\', b'/': b'/', b'b': b'\b',
+                b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t'}
+
+
+def _json_unescape(m):
+    if m.group(1):
+        return chr(int(m.group(1), 16)).encode('utf-8', 'surrogatepass')
+    return _JSON_SIMPLE[m.group(2)]
+
+
+class _JsonDecoder:
+    """Incremental JSON string-escape decoding (e.g. \\u003cscript\\u003e),
+    holding back an escape split across chunks."""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data: bytes, final=False) -> bytes:
+        data = self._pending + data
+        cut = data.rfind(b'\\', max(len(data) - 6, 0))
+        if cut >= 0 and not final:
+            data, self._pending = data[:cut], data[cut:]
+        else:
+            self._pending = b''
+        return _JSON_ESCAPE_RE.sub(_json_unescape, data)
+
+
+class _MultipartDecoder:
+    """Incremental multipart/form-data decoding: part headers are reduced to
+    `name=` / `filename=` lines and part contents are passed through. A
+    malformed body is scanned raw from that point on."""
+
+    def __init__(self, boundary: bytes):
+        self._parser = MultipartDecoder(boundary)
+        self._raw = False
+
+    def feed(self, data: bytes, final=False) -> bytes:
+        if self._raw:
+            return data
+        out = []
+        try:
+            self._parser.receive_data(data)
+            if final:
+                self._parser.receive_data(None)
+            while True:
+                event = self._parser.next_event()
+                if event is NEED_DATA or isinstance(event, Epilogue):
+                    break
+                if isinstance(event, File):
+                    out.append(f"\n{event.name}={event.filename}\n".encode())
+                elif isinstance(event, Field):
+                    out.append(f"\n{event.name}=".encode())
+                elif isinstance(event, Data):
+                    out.append(event.data)
+        except ValueError:
+            self._raw = True
+            out.append(bytes(self._parser.buffer))
+        return b''.join(out)
+
+
+def _body_decoders(content_type: str):
+    """Byte decoders for a body of this content type, applied in order.
+    Percent-decoding always runs last, as it did over the whole surface."""
+    mimetype, options = parse_options_header(content_type or '')
+    if mimetype == 'multipart/form-data' and options.get('boundary'):
+        return [_MultipartDecoder(options['boundary'].encode('latin-1')), _PercentDecoder()]
+    if mimetype == 'application/x-www-form-urlencoded':
+        return [_PercentDecoder(plus=True)]
+    if mimetype == 'application/json' or mimetype.endswith('+json'):
+        return [_JsonDecoder(), _PercentDecoder()]
+    return [_PercentDecoder()]
+
+
+class _ChainedStream(io.RawIOBase):
+    """The spooled prefix of the body followed by the unread remainder, so
+    the view sees the request body as if it had never been read."""
+
+    def __init__(self, head, tail):
+        self._streams = [head, tail]
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._streams:
+            n = self._streams[0].readinto(b)
+            if n:
+                return n
+            self._streams.pop(0)
+        return 0
+
+
+class _StreamScan:
+    """Feeds text to a SignatureEngine piece by piece, re-scanning the last
+    SCAN_OVERLAP characters of the previous piece with each new one."""
+
+    def __init__(self, engine: SignatureEngine):
+        self.engine = engine
+        self.found = set()
+        self._tail = ''
+
+    def feed(self, text: str):
+        if not text:
+            return
+        window = self._tail + text.lower()
+        self.engine.match(window, self.found)
+        self._tail = window[-SCAN_OVERLAP:]
+
+
+class RequestScan:
+    """Surface and signature scan of one request, built incrementally: the
+    request line and headers at construction, then the body chunk by chunk
+    through feed(). scan_request drives it from a WSGI request; the ASGI
+    guard from http.request messages."""
+
+    def __init__(self, method: str, path: str, query_string: bytes, remote_addr: str,
+                 user_agent: str, content_type: str = None, engine: SignatureEngine = None,
+                 max_body: int = MAX_BODY_SCAN):
+        self.engine = engine or ENGINE
+        self.user_agent = user_agent
+        self.max_body = max_body
+        self.read = 0
+        self.head = unquote("\n".join([
+            f"method={method}",
+            f"path={path}",
+            f"query={query_string.decode('utf-8', 'ignore')}",
+            f"ip={remote_addr}",
+            f"ua={user_agent}",
+        ]))
+        self._scan = _StreamScan(self.engine)
+        self._scan.feed(self.head)
+        self._content_type = content_type
+        self._decoders = None
+        self._text = None
+        self._kept = []
+        self._kept_chars = 0
+
+    def feed(self, chunk: bytes, final: bool = False) -> bool:
+        """Scan the next piece of the body. Returns True once the body is
+        complete or `max_body` bytes have been scanned; the rest is not
+        inspected."""
+        if self._decoders is None:
+            self._decoders = _body_decoders(self._content_type)
+            self._text = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        chunk = chunk[:max(self.max_body - self.read, 0)]
+        final = final or self.read + len(chunk) >= self.max_body
+        self.read += len(chunk)
+        data = chunk
+        for decoder in self._decoders:
+            data = decoder.feed(data, final)
+        decoded = self._text.decode(data, final)
+        self._scan.feed(decoded)
+        if self._kept_chars < SURFACE_BODY_CHARS:
+            self._kept.append(decoded[:SURFACE_BODY_CHARS - self._kept_chars])
+            self._kept_chars += len(self._kept[-1])
+        return final
+
+    def result(self):
+        """(surface, {'score', 'hits'})"""
+        surface = self.head
+        if self._decoders is not None:
+            body = ''.join(self._kept)
+            if self.read >= self.max_body:
+                body += f"\n(body scan stopped after {self.read} bytes)"
+            surface = f"{surface}\nbody={body}"
+        return surface, self.engine.score(self._scan.found, self.user_agent)
+
+
+def scan_request(request, engine: SignatureEngine = None, max_body: int = MAX_BODY_SCAN,
+                 chunk_size: int = CHUNK_SIZE):
+    """Extract the request surface and score it with `engine` in one pass.
+
+    The body is streamed from `request.stream` in `chunk_size` pieces, up to
+    `max_body` bytes, then put back for the view. Memory use is bounded by
+    the chunk size, the spool and SURFACE_BODY_CHARS regardless of body
+    size. Returns (surface, {'score', 'hits'}).
+    """
+    scan = RequestScan(
+        request.method, request.path, request.query_string, request.remote_addr,
+        request.headers.get('User-Agent', '-'), request.headers.get('Content-Type'),
+        engine, max_body)
+    if request.content_length or request.environ.get('wsgi.input_terminated'):
+        _scan_body(request, scan, chunk_size)
+    return scan.result()
+
+
+def _scan_body(request, scan, chunk_size):
+    stream = request.stream
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
     try:
-        if request.content_length and request.content_length < 4096:
-            body = request.get_data(as_text=True) or ""
-            parts.append(f"body={body}")
-    except Exception:
-        pass
-    return unquote("\n".join(parts))
-
-
-def heuristic_assess(surface: str, user_agent: str) -> dict:
-    score = 0.0
-    hits = []
-
-    for name, regex in CATEGORIES.items():
-        if regex.search(surface):
-            hits.append(name)
-            score += 0.35
-
-    if SCANNER_UA.search(user_agent or ""):
-        hits.append('SCANNER')
-        score += 0.3
-
-    # Normalize score to 0..1
-    score = min(1.0, score)
-    return {
-        'score': score,
-        'hits': hits,
-    }
\ No newline at end of file
+        while scan.read < scan.max_body:
+            chunk = stream.read(min(chunk_size, scan.max_body - scan.read))
+            spool.write(chunk)
+            if scan.feed(chunk, final=not chunk):
+                break
+    except (OSError, ValueError, HTTPException):
+        pass  # a broken upload is the view's to report; scan what we have
+    finally:
+        spool.seek(0)
+        # Replay the inspected bytes to the view, followed by the rest
+        request.environ['wsgi.input'] = _ChainedStream(spool, stream)
+        request.__dict__.pop('stream', None)
+
+
+def extract_surface(request, max_body: int = MAX_BODY_SCAN) -> str:
+    """Extracts string surface from Flask request for heuristic and AI analysis."""
+    return scan_request(request, max_body=max_body)[0]
+
+
+def heuristic_assess(surface: str, user_agent: str, engine: SignatureEngine = None) -> dict:
+    return (engine or ENGINE).assess(surface, user_agent)
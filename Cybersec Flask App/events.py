@@ -0,0 +1,67 @@
+import json
+import threading
+from collections import deque
+
+
+class EventBus:
+    """In-memory pub/sub ring buffer for the dashboard's live stream.
+
+    `publish` appends an event with a monotonically increasing id and wakes
+    any subscribers; the last `size` events are kept so a reconnecting
+    client can resume from its Last-Event-ID. Events are per process: with
+    several workers each dashboard connection sees its own worker's events.
+    """
+
+    def __init__(self, size: int = 1000):
+        self._events = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._last_id = 0
+        self.published = 0
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, kind: str, data: dict) -> int:
+        payload = json.dumps(data, default=str)
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, kind, payload))
+            self.published += 1
+            self._cond.notify_all()
+            return self._last_id
+
+    def since(self, last_id: int):
+        """Events newer than `last_id`, or None if some of them have already
+        been overwritten (the client must reload instead of resuming)."""
+        with self._cond:
+            return self._since(last_id)
+
+    def wait(self, last_id: int, timeout: float):
+        """Like `since`, but block up to `timeout` seconds for a new event.
+        Returns an empty list on timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            return self._since(last_id)
+
+    def _since(self, last_id):
+        if last_id > self._last_id:  # id from before a restart
+            return None
+        if last_id == self._last_id:
+            return []
+        if not self._events or self._events[0][0] > last_id + 1:
+            return None
+        # ids are contiguous, so the first new event sits at a known offset
+        start = last_id + 1 - self._events[0][0]
+        return [self._events[i] for i in range(start, len(self._events))]
+
+    def stats(self) -> dict:
+        return {
+            'buffered': len(self._events),
+            'last_id': self._last_id,
+            'published': self.published,
+        }
+
+
+def format_sse(event_id: int, kind: str, payload: str) -> str:
+    return f"id: {event_id}\nevent: {kind}\ndata: {payload}\n\n"
@@ -1,6 +1,16 @@
+import hashlib
+import ipaddress
 import json
+import re
 from datetime import datetime
-from openai import OpenAI
+from typing import Optional
+
+from openai import AsyncOpenAI, OpenAI
+
+from breaker import CircuitBreaker, remaining
+from cache import TTLCache
+from shared_state import SqliteScriptStore
+from singleflight import AsyncSingleFlight, SingleFlight
 
 TEMPLATE_BASELINE = """#!/usr/bin/env bash
 # Generated at {ts}
@@ -16,31 +26,177 @@ iptables -I INPUT -s "$IP" -j DROP
 
 # Example NGINX snippet to drop obvious malicious payloads
 cat > /etc/nginx/conf.d/ai-guard-snippet.conf <<'NGINX'
-map $request_uri $ai_guard_block {
+map $request_uri $ai_guard_block {{
   default 0;
-  ~*(<script>|select\s+.*from|\.{2}/|/etc/passwd) 1;
-}
-server {
-  if ($ai_guard_block) { return 403; }
-}
+  ~*(<script>|select\s+.*from|\.{{2}}/|/etc/passwd) 1;
+}}
+server {{
+  if ($ai_guard_block) {{ return 403; }}
+}}
 NGINX
 
 systemctl reload nginx 2>/dev/null || true
 """
 
+# Stands in for the attacker address in cached script templates
+IP_PLACEHOLDER = "{{IP}}"
+_PATH_ID_RE = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{16,}|\d+", re.I)
+
+
+def incident_signature(incident: dict) -> str:
+    """Content address for incidents that warrant the same mitigation:
+    heuristic hits, AI categories, method and the path with ids collapsed.
+    The client address and user agent are left out."""
+    ai = incident.get('ai') or {}
+    canonical = json.dumps([
+        sorted(set(incident.get('heuristic_hits') or [])),
+        sorted(set(ai.get('categories') or [])),
+        incident.get('method'),
+        _PATH_ID_RE.sub('0', incident.get('path') or ''),
+    ], separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _is_address(ip: str) -> bool:
+    try:
+        ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return True
+
+
+class ScriptCache:
+    """Mitigation script templates by incident signature: an LRU/TTL
+    memory cache, optionally backed by a SqliteScriptStore at `path` so
+    templates survive restarts and are shared between workers."""
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 86400.0, path: str = ''):
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize, ttl)
+        self.store = SqliteScriptStore(path) if path else None
+        self.disk_hits = 0
+
+    def get(self, signature: str) -> Optional[str]:
+        template = self.memory.get(signature)
+        if template is None and self.store is not None:
+            template = self.store.get(signature, self.ttl)
+            if template is not None:
+                self.disk_hits += 1
+                self.memory.set(signature, template)
+        return template
+
+    def set(self, signature: str, template: str):
+        self.memory.set(signature, template)
+        if self.store is not None:
+            self.store.put(signature, template, self.ttl)
+
+    def stats(self) -> dict:
+        mem = self.memory.stats()
+        lookups = mem['hits'] + mem['misses']
+        hits = mem['hits'] + self.disk_hits
+        return {
+            'size': mem['size'],
+            'hits': mem['hits'],
+            'disk_hits': self.disk_hits,
+            'misses': mem['misses'] - self.disk_hits,
+            'evictions': mem['evictions'],
+            'hit_rate': hits / lookups if lookups else 0.0,
+        }
+
+
 class MitigationGenerator:
-    def __init__(self, api_key: str, model: str):
-        self.client = OpenAI(api_key=api_key) if api_key else None
+    def __init__(self, api_key: str, model: str, base_url: str = None,
+                 breaker: CircuitBreaker = None, call_timeout: float = 20.0,
+                 cache: ScriptCache = None, singleflight: SingleFlight = None):
+        self.client = OpenAI(api_key=api_key, base_url=base_url or None) if api_key else None
+        # For generate_async; created on first use, inside the serving loop
+        self._async_args = {'api_key': api_key, 'base_url': base_url or None}
+        self._async_client = None
         self.model = model
+        self.breaker = breaker
+        self.call_timeout = call_timeout
+        self.cache = cache
+        self.singleflight = singleflight
+        self.async_singleflight = AsyncSingleFlight() if singleflight is not None else None
 
-    def generate(self, incident: dict) -> str:
+    def generate(self, incident: dict, deadline: float = None) -> str:
         """Ask AI to produce a short shell script + config hints tailored to the incident.
-        Falls back to a baseline template if AI is unavailable.
+        Falls back to a baseline template if AI is unavailable, the circuit
+        breaker is open or the latency budget (`deadline`) is spent.
+
+        With a cache, the AI writes a template using IP_PLACEHOLDER, stored
+        under the incident signature; later incidents with that signature
+        are rendered from it without an AI call. Fallback scripts are not
+        cached, and incidents without a valid client address bypass the
+        cache. With single-flight, concurrent misses for one signature
+        share one AI call.
         """
+        script, call = self._prepare(incident, deadline)
+        if call is None:
+            return script
+        ip, key, timeout, args = call
+        if key is None or self.singleflight is None:
+            script = self._request(ip, key, timeout, args)
+        else:
+            try:
+                script = self.singleflight.do(key, lambda: self._request(ip, key, timeout, args), timeout)
+            except TimeoutError:
+                script = None
+        return self._render(script, ip)
+
+    async def generate_async(self, incident: dict, deadline: float = None) -> str:
+        """generate() for asyncio callers, over AsyncOpenAI."""
+        script, call = self._prepare(incident, deadline)
+        if call is None:
+            return script
+        ip, key, timeout, args = call
+        if key is None or self.async_singleflight is None:
+            script = await self._request_async(ip, key, timeout, args)
+        else:
+            try:
+                script = await self.async_singleflight.do(
+                    key, lambda: self._request_async(ip, key, timeout, args), timeout)
+            except Exception:
+                # Timed out, or the leader was cancelled with its client
+                script = None
+        return self._render(script, ip)
+
+    def _request(self, ip, key, timeout, args) -> Optional[str]:
+        try:
+            resp = self.client.with_options(timeout=timeout, max_retries=0).chat.completions.create(**args)
+        except Exception:
+            self._failed()
+            return None
+        return self._finish(ip, key, resp)
+
+    async def _request_async(self, ip, key, timeout, args) -> Optional[str]:
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(**self._async_args)
+        try:
+            resp = await self._async_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(**args)
+        except Exception:
+            self._failed()
+            return None
+        return self._finish(ip, key, resp)
+
+    def _prepare(self, incident: dict, deadline: float = None):
+        """(script, None) when no AI call is needed, else (None, (ip, cache
+        key, timeout, completion args))."""
         ip = incident.get('ip', '0.0.0.0')
         ts = datetime.utcnow().isoformat()
         if not self.client:
-            return TEMPLATE_BASELINE.format(ip=ip, ts=ts)
+            return TEMPLATE_BASELINE.format(ip=ip, ts=ts), None
+        key = None
+        if self.cache is not None and _is_address(ip):
+            key = incident_signature(incident)
+            template = self.cache.get(key)
+            if template is not None:
+                return template.replace(IP_PLACEHOLDER, ip), None
+            incident = dict(incident, ip=IP_PLACEHOLDER)
+        timeout = remaining(self.call_timeout, deadline)
+        if timeout <= 0 or (self.breaker and not self.breaker.allow()):
+            return TEMPLATE_BASELINE.format(ip=ip, ts=ts), None
 
         prompt = (
             "You are a defensive security assistant. Generate a short bash script (with comments) "
@@ -49,16 +205,37 @@ class MitigationGenerator:
             "Keep it under ~80 lines. Include inline comments and reminders to review and roll back.\n\n"
             f"Incident (JSON):\n{json.dumps(incident, ensure_ascii=False, indent=2)}"
         )
+        if key is not None:
+            prompt += f"\n\nWrite the attacker address exactly as {IP_PLACEHOLDER}; the script is a reusable template."
+        args = {
+            'model': self.model,
+            'messages': [
+                {"role": "system", "content": "You help defenders mitigate web attacks safely."},
+                {"role": "user", "content": prompt},
+            ],
+            'temperature': 0.2,
+        }
+        return None, (ip, key, timeout, args)
 
-        try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You help defenders mitigate web attacks safely."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.2,
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception:
-            return TEMPLATE_BASELINE.format(ip=ip, ts=ts)
\ No newline at end of file
+    def _failed(self):
+        if self.breaker:
+            self.breaker.record_failure()
+
+    def _finish(self, ip: str, key: str, resp) -> str:
+        """The AI's script; with a cache key, as the template it caches."""
+        if self.breaker:
+            self.breaker.record_success()
+        script = resp.choices[0].message.content.strip()
+        if key is None:
+            return script
+        # In case the model spelled out the address anyway
+        template = re.sub(rf"(?<![\w.:]){re.escape(ip)}(?![\w.:])", IP_PLACEHOLDER, script)
+        self.cache.set(key, template)
+        return template
+
+    @staticmethod
+    def _render(script: Optional[str], ip: str) -> str:
+        """`script` for `ip`, or the baseline template if the AI failed."""
+        if script is None:
+            return TEMPLATE_BASELINE.format(ip=ip, ts=datetime.utcnow().isoformat())
+        return script.replace(IP_PLACEHOLDER, ip)
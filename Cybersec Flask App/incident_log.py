@@ -0,0 +1,245 @@
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+INCIDENT_COLUMNS = (
+    'ts', 'ip', 'path', 'method', 'user_agent', 'surface',
+    'heuristic_score', 'heuristic_hits', 'ai_verdict', 'ai_confidence',
+    'ai_categories', 'ai_explanation', 'action', 'mitigation_script', 'ref',
+)
+INCIDENT_UPDATABLE = ('ai_verdict', 'ai_confidence', 'ai_categories', 'ai_explanation',
+                      'action', 'mitigation_script')
+
+INSERT_SQL = (
+    f"INSERT INTO incidents ({', '.join(INCIDENT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(INCIDENT_COLUMNS))})"
+)
+
+# Rollups are maintained in the same transaction as the incidents they
+# count, so dashboard aggregates never need to scan the incidents table.
+ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rollup_ip (
+        ip TEXT PRIMARY KEY,
+        incidents INTEGER NOT NULL,
+        blocked INTEGER NOT NULL,
+        last_ts TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_rollup_ip_incidents ON rollup_ip(incidents);
+    CREATE TABLE IF NOT EXISTS rollup_category (
+        category TEXT PRIMARY KEY,
+        incidents INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS rollup_minute (
+        minute TEXT PRIMARY KEY,
+        incidents INTEGER NOT NULL,
+        blocked INTEGER NOT NULL
+    );
+"""
+
+_COL = {name: i for i, name in enumerate(INCIDENT_COLUMNS)}
+
+_STOP = object()
+
+
+def _split(csv):
+    return {c for c in (csv or '').split(',') if c}
+
+
+def _bump(db, per_ip, per_minute, categories):
+    db.executemany(
+        """INSERT INTO rollup_ip (ip, incidents, blocked, last_ts) VALUES (?, ?, ?, ?)
+           ON CONFLICT(ip) DO UPDATE SET
+               incidents = incidents + excluded.incidents,
+               blocked = blocked + excluded.blocked,
+               last_ts = max(coalesce(last_ts, ''), coalesce(excluded.last_ts, ''))""",
+        [(ip, n, b, ts) for ip, (n, b, ts) in per_ip.items()])
+    db.executemany(
+        """INSERT INTO rollup_minute (minute, incidents, blocked) VALUES (?, ?, ?)
+           ON CONFLICT(minute) DO UPDATE SET
+               incidents = incidents + excluded.incidents,
+               blocked = blocked + excluded.blocked""",
+        [(m, n, b) for m, (n, b) in per_minute.items()])
+    db.executemany(
+        """INSERT INTO rollup_category (category, incidents) VALUES (?, ?)
+           ON CONFLICT(category) DO UPDATE SET incidents = incidents + excluded.incidents""",
+        list(categories.items()))
+
+
+def apply_rollups(db, rows):
+    """Count inserted incident rows (tuples in INCIDENT_COLUMNS order) into
+    the per-IP, per-minute and per-category rollups."""
+    per_ip, per_minute, categories = {}, {}, Counter()
+    for row in rows:
+        ts, ip = row[_COL['ts']], row[_COL['ip']]
+        blocked = int(row[_COL['action']] == 'blocked')
+        n, b, last = per_ip.get(ip, (0, 0, ts))
+        per_ip[ip] = (n + 1, b + blocked, max(last, ts))
+        n, b = per_minute.get(ts[:16], (0, 0))
+        per_minute[ts[:16]] = (n + 1, b + blocked)
+        categories.update(_split(row[_COL['heuristic_hits']]) | _split(row[_COL['ai_categories']]))
+    _bump(db, per_ip, per_minute, categories)
+
+
+def rebuild_rollups(db, chunk: int = 10_000):
+    """Recompute all rollups from the incidents table (one-off backfill)."""
+    db.execute("DELETE FROM rollup_ip")
+    db.execute("DELETE FROM rollup_minute")
+    db.execute("DELETE FROM rollup_category")
+    last_id = 0
+    while True:
+        batch = db.execute(
+            f"SELECT id, {', '.join(INCIDENT_COLUMNS)} FROM incidents WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, chunk)).fetchall()
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        apply_rollups(db, [tuple(r[1:]) for r in batch])
+
+
+class IncidentWriter:
+    """Write-behind queue for the incidents table.
+
+    Request threads only enqueue; a dedicated writer thread drains the queue
+    and commits whatever arrived within `flush_interval` seconds (at most
+    `batch_size` operations) as one WAL transaction, with runs of inserts
+    sent through executemany. Inserts and updates are applied in submission
+    order, so an update never overtakes the insert it refers to.
+
+    When the queue is full, inserts are dropped (`overflow='drop'`) or, with
+    `overflow='sample'`, one in every `1 / sample_rate` is kept once the
+    queue is three quarters full and the rest are dropped; `dropped` and
+    `sampled_out` count them. Updates wait for room instead. Pending rows
+    are flushed on interpreter exit.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.005,
+                 max_queue: int = 50_000, overflow: str = 'drop', sample_rate: float = 0.1):
+        if overflow not in ('drop', 'sample'):
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.sample_every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._queue = queue.Queue(max_queue)
+        self._high_water = max_queue * 3 // 4
+        self._offered = 0
+        self._thread = threading.Thread(target=self._run, name='incident-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def insert(self, row: tuple):
+        if self.overflow == 'sample' and self._queue.qsize() >= self._high_water:
+            self._offered += 1
+            if not self.sample_every or self._offered % self.sample_every:
+                self.sampled_out += 1
+                return
+        try:
+            self._queue.put_nowait(('insert', row))
+        except queue.Full:
+            self.dropped += 1
+
+    def update(self, ref: str, fields: dict):
+        fields = {c: fields[c] for c in INCIDENT_UPDATABLE if c in fields}
+        if fields:
+            self._queue.put(('update', (ref, fields)))
+
+    def flush(self):
+        """Block until everything submitted so far is committed."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+        }
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _run(self):
+        db = self._connect()
+        stopping = False
+        while not stopping:
+            ops = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(ops) < self.batch_size and ops[-1] is not _STOP:
+                timeout = deadline - time.monotonic()
+                try:
+                    ops.append(self._queue.get(timeout=timeout) if timeout > 0
+                               else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if ops[-1] is _STOP:
+                stopping = True
+                ops.pop()
+            try:
+                self._write(db, ops)
+            except Exception:
+                log.exception("Dropping %d incident operations after write failure", len(ops))
+            finally:
+                for _ in range(len(ops) + stopping):
+                    self._queue.task_done()
+        db.close()
+
+    def _write(self, db, ops):
+        if not ops:
+            return
+        with db:
+            rows = []
+            for kind, payload in ops:
+                if kind == 'insert':
+                    rows.append(payload)
+                    continue
+                self._insert(db, rows)
+                rows = []
+                self._update(db, *payload)
+            self._insert(db, rows)
+        self.batches += 1
+
+    def _insert(self, db, rows):
+        if rows:
+            db.executemany(INSERT_SQL, rows)
+            apply_rollups(db, rows)
+            self.written += len(rows)
+
+    def _update(self, db, ref, fields):
+        old = None
+        if 'action' in fields or 'ai_categories' in fields:
+            old = db.execute(
+                "SELECT ts, ip, action, heuristic_hits, ai_categories FROM incidents WHERE ref = ?",
+                (ref,)).fetchone()
+        cols = list(fields)
+        db.execute(f"UPDATE incidents SET {', '.join(c + ' = ?' for c in cols)} WHERE ref = ?",
+                   [fields[c] for c in cols] + [ref])
+        if old is None:
+            return
+        ts, ip, action, hits, ai_categories = old
+        blocked = int(fields.get('action', action) == 'blocked' and action != 'blocked')
+        new_categories = _split(fields.get('ai_categories')) - _split(hits) - _split(ai_categories)
+        if blocked or new_categories:
+            _bump(db,
+                  {ip: (0, blocked, ts)} if blocked else {},
+                  {ts[:16]: (0, blocked)} if blocked else {},
+                  Counter(new_categories))
@@ -0,0 +1,240 @@
+"""Local second-stage classifier: hashed character n-grams of the request
+surface fed to a logistic regression, trained offline from the verdicts
+AIGuard has already written to incidents.db and its archive days.
+
+The guard asks the model first and only escalates to AIGuard when the
+model's probability falls inside an uncertainty band, so the LLM sees just
+the requests the model cannot call on its own.
+
+    python local_model.py train --db incidents.db --out models/local_model.npz
+    python local_model.py eval --db incidents.db --model models/local_model.npz
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+
+from retention import IncidentArchive
+
+BITS = 18
+NGRAMS = (3, 5)
+MAX_BYTES = 4096
+PRIME = np.uint32(16777619)
+GOLDEN = np.uint32(2654435761)
+# The client address is not request content; leaving it in would let the
+# model memorize attacker IPs instead of payloads.
+IP_LINE_RE = re.compile(r'^ip=.*$', re.MULTILINE)
+
+
+def featurize(surface: str, bits: int = BITS, ngrams=NGRAMS) -> np.ndarray:
+    """Hash indices of every character n-gram (n in `ngrams`, inclusive) of
+    the lower-cased surface. Repeated n-grams repeat their index, so summing
+    weights over the array gives a term-frequency dot product.
+
+    This is the only truncation (MAX_BYTES) applied to surfaces, at
+    training and at serving time alike, so callers must pass the whole
+    surface as it is stored in the incidents table."""
+    data = IP_LINE_RE.sub('', surface.lower()).encode('utf-8', 'ignore')[:MAX_BYTES]
+    b = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    lo, hi = ngrams
+    if len(b) < lo:
+        return np.zeros(0, dtype=np.int64)
+    # Rolling polynomial hash: h_n[i] covers b[i:i+n]; uint32 wraps on overflow
+    h, out = b, []
+    for n in range(2, hi + 1):
+        h = h[:len(b) - n + 1] * PRIME + b[n - 1:]
+        if n >= lo:
+            out.append(h * GOLDEN >> np.uint32(32 - bits))
+    return np.concatenate(out).astype(np.int64)
+
+
+class LocalModel:
+    """Logistic regression over hashed n-gram counts, normalized by the
+    square root of the n-gram count so long and short requests score on
+    the same scale."""
+
+    def __init__(self, weights: np.ndarray, bias: float, bits: int = BITS, ngrams=NGRAMS, meta: dict = None):
+        self.weights = weights
+        self.bias = float(bias)
+        self.bits = bits
+        self.ngrams = tuple(ngrams)
+        self.meta = meta or {}
+
+    def predict(self, surface: str) -> float:
+        """Probability that the request would be blocked by AIGuard."""
+        idx = featurize(surface, self.bits, self.ngrams)
+        if not len(idx):
+            z = self.bias
+        else:
+            z = float(self.weights[idx].sum()) / np.sqrt(len(idx)) + self.bias
+        return 1.0 / (1.0 + np.exp(-z))
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path, weights=self.weights.astype(np.float32), bias=self.bias,
+            bits=self.bits, ngrams=np.array(self.ngrams), meta=json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, path: str) -> 'LocalModel':
+        with np.load(path) as f:
+            return cls(f['weights'], float(f['bias']), int(f['bits']),
+                       tuple(int(n) for n in f['ngrams']), json.loads(str(f['meta'])))
+
+    @classmethod
+    def train(cls, surfaces, labels, bits: int = BITS, ngrams=NGRAMS,
+              epochs: int = 200, lr: float = 0.5, l2: float = 1e-5) -> 'LocalModel':
+        """Full-batch Adagrad on class-balanced log loss."""
+        feats = [featurize(s, bits, ngrams) for s in surfaces]
+        lengths = np.array([max(len(f), 1) for f in feats])
+        idx = np.concatenate(feats) if feats else np.zeros(0, dtype=np.int64)
+        row = np.repeat(np.arange(len(feats)), [len(f) for f in feats])
+        norm = 1.0 / np.sqrt(lengths)
+        y = np.asarray(labels, dtype=np.float64)
+        pos = max(y.sum(), 1.0)
+        neg = max(len(y) - y.sum(), 1.0)
+        sample_w = np.where(y == 1, len(y) / (2 * pos), len(y) / (2 * neg)) / len(y)
+
+        dim = 1 << bits
+        w = np.zeros(dim)
+        b = 0.0
+        gw_sq = np.full(dim, 1e-8)
+        gb_sq = 1e-8
+        for _ in range(epochs):
+            z = np.bincount(row, weights=w[idx], minlength=len(feats)) * norm + b
+            p = 1.0 / (1.0 + np.exp(-z))
+            err = (p - y) * sample_w
+            gw = np.bincount(idx, weights=(err * norm)[row], minlength=dim) + l2 * w
+            gb = err.sum()
+            gw_sq += gw * gw
+            gb_sq += gb * gb
+            w -= lr * gw / np.sqrt(gw_sq)
+            b -= lr * gb / np.sqrt(gb_sq)
+        meta = {'rows': len(y), 'positives': int(y.sum()), 'trained_at': time.time()}
+        return cls(w, b, bits, ngrams, meta)
+
+
+class LocalGuard:
+    """Decides from the local model when it is confident, and tells the
+    caller to escalate to AIGuard when its probability is in [low, high]."""
+
+    def __init__(self, model: LocalModel, low: float = 0.1, high: float = 0.9):
+        if not 0.0 <= low <= high <= 1.0:
+            raise ValueError("local model band must satisfy 0 <= low <= high <= 1")
+        self.model = model
+        self.low = low
+        self.high = high
+        self.decided = 0
+        self.escalated = 0
+
+    def classify(self, surface: str, categories=()):
+        """An AIGuard-shaped verdict, or None when the request should be
+        escalated. The model has no categories of its own; the caller may
+        pass the heuristic hits."""
+        p = self.model.predict(surface)
+        if self.low < p < self.high:
+            self.escalated += 1
+            return None
+        self.decided += 1
+        malicious = p >= self.high
+        return {
+            'verdict': 'MALICIOUS' if malicious else 'BENIGN',
+            'confidence': round(p if malicious else 1.0 - p, 4),
+            'categories': list(categories) if malicious else [],
+            'explanation': f'Local model (p={p:.2f}).',
+        }
+
+    def stats(self) -> dict:
+        total = self.decided + self.escalated
+        return {
+            'decided': self.decided,
+            'escalated': self.escalated,
+            'escalation_rate': self.escalated / total if total else 0.0,
+        }
+
+
+# Definitive AI verdicts only: the model must not learn from its own calls
+EXAMPLE_WHERE = ("ai_verdict IN ('MALICIOUS', 'BENIGN') "
+                 "AND COALESCE(ai_explanation, '') NOT LIKE 'Local model%'")
+
+
+def load_examples(db_path: str, min_confidence: float = 0.65, archive_dir: str = None):
+    """(surface, label) pairs from incidents with a definitive AI verdict,
+    from the hot table and every archive day (the compactor moves rows out
+    of the hot table after INCIDENT_HOT_HOURS). The label is whether
+    AIGuard.should_block would have fired. `archive_dir` defaults to
+    archive/ next to the database, as in app.py; pass '' to skip it."""
+    columns = ('surface', 'ai_verdict', 'ai_confidence')
+    db = sqlite3.connect(db_path)
+    rows = db.execute(f"SELECT {', '.join(columns)} FROM incidents WHERE {EXAMPLE_WHERE}").fetchall()
+    db.close()
+    if archive_dir is None:
+        archive_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive')
+    if archive_dir and os.path.isdir(archive_dir):
+        rows += IncidentArchive(archive_dir).scan(columns, EXAMPLE_WHERE)
+    # Placeholder surfaces such as "(pending)" carry no request content
+    return [(s, int(v == 'MALICIOUS' and (c or 0.0) >= min_confidence))
+            for s, v, c in rows if s and not s.startswith('(')]
+
+
+def evaluate(guard: LocalGuard, examples) -> dict:
+    agree = decided = 0
+    t0 = time.perf_counter()
+    for surface, label in examples:
+        verdict = guard.classify(surface)
+        if verdict is not None:
+            decided += 1
+            agree += int((verdict['verdict'] == 'MALICIOUS') == bool(label))
+    elapsed = time.perf_counter() - t0
+    n = len(examples)
+    return {
+        'examples': n,
+        'decided_locally': decided,
+        'escalation_rate': round(1 - decided / n, 4) if n else 0.0,
+        'agreement_when_decided': round(agree / decided, 4) if decided else None,
+        'us_per_request': round(elapsed / n * 1e6, 1) if n else None,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    tr = sub.add_parser('train', help='train from incidents.db')
+    tr.add_argument('--db', default='incidents.db')
+    tr.add_argument('--out', required=True)
+    tr.add_argument('--epochs', type=int, default=200)
+    tr.add_argument('--holdout', type=float, default=0.2, help='fraction held out for evaluation')
+    ev = sub.add_parser('eval', help='evaluate a saved model against incidents.db')
+    ev.add_argument('--db', default='incidents.db')
+    ev.add_argument('--model', required=True)
+    for p in (tr, ev):
+        p.add_argument('--archive-dir', help="default: archive/ next to the database; '' for none")
+        p.add_argument('--min-confidence', type=float, default=0.65)
+        p.add_argument('--low', type=float, default=0.1)
+        p.add_argument('--high', type=float, default=0.9)
+    args = ap.parse_args()
+
+    examples = load_examples(args.db, args.min_confidence, args.archive_dir)
+    if args.cmd == 'train':
+        if not examples:
+            raise SystemExit(f"no incidents with a MALICIOUS/BENIGN verdict in {args.db}")
+        rng = np.random.default_rng(0)
+        order = rng.permutation(len(examples))
+        cut = int(len(examples) * (1 - args.holdout)) if len(examples) > 10 else len(examples)
+        train = [examples[i] for i in order[:cut]]
+        held = [examples[i] for i in order[cut:]]
+        model = LocalModel.train([s for s, _ in train], [y for _, y in train], epochs=args.epochs)
+        model.save(args.out)
+        report = {'trained_on': len(train), 'positives': model.meta['positives']}
+        if held:
+            report['holdout'] = evaluate(LocalGuard(model, args.low, args.high), held)
+    else:
+        report = evaluate(LocalGuard(LocalModel.load(args.model), args.low, args.high), examples)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
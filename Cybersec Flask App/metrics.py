@@ -0,0 +1,223 @@
+"""Lightweight instrumentation for the guard: counters, latency histograms
+and gauges rendered in the Prometheus text format.
+
+Every counter and histogram bucket is an itertools.count, whose next() is a
+single C call under the GIL, so request threads record without taking any
+lock and without losing updates. Recording a latency costs one
+perf_counter_ns(), an int.bit_length() and one next().
+"""
+import itertools
+import math
+import re
+import time
+
+# Log-linear ("HDR-style") buckets: values below 2**SUB_BITS nanoseconds get
+# a bucket each, above that every power of two is split into 2**SUB_BITS
+# equal buckets, for a relative error under 1/2**SUB_BITS (12.5%).
+SUB_BITS = 3
+SUB = 1 << SUB_BITS
+MAX_BITS = 40  # ~18 minutes in ns; anything slower lands in the last bucket
+N_BUCKETS = (MAX_BITS - SUB_BITS) * SUB + SUB
+assert (SUB_BITS, MAX_BITS) == (3, 40), "Histogram.since hard-codes these"
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+_COUNT_REPR = re.compile(r"count\((\d+)\)")
+
+
+def _count():
+    """A counter cell. Always start=0, step=1: _value() reads the position
+    back from repr(), which only has the bare "count(N)" form then."""
+    return itertools.count(0, 1)
+
+
+def _value(counter) -> int:
+    # repr() is the only public view of an itertools.count's position; the
+    # pickling hooks are gone as of Python 3.14
+    m = _COUNT_REPR.fullmatch(repr(counter))
+    if m is None:
+        raise ValueError(f"unexpected itertools.count repr: {counter!r}")
+    return int(m.group(1))
+
+
+assert _value(_count()) == 0
+
+
+def bucket_index(ns: int) -> int:
+    bits = ns.bit_length()
+    if bits <= SUB_BITS + 1:
+        return ns
+    if bits > MAX_BITS:
+        return N_BUCKETS - 1
+    return (bits - SUB_BITS) * SUB + ((ns >> (bits - SUB_BITS - 1)) & (SUB - 1))
+
+
+def bucket_bounds(index: int):
+    """[low, high) in nanoseconds covered by a bucket."""
+    if index < 2 * SUB:
+        return index, index + 1
+    bits, sub = divmod(index, SUB)
+    shift = bits - 1
+    return (SUB + sub) << shift, (SUB + sub + 1) << shift
+
+
+class Histogram:
+    """Latency histogram over log-linear nanosecond buckets."""
+
+    __slots__ = ('name', 'help', '_buckets')
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._buckets = [_count() for _ in range(N_BUCKETS)]
+
+    def observe_ns(self, ns: int):
+        next(self._buckets[bucket_index(ns)])
+
+    def since(self, start_ns: int, _clock=time.perf_counter_ns) -> int:
+        """Record the time since `start_ns` and return the current time, so
+        consecutive stages can be timed with one clock read each."""
+        now = _clock()
+        ns = now - start_ns
+        bits = ns.bit_length()
+        # bucket_index() inlined with SUB_BITS=3 and MAX_BITS=40 spelled out:
+        # this runs several times per request
+        if bits <= 4:
+            next(self._buckets[ns])
+        elif bits <= 40:
+            next(self._buckets[(bits << 3) - 24 + ((ns >> (bits - 4)) & 7)])
+        else:
+            next(self._buckets[-1])
+        return now
+
+    def snapshot(self):
+        return [_value(c) for c in self._buckets]
+
+
+def quantile(counts, q: float) -> float:
+    """Approximate `q` quantile in seconds (bucket midpoint)."""
+    total = sum(counts)
+    if not total:
+        return math.nan
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= rank and n:
+            low, high = bucket_bounds(i)
+            return (low + high) / 2e9
+    return math.nan
+
+
+class Counter:
+    """Monotonic counter, optionally split by one label."""
+
+    __slots__ = ('name', 'help', 'label', '_values')
+
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+
+    def inc(self, value: str = ''):
+        c = self._values.get(value)
+        if c is None:
+            c = self._values.setdefault(value, _count())
+        next(c)
+
+
+class Metrics:
+    """Registry of counters, histograms and gauge callbacks.
+
+    Gauges are read only when /metrics is scraped: `fn` returns a number or
+    a dict of numbers (e.g. a component's stats()); string values become a
+    `value` label set to 1, which is how breaker states are exported.
+    """
+
+    def __init__(self, namespace: str = 'aiguard'):
+        self.namespace = namespace
+        self._histograms = []
+        self._counters = []
+        self._gauges = []
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        h = Histogram(f"{self.namespace}_{name}", help)
+        self._histograms.append(h)
+        return h
+
+    def counter(self, name: str, help: str, label: str = None) -> Counter:
+        c = Counter(f"{self.namespace}_{name}", help, label)
+        self._counters.append(c)
+        return c
+
+    def gauge(self, name: str, fn, help: str = ''):
+        self._gauges.append((f"{self.namespace}_{name}", fn, help))
+
+    def render(self) -> str:
+        out = []
+        for c in self._counters:
+            out.append(f"# HELP {c.name} {c.help}\n# TYPE {c.name} counter")
+            for value, n in sorted(c._values.items()):
+                labels = f'{{{c.label}="{_escape(value)}"}}' if c.label else ''
+                out.append(f"{c.name}{labels} {_value(n)}")
+        for h in self._histograms:
+            out.extend(_render_histogram(h))
+        for name, fn, help in self._gauges:
+            out.extend(_render_gauge(name, fn, help))
+        return "\n".join(out) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _render_histogram(h: Histogram):
+    counts = h.snapshot()
+    total = sum(counts)
+    # Exported at power-of-two boundaries from 1us, which coincide with
+    # internal bucket edges, so the cumulative counts are exact.
+    lines = [f"# HELP {h.name} {h.help}", f"# TYPE {h.name} histogram"]
+    cumulative = 0
+    i = 0
+    edge = 1024
+    while edge < (1 << MAX_BITS):
+        while i < N_BUCKETS - 1 and bucket_bounds(i)[1] <= edge:
+            cumulative += counts[i]
+            i += 1
+        lines.append(f'{h.name}_bucket{{le="{edge / 1e9:.9g}"}} {cumulative}')
+        edge <<= 1
+    lines.append(f'{h.name}_bucket{{le="+Inf"}} {total}')
+    # Sum from bucket midpoints; within the bucket error of the true sum
+    approx = sum(n * sum(bucket_bounds(i)) / 2 for i, n in enumerate(counts) if n)
+    lines.append(f"{h.name}_sum {approx / 1e9:.9g}")
+    lines.append(f"{h.name}_count {total}")
+    if total:
+        name = f"{h.name}_quantile"
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f'{name}{{quantile="{q}"}} {quantile(counts, q):.9g}' for q in QUANTILES)
+    return lines
+
+
+def _render_gauge(name, fn, help):
+    try:
+        value = fn()
+    except Exception as e:  # a broken gauge must not break the scrape
+        return [f"# {name}: {type(e).__name__}"]
+    lines = []
+    items = value.items() if isinstance(value, dict) else [(None, value)]
+    for key, v in items:
+        series = f"{name}_{key}" if key else name
+        if isinstance(v, bool):
+            v = int(v)
+        if isinstance(v, (int, float)):
+            sample = f"{series} {v}"
+        elif isinstance(v, str):
+            sample = f'{series}{{value="{_escape(v)}"}} 1'
+        else:
+            continue
+        if help:
+            lines.append(f"# HELP {series} {help}")
+        lines.extend((f"# TYPE {series} gauge", sample))
+    return lines
@@ -0,0 +1,71 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class AIPipeline:
+    """Bounded background executor for AI classification and mitigation
+    generation, so request threads never wait on the LLM.
+
+    At most `max_pending` jobs may be queued or running. `submit` never
+    blocks: when the pipeline is saturated it returns False and the caller
+    keeps its heuristic-only decision (backpressure instead of an unbounded
+    queue).
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 256):
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='ai-pipeline')
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+            self._pending += 1
+        try:
+            self._executor.submit(self._run, fn, args, kwargs)
+        except RuntimeError:  # executor shut down
+            self._release()
+            return False
+        return True
+
+    def _run(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            log.exception("AI pipeline job failed")
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> dict:
+        return {
+            'pending': self._pending,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
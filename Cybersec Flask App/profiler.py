@@ -0,0 +1,225 @@
+"""Per-IP behavior profiles built from fixed-size streaming sketches.
+
+Each request updates, for the client address (and, if enabled, for its
+IPv4 /24):
+
+- a HyperLogLog of distinct request paths (64 one-byte registers)
+- a Count-Min sketch of response status codes (2 x 16 counters)
+- an exponentially weighted request rate
+
+and gets back a behavior score that catches what single-request
+signatures cannot: path enumeration below the rate limit (optionally also
+when it is spread over a /24), and credential stuffing as a pile of
+401/403s. The path and status sketches are cleared every `window` seconds,
+so only what a client does within one window adds up. Every update and
+score is O(1); profiles live in sharded LRU maps capped at `max_profiles`,
+and ones idle for `idle_seconds` are dropped first.
+"""
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+HLL_BITS = 6
+HLL_M = 1 << HLL_BITS
+HLL_ALPHA = 0.709  # bias correction for m = 64
+CMS_WIDTH = 16
+_MASK64 = (1 << 64) - 1
+
+
+class _Profile:
+    __slots__ = ('registers', 'inv_sum', 'zeros', 'statuses', 'requests', 'since', 'rate', 'last')
+
+    def __init__(self, now):
+        self.reset(now)
+        self.rate = 0.0
+        self.last = now
+
+    def reset(self, now):
+        """Start a new counting window: clear the path and status sketches."""
+        self.registers = bytearray(HLL_M)
+        # Running sum of 2**-register and count of empty registers, so the
+        # HLL estimate never has to scan the registers
+        self.inv_sum = float(HLL_M)
+        self.zeros = HLL_M
+        self.statuses = array('I', bytes(8 * CMS_WIDTH))
+        self.requests = 0
+        self.since = now
+
+    def add_path(self, path):
+        h = hash(path) & _MASK64
+        j = h & (HLL_M - 1)
+        rank = 65 - HLL_BITS - (h >> HLL_BITS).bit_length()
+        old = self.registers[j]
+        if rank > old:
+            self.registers[j] = rank
+            self.inv_sum += 2.0 ** -rank - 2.0 ** -old
+            self.zeros -= old == 0
+
+    def distinct_paths(self) -> float:
+        estimate = HLL_ALPHA * HLL_M * HLL_M / self.inv_sum
+        if estimate <= 2.5 * HLL_M and self.zeros:
+            # Linear counting is more accurate for small cardinalities
+            return HLL_M * math.log(HLL_M / self.zeros)
+        return estimate
+
+    def add_status(self, status):
+        s = self.statuses
+        s[status % CMS_WIDTH] += 1
+        s[CMS_WIDTH + ((status * 0x9E3779B1) >> 11) % CMS_WIDTH] += 1
+
+    def status_count(self, status) -> int:
+        s = self.statuses
+        return min(s[status % CMS_WIDTH], s[CMS_WIDTH + ((status * 0x9E3779B1) >> 11) % CMS_WIDTH])
+
+    def tick(self, now, tau):
+        """Count one request into the EWMA rate (requests per second)."""
+        self.rate = self.rate * math.exp((self.last - now) / tau) + 1.0 / tau
+        self.last = now
+        self.requests += 1
+
+
+class _Shard:
+    __slots__ = ('lock', 'profiles', 'max_profiles', 'evicted')
+
+    def __init__(self, max_profiles):
+        self.lock = threading.Lock()
+        self.profiles = OrderedDict()
+        self.max_profiles = max_profiles
+        self.evicted = 0
+
+
+def network_of(ip: str):
+    """The /24 an IPv4 address belongs to, or None."""
+    head, sep, _ = ip.rpartition('.')
+    return f"{head}.0/24" if sep and ':' not in ip else None
+
+
+class BehaviorProfiler:
+    """Scores clients on cross-request behavior.
+
+    score = 1 - (1 - scan)(1 - brute)(1 - burst), where
+      scan  = distinct paths / `scan_paths` (capped at 1), weighted by the
+              share of those requests that were 404s (half weight if none)
+      brute = (401 + 403 responses) / `auth_failures` (capped at 1)
+      burst = half of EWMA rate / `rate_per_sec` (capped at 0.5), so a fast
+              client alone never reaches the block threshold; that is the
+              rate limiter's job
+    Paths, statuses and the request count behind the 404 share cover the
+    current `window` only (a tumbling window, restarted per profile), so
+    slow activity never accumulates into a block.
+
+    With `network_scale` set, the address's /24 is also scored the same
+    way with every threshold `network_scale` times higher, and the address
+    gets the larger of the two scores. Off by default: a busy /24 (NAT,
+    office, mobile carrier) would otherwise pass its score on to every
+    address in it.
+    """
+
+    SWEEP_BATCH = 4
+
+    def __init__(self, max_profiles: int = 100_000, idle_seconds: float = 3600.0,
+                 scan_paths: int = 50, auth_failures: int = 20, rate_per_sec: float = 5.0,
+                 rate_window: float = 60.0, window: float = 600.0, network_scale: float = None,
+                 shards: int = 16, clock=time.monotonic):
+        self.idle_seconds = idle_seconds
+        self.scan_paths = scan_paths
+        self.auth_failures = auth_failures
+        self.rate_per_sec = rate_per_sec
+        self.rate_window = rate_window
+        self.window = window
+        self.network_scale = network_scale
+        self.clock = clock
+        per_shard = max(1, -(-max_profiles // shards))
+        self.shards = [_Shard(per_shard) for _ in range(shards)]
+        self.flagged = 0
+
+    def _profile(self, key, now):
+        """Profile for `key`, created if needed; call with its shard's lock."""
+        shard = self.shards[hash(key) % len(self.shards)]
+        profiles = shard.profiles
+        p = profiles.get(key)
+        if p is not None:
+            profiles.move_to_end(key)
+            return p
+        for _ in range(self.SWEEP_BATCH):
+            if not profiles or now - next(iter(profiles.values())).last < self.idle_seconds:
+                break
+            profiles.popitem(last=False)
+        while len(profiles) >= shard.max_profiles:
+            profiles.popitem(last=False)
+            shard.evicted += 1
+        p = profiles[key] = _Profile(now)
+        return p
+
+    def _update(self, key, now, path=None, status=None):
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.lock:
+            p = self._profile(key, now)
+            if now - p.since >= self.window:
+                p.reset(now)
+            if status is not None:
+                p.add_status(status)
+                return None
+            p.add_path(path)
+            p.tick(now, self.rate_window)
+            return (p.distinct_paths(), p.requests, p.status_count(404),
+                    p.status_count(401) + p.status_count(403), p.rate)
+
+    def _score(self, sample, scale):
+        paths, requests, not_found, auth_failed, rate = sample
+        # Status counts lag by one request: the current one has none yet
+        answered = max(requests - 1, 1)
+        scan = min(1.0, paths / (self.scan_paths * scale)) * (0.5 + 0.5 * min(1.0, not_found / answered))
+        brute = min(1.0, auth_failed / (self.auth_failures * scale))
+        burst = 0.5 * min(1.0, rate / (self.rate_per_sec * scale))
+        hits = []
+        if scan >= 0.5:
+            hits.append('SCANNER')
+        if brute >= 0.5:
+            hits.append('AUTH_BRUTE_FORCE')
+        if burst >= 0.25:
+            hits.append('HIGH_RATE')
+        return 1.0 - (1.0 - scan) * (1.0 - brute) * (1.0 - burst), hits
+
+    def observe(self, ip: str, path: str) -> dict:
+        """Record a request and return {score, hits, paths, rate,
+        auth_failures, not_found} for the client (the /24's score when
+        that is higher)."""
+        now = self.clock()
+        sample = self._update(ip, now, path=path)
+        score, hits = self._score(sample, 1.0)
+        net = network_of(ip) if self.network_scale else None
+        if net is not None:
+            net_score, net_hits = self._score(self._update(net, now, path=path), self.network_scale)
+            if net_score > score:
+                score, hits = net_score, [f'{h}_NETWORK' for h in net_hits]
+        if hits:
+            self.flagged += 1
+        return {
+            'score': round(score, 4),
+            'hits': hits,
+            'paths': round(sample[0]),
+            'rate': round(sample[4], 3),
+            'auth_failures': sample[3],
+            'not_found': sample[2],
+        }
+
+    def record_status(self, ip: str, status: int):
+        """Count the response status of a request observed earlier."""
+        now = self.clock()
+        self._update(ip, now, status=status)
+        net = network_of(ip) if self.network_scale else None
+        if net is not None:
+            self._update(net, now, status=status)
+
+    def stats(self) -> dict:
+        return {
+            'profiles': len(self),
+            'evicted': sum(s.evicted for s in self.shards),
+            'flagged': self.flagged,
+        }
+
+    def __len__(self):
+        return sum(len(s.profiles) for s in self.shards)
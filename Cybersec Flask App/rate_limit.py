@@ -1,20 +1,191 @@
+import threading
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict
 
-class TokenBucketLimiter:
-    """Simple per-IP token bucket for rate limiting."""
-    def __init__(self, per_minute=120, burst=30):
+
+class _Shard:
+    __slots__ = ('lock', 'states', 'max_keys', 'evicted')
+
+    def __init__(self, max_keys):
+        self.lock = threading.Lock()
+        self.states = OrderedDict()
+        self.max_keys = max_keys
+        self.evicted = 0
+
+
+class _ShardedLimiter:
+    """Common storage for the per-IP limiters: `allow(key)` semantics,
+    thread safety and bounded memory.
+
+    Keys are striped over `shards` independently locked shards by hash, so
+    threads only contend when their keys land on the same shard, and each
+    read-modify-write of a key's state happens under its shard's lock.
+
+    Per-key state lives in per-shard OrderedDicts kept in LRU order. State
+    that `_idle` reports as equivalent to a fresh key is swept from the cold
+    end whenever a new key is admitted, which loses nothing. If live keys
+    still exceed a shard's share of `max_keys`, the least recently used one
+    is evicted (that key just starts over) and counted in `evicted`.
+
+    Subclasses implement `_decide(state, now) -> (allowed, state)`, where
+    state is None for an unseen key, and `_idle(state, now)`.
+    """
+
+    # Idle keys swept per new key; keeps insertion O(1) amortized.
+    SWEEP_BATCH = 4
+
+    def __init__(self, per_minute=120, burst=30, max_keys=100_000, shards=16):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_keys = max_keys
+        per_shard = max(1, -(-max_keys // shards))
+        self.shards = [_Shard(per_shard) for _ in range(shards)]
+
+    def allow(self, key: str) -> bool:
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.lock:
+            now = time.monotonic()
+            states = shard.states
+            state = states.get(key)
+            if state is None:
+                self._make_room(shard, now)
+            else:
+                states.move_to_end(key)
+            allowed, states[key] = self._decide(state, now)
+            return allowed
+
+    def _make_room(self, shard, now):
+        states = shard.states
+        for _ in range(self.SWEEP_BATCH):
+            if not states or not self._idle(next(iter(states.values())), now):
+                break
+            states.popitem(last=False)
+        while len(states) >= shard.max_keys:
+            states.popitem(last=False)
+            shard.evicted += 1
+
+    def _decide(self, state, now):
+        raise NotImplementedError
+
+    def _idle(self, state, now) -> bool:
+        raise NotImplementedError
+
+    @property
+    def evicted(self):
+        return sum(s.evicted for s in self.shards)
+
+    def __len__(self):
+        return sum(len(s.states) for s in self.shards)
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, tokens, last):
+        self.tokens = tokens
+        self.last = last
+
+
+class TokenBucketLimiter(_ShardedLimiter):
+    """Per-IP token bucket: `burst` tokens, refilled at `per_minute`.
+
+    A bucket left idle for `burst / refill_rate` seconds is full again.
+    """
+
+    def __init__(self, per_minute=120, burst=30, max_keys=100_000, shards=16):
+        super().__init__(per_minute, burst, max_keys, shards)
         self.capacity = burst
         self.refill_rate = per_minute / 60.0  # tokens per second
-        self.buckets = defaultdict(lambda: {'tokens': burst, 'last': time.time()})
+        self.idle_after = burst / self.refill_rate if self.refill_rate else float('inf')
 
-    def allow(self, key: str) -> bool:
-        now = time.time()
-        b = self.buckets[key]
-        elapsed = now - b['last']
-        b['tokens'] = min(self.capacity, b['tokens'] + elapsed * self.refill_rate)
-        b['last'] = now
-        if b['tokens'] >= 1.0:
-            b['tokens'] -= 1.0
-            return True
-        return False
\ No newline at end of file
+    def _decide(self, b, now):
+        if b is None:
+            b = _Bucket(self.capacity, now)
+        else:
+            b.tokens = min(self.capacity, b.tokens + (now - b.last) * self.refill_rate)
+            b.last = now
+        if b.tokens >= 1.0:
+            b.tokens -= 1.0
+            return True, b
+        return False, b
+
+    def _idle(self, b, now):
+        return now - b.last >= self.idle_after
+
+
+class GCRALimiter(_ShardedLimiter):
+    """Generic Cell Rate Algorithm: admits the same traffic as a token bucket
+    of `burst` refilled at `per_minute`, but the whole per-key state is one
+    float, the theoretical arrival time (TAT) of the next request.
+    """
+
+    def __init__(self, per_minute=120, burst=30, max_keys=100_000, shards=16):
+        if per_minute <= 0:
+            raise ValueError("GCRALimiter needs per_minute > 0")
+        super().__init__(per_minute, burst, max_keys, shards)
+        self.interval = 60.0 / per_minute  # emission interval
+        self.tolerance = burst * self.interval
+
+    def _decide(self, tat, now):
+        tat = now if tat is None or tat < now else tat
+        new_tat = tat + self.interval
+        if new_tat - now <= self.tolerance:
+            return True, new_tat
+        return False, tat
+
+    def _idle(self, tat, now):
+        return tat <= now
+
+
+class _Window:
+    __slots__ = ('start', 'prev', 'count')
+
+    def __init__(self, start):
+        self.start = start
+        self.prev = 0
+        self.count = 0
+
+
+class SlidingWindowLimiter(_ShardedLimiter):
+    """Sliding-window counter: at most `per_minute` requests in any 60 s
+    window, approximated from the current and previous fixed windows (the
+    previous count is weighted by how much of it still overlaps the sliding
+    window). `burst` is not used; the window itself bounds bursts.
+    """
+
+    WINDOW = 60.0
+
+    def _decide(self, w, now):
+        if w is None:
+            w = _Window(now - now % self.WINDOW)
+        elapsed = now - w.start
+        if elapsed >= self.WINDOW:
+            # Roll forward; anything older than one window no longer counts.
+            w.prev = w.count if elapsed < 2 * self.WINDOW else 0
+            w.count = 0
+            w.start = now - now % self.WINDOW
+            elapsed = now - w.start
+        estimate = w.prev * (1.0 - elapsed / self.WINDOW) + w.count
+        if estimate + 1 <= self.per_minute:
+            w.count += 1
+            return True, w
+        return False, w
+
+    def _idle(self, w, now):
+        return now - w.start >= 2 * self.WINDOW
+
+
+LIMITERS = {
+    'token_bucket': TokenBucketLimiter,
+    'gcra': GCRALimiter,
+    'sliding_window': SlidingWindowLimiter,
+}
+
+
+def make_limiter(algorithm='token_bucket', **kwargs) -> _ShardedLimiter:
+    try:
+        cls = LIMITERS[algorithm]
+    except KeyError:
+        raise ValueError(f"Unknown rate limit algorithm {algorithm!r}. "
+                         f"Available: {', '.join(LIMITERS)}") from None
+    return cls(**kwargs)
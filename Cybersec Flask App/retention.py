@@ -0,0 +1,327 @@
+"""Incident retention: per-day archive files and the compactor that fills
+them.
+
+The `incidents` table in incidents.db only holds the hot window (the last
+INCIDENT_HOT_HOURS). Older rows are moved, in small batches, into one
+SQLite file per UTC day under the archive directory, where surfaces are
+zlib-compressed and mitigation scripts are stored once in a
+content-addressed `scripts` table. Whole archive days are then dropped by
+age and, oldest first, whenever the archive outgrows its size cap. Each
+incident is written twice over its life (hot table, then archive), and
+the freed hot-table pages are reused, so disk use and write amplification
+stay bounded however long an attack lasts.
+
+Run one compaction pass by hand or from cron (e.g. with several workers
+and INCIDENT_COMPACT_SECONDS=0):
+
+    python retention.py --db incidents.db --hot-hours 24 --retention-days 30
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from incident_log import INCIDENT_COLUMNS
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scripts (
+        hash TEXT PRIMARY KEY,
+        script TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS incidents (
+        id INTEGER PRIMARY KEY,
+        ts TEXT NOT NULL,
+        ip TEXT,
+        path TEXT,
+        method TEXT,
+        user_agent TEXT,
+        surface BLOB,
+        heuristic_score REAL,
+        heuristic_hits TEXT,
+        ai_verdict TEXT,
+        ai_confidence REAL,
+        ai_categories TEXT,
+        ai_explanation TEXT,
+        action TEXT,
+        script_hash TEXT REFERENCES scripts(hash),
+        ref TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_incidents_ts ON incidents(ts);
+    CREATE INDEX IF NOT EXISTS idx_incidents_ip ON incidents(ip);
+"""
+
+_ARCHIVE_COLUMNS = tuple('script_hash' if c == 'mitigation_script' else c for c in INCIDENT_COLUMNS)
+_SURFACE = INCIDENT_COLUMNS.index('surface')
+_SCRIPT = INCIDENT_COLUMNS.index('mitigation_script')
+_PREFIX = 'incidents-'
+
+
+def script_hash(script: str) -> str:
+    return hashlib.sha256(script.encode('utf-8')).hexdigest()
+
+
+class IncidentArchive:
+    """Directory of per-day archive databases (incidents-YYYY-MM-DD.db)."""
+
+    def __init__(self, directory: str, level: int = 6):
+        self.directory = directory
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, day: str) -> str:
+        return os.path.join(self.directory, f"{_PREFIX}{day}.db")
+
+    def days(self):
+        """Archived days, oldest first."""
+        return sorted(name[len(_PREFIX):-3] for name in os.listdir(self.directory)
+                      if name.startswith(_PREFIX) and name.endswith('.db'))
+
+    def size(self) -> int:
+        return sum(os.path.getsize(self.path(day)) for day in self.days())
+
+    def _connect(self, day: str):
+        db = sqlite3.connect(self.path(day), timeout=30)
+        db.executescript(ARCHIVE_SCHEMA)
+        return db
+
+    def store(self, rows) -> int:
+        """Archive hot-table rows given as (id, *INCIDENT_COLUMNS). Rows
+        already archived are skipped, so an interrupted move can be redone.
+        Returns the number of new scripts stored (the rest were duplicates)."""
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[1][:10], []).append(row)
+        new_scripts = 0
+        for day, batch in by_day.items():
+            db = self._connect(day)
+            try:
+                with db:
+                    scripts, out = {}, []
+                    for row in batch:
+                        values = list(row[1:])
+                        surface, script = values[_SURFACE], values[_SCRIPT]
+                        if surface is not None:
+                            values[_SURFACE] = zlib.compress(surface.encode('utf-8'), self.level)
+                        digest = None
+                        if script:
+                            digest = script_hash(script)
+                            scripts[digest] = script
+                        values[_SCRIPT] = digest
+                        out.append((row[0], *values))
+                    before = db.total_changes
+                    db.executemany("INSERT OR IGNORE INTO scripts (hash, script) VALUES (?, ?)",
+                                   list(scripts.items()))
+                    new_scripts += db.total_changes - before
+                    db.executemany(
+                        f"INSERT OR IGNORE INTO incidents (id, {', '.join(_ARCHIVE_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * (len(_ARCHIVE_COLUMNS) + 1))})", out)
+            finally:
+                db.close()
+        return new_scripts
+
+    def get(self, incident_id: int):
+        """An archived incident as a dict with its surface and script
+        restored, or None. Searches the newest days first."""
+        for day in reversed(self.days()):
+            db = self._connect(day)
+            try:
+                db.row_factory = sqlite3.Row
+                row = db.execute(
+                    "SELECT i.*, s.script AS mitigation_script FROM incidents i "
+                    "LEFT JOIN scripts s ON s.hash = i.script_hash WHERE i.id = ?",
+                    (incident_id,)).fetchone()
+            finally:
+                db.close()
+            if row is not None:
+                out = dict(row)
+                out.pop('script_hash')
+                if out['surface'] is not None:
+                    out['surface'] = zlib.decompress(out['surface']).decode('utf-8')
+                return out
+        return None
+
+    def scan(self, columns, where: str = '', params=()):
+        """Yield `columns` of archived incidents matching the SQL `where`
+        clause, oldest day first, with surfaces decompressed. `where` sees
+        the stored row, so it must not test the (compressed) surface."""
+        select = ', '.join(columns)
+        surface = columns.index('surface') if 'surface' in columns else None
+        for day in self.days():
+            db = self._connect(day)
+            try:
+                rows = db.execute(f"SELECT {select} FROM incidents {f'WHERE {where}' if where else ''}",
+                                  params).fetchall()
+            finally:
+                db.close()
+            for row in rows:
+                if surface is not None and row[surface] is not None:
+                    row = row[:surface] + (zlib.decompress(row[surface]).decode('utf-8'),) + row[surface + 1:]
+                yield row
+
+    def enforce(self, retention_days: int = 0, max_bytes: int = 0, today: str = None):
+        """Delete days older than `retention_days` (0 keeps them all), then
+        the oldest remaining days while the archive exceeds `max_bytes`
+        (0 = no cap). The newest day is never dropped for size. Returns
+        the deleted days."""
+        days = self.days()
+        dropped = []
+        if retention_days:
+            today = today or datetime.utcnow().date().isoformat()
+            cutoff = (datetime.fromisoformat(today) - timedelta(days=retention_days)).date().isoformat()
+            dropped = [d for d in days if d < cutoff]
+            days = days[len(dropped):]
+        if max_bytes:
+            sizes = [os.path.getsize(self.path(d)) for d in days]
+            total = sum(sizes)
+            while len(days) > 1 and total > max_bytes:
+                total -= sizes.pop(0)
+                dropped.append(days.pop(0))
+        for day in dropped:
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                try:
+                    os.remove(self.path(day) + suffix)
+                except FileNotFoundError:
+                    pass
+        return dropped
+
+
+class Compactor:
+    """Moves incidents older than `hot_hours` from the hot table into an
+    IncidentArchive and applies retention, every `interval` seconds on a
+    background thread (or once via run_once()).
+
+    Rows move `batch_size` at a time, each batch archived before it is
+    deleted from the hot table, so the incident writer is never locked out
+    for long and a crash in between only repeats work.
+
+    Each pass also trims the rollups: minutes and addresses not seen within
+    `retention_days`, and all but the `max_rollup_ips` addresses with the
+    most incidents (0 = no cap), since spoofed client addresses would
+    otherwise grow rollup_ip without bound.
+    """
+
+    def __init__(self, db_path: str, archive: IncidentArchive, hot_hours: float = 24,
+                 retention_days: int = 30, max_bytes: int = 0, interval: float = 300,
+                 batch_size: int = 2000, max_rollup_ips: int = 10_000):
+        self.db_path = db_path
+        self.archive = archive
+        self.hot_hours = hot_hours
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_rollup_ips = max_rollup_ips
+        self.runs = 0
+        self.moved = 0
+        self.scripts_stored = 0
+        self.days_dropped = 0
+        self.rollup_ips_pruned = 0
+        self.last_run_s = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='incident-compactor', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError):
+                log.exception("Incident compaction failed")
+
+    def run_once(self, now: datetime = None) -> dict:
+        t0 = time.perf_counter()
+        now = now or datetime.utcnow()
+        cutoff = (now - timedelta(hours=self.hot_hours)).isoformat()
+        moved = 0
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self._stop.is_set():
+                rows = db.execute(
+                    f"SELECT id, {', '.join(INCIDENT_COLUMNS)} FROM incidents "
+                    f"WHERE ts < ? ORDER BY ts LIMIT ?", (cutoff, self.batch_size)).fetchall()
+                if not rows:
+                    break
+                self.scripts_stored += self.archive.store(rows)
+                with db:
+                    db.executemany("DELETE FROM incidents WHERE id = ?", [(r[0],) for r in rows])
+                moved += len(rows)
+            pruned = self._prune_rollups(db, now)
+        finally:
+            db.close()
+        dropped = self.archive.enforce(self.retention_days, self.max_bytes, now.date().isoformat())
+        self.runs += 1
+        self.moved += moved
+        self.days_dropped += len(dropped)
+        self.rollup_ips_pruned += pruned
+        self.last_run_s = time.perf_counter() - t0
+        return {'moved': moved, 'dropped_days': dropped, 'rollup_ips_pruned': pruned,
+                'seconds': round(self.last_run_s, 3)}
+
+    def _prune_rollups(self, db, now) -> int:
+        """Trim rollup_minute and rollup_ip; returns the addresses removed."""
+        pruned = 0
+        with db:
+            if self.retention_days:
+                # The minute rollup only feeds the recent-activity chart
+                horizon = (now - timedelta(days=self.retention_days)).isoformat()
+                db.execute("DELETE FROM rollup_minute WHERE minute < ?", (horizon[:16],))
+                pruned += db.execute("DELETE FROM rollup_ip WHERE last_ts < ?", (horizon,)).rowcount
+            if self.max_rollup_ips:
+                (count,) = db.execute("SELECT COUNT(*) FROM rollup_ip").fetchone()
+                if count > self.max_rollup_ips:
+                    pruned += db.execute(
+                        "DELETE FROM rollup_ip WHERE ip NOT IN (SELECT ip FROM rollup_ip "
+                        "ORDER BY incidents DESC, last_ts DESC LIMIT ?)", (self.max_rollup_ips,)).rowcount
+        return pruned
+
+    def stats(self) -> dict:
+        return {
+            'runs': self.runs,
+            'moved': self.moved,
+            'scripts_stored': self.scripts_stored,
+            'days_dropped': self.days_dropped,
+            'rollup_ips_pruned': self.rollup_ips_pruned,
+            'archive_days': len(self.archive.days()),
+            'archive_bytes': self.archive.size(),
+            'last_run_s': round(self.last_run_s, 3),
+        }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--db', default='incidents.db')
+    ap.add_argument('--archive-dir', help='default: archive/ next to the database')
+    ap.add_argument('--hot-hours', type=float, default=24)
+    ap.add_argument('--retention-days', type=int, default=30)
+    ap.add_argument('--max-mb', type=float, default=0, help='archive size cap (0 = none)')
+    ap.add_argument('--rollup-max-ips', type=int, default=10_000, help='per-IP rollup cap (0 = none)')
+    args = ap.parse_args()
+    archive = IncidentArchive(args.archive_dir or os.path.join(os.path.dirname(os.path.abspath(args.db)), 'archive'))
+    compactor = Compactor(args.db, archive, args.hot_hours, args.retention_days,
+                          int(args.max_mb * 1024 * 1024), max_rollup_ips=args.rollup_max_ips)
+    report = compactor.run_once()
+    report.update(compactor.stats())
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from detectors import SignatureEngine
+
+log = logging.getLogger(__name__)
+
+
+class RulePackStore:
+    """Serves the compiled SignatureEngine for a rule-pack file and swaps in
+    a new one when the file changes on disk.
+
+    The file is stat'ed at most every `check_interval` seconds. A changed
+    mtime/size triggers a re-read, but the pack is only recompiled when its
+    content hash differs. Swapping is a single attribute assignment, so
+    callers that already hold an engine keep using it for the rest of their
+    request. A pack that fails to load is logged and the previous engine
+    stays in service.
+    """
+
+    def __init__(self, path: str, check_interval: float = 2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        self._engine = None
+        self._next_check = 0.0
+        # Fail loudly at startup; later reload errors keep the old engine.
+        self._reload()
+
+    def current(self) -> SignatureEngine:
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.check_interval
+                self._reload()
+            except (OSError, ValueError) as e:
+                self.last_error = str(e)
+                log.warning("Keeping rule pack %s: reload of %s failed: %s",
+                            self._engine.version, self.path, e)
+            finally:
+                self._lock.release()
+        return self._engine
+
+    def _reload(self):
+        st = os.stat(self.path)
+        stat_key = (st.st_mtime_ns, st.st_size)
+        if stat_key == self._stat:
+            return
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest != self._digest:
+            try:
+                pack = json.loads(raw.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                raise ValueError(f"Invalid rule pack: {e}") from e
+            engine = SignatureEngine.from_pack(pack)
+            self._engine = engine
+            self._digest = digest
+            self.reloads += 1
+            self.last_error = None
+            log.info("Loaded rule pack %s %s (%s)", engine.name, engine.version, digest[:12])
+        self._stat = stat_key
+
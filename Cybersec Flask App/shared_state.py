@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Host-wide guard state for multi-process deployments (e.g. several gunicorn
+# workers). Every worker opens the same SQLite file in WAL mode, so readers
+# never wait on writers and each decision is a single indexed statement.
+# The state is disposable (it only has to outlive a worker, not the host),
+# so commits skip fsync with synchronous=OFF.
+
+
+class _SqliteState:
+
+    SCHEMA = ""
+
+    def __init__(self, path: str, busy_timeout_ms: int = 2000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shareable across threads by default.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=True)
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+
+class SqliteTokenBucketLimiter(_SqliteState):
+    """Token bucket with the TokenBucketLimiter interface, shared by every
+    process that opens the same file.
+
+    Refill, spend and the allow/deny decision happen in one UPSERT, so
+    concurrent workers cannot double-spend a token. That UPSERT is a write
+    transaction (about 25us) holding the database-wide SQLite write lock,
+    so rather than one per request, a process leases up to `lease` tokens
+    of a key at a time and spends them locally until they run out or
+    `lease_ttl` seconds pass; unspent leased tokens are forfeited. A denied
+    key is also denied locally until its next token is due, which covers
+    a flooding client without touching the file at all.
+
+    Leasing never admits more than the bucket holds, but a key can be
+    denied early by up to (workers - 1) * (lease - 1) tokens stranded in
+    other workers' leases, and admit up to lease - 1 more than `burst`
+    within `lease_ttl` of a refill. lease=1 gives the exact per-request
+    bucket. At most `max_keys` leases are kept per process, least recently
+    used first out.
+
+    Buckets idle long enough to be full again are pruned every
+    `prune_every` seconds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            last REAL NOT NULL,
+            allowed INTEGER NOT NULL  -- tokens granted by the last call
+        ) WITHOUT ROWID;
+    """
+
+    # SET expressions all see the pre-update row, so `refilled` is computed
+    # from the old tokens/last in each of them.
+    _LEASE = """
+        INSERT INTO rate_buckets (key, tokens, last, allowed)
+        VALUES (:key, :cap - min(:lease, :cap), :now, min(:lease, :cap))
+        ON CONFLICT(key) DO UPDATE SET
+            tokens = {refilled} - {granted},
+            allowed = {granted},
+            last = :now
+        RETURNING allowed, tokens
+    """.format(refilled="min(:cap, tokens + max(0, :now - last) * :rate)",
+               granted="min(:lease, CAST(min(:cap, tokens + max(0, :now - last) * :rate) AS INTEGER))")
+
+    def __init__(self, path: str, per_minute=120, burst=30, prune_every=60.0,
+                 lease=1, lease_ttl=1.0, max_keys=100_000, **kwargs):
+        super().__init__(path, **kwargs)
+        self.capacity = burst
+        self.refill_rate = per_minute / 60.0
+        self.idle_after = burst / self.refill_rate if self.refill_rate else float('inf')
+        self.prune_every = prune_every
+        self.lease = max(1, int(lease))
+        self.lease_ttl = lease_ttl
+        self.max_keys = max_keys
+        self.shared_calls = 0
+        self._leases = OrderedDict()  # key -> (tokens left, valid until)
+        self._lock = threading.Lock()
+        self._next_prune = time.monotonic() + prune_every
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            # (0, until) denies until then; spent leases are dropped
+            left, until = self._leases.get(key, (0, 0.0))
+            if now < until:
+                if left > 1:
+                    self._leases[key] = (left - 1, until)
+                    self._leases.move_to_end(key)
+                elif left:
+                    del self._leases[key]
+                else:
+                    self._leases.move_to_end(key)
+                return bool(left)
+        granted, tokens = self._conn().execute(self._LEASE, {
+            'key': key, 'cap': self.capacity, 'now': time.time(), 'rate': self.refill_rate,
+            'lease': self.lease,
+        }).fetchone()
+        if granted > 1:
+            entry = (granted - 1, now + self.lease_ttl)
+        elif granted:
+            entry = None
+        elif self.refill_rate:
+            # No token exists anywhere before the bucket refills to one
+            entry = (0, now + (1 - tokens) / self.refill_rate)
+        else:
+            entry = (0, now + self.lease_ttl)
+        with self._lock:
+            self.shared_calls += 1
+            if entry is None:
+                self._leases.pop(key, None)
+            else:
+                self._leases[key] = entry
+                self._leases.move_to_end(key)
+                while len(self._leases) > self.max_keys:
+                    self._leases.popitem(last=False)
+        if now >= self._next_prune:
+            self.prune()
+        return bool(granted)
+
+    def prune(self):
+        self._next_prune = time.monotonic() + self.prune_every
+        if self.idle_after != float('inf'):
+            self._conn().execute("DELETE FROM rate_buckets WHERE last < ?",
+                                 (time.time() - self.idle_after,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT count(*) FROM rate_buckets").fetchone()[0]
+
+
+class SqliteBlocklist(_SqliteState):
+    """Blocklist with the blocklist.Blocklist interface, visible to every
+    process that opens the same file."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blocklist (
+            ip TEXT PRIMARY KEY,
+            until REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def is_blocked(self, ip: str) -> bool:
+        row = self._conn().execute(
+            "SELECT until FROM blocklist WHERE ip = ?", (ip,)).fetchone()
+        if row is None:
+            return False
+        if time.time() < row[0]:
+            return True
+        self._conn().execute("DELETE FROM blocklist WHERE ip = ? AND until = ?", (ip, row[0]))
+        return False
+
+    def block(self, ip: str, duration: float):
+        if '/' in ip:
+            raise ValueError("the shared blocklist only supports single addresses")
+        self._conn().execute(
+            "INSERT OR REPLACE INTO blocklist (ip, until) VALUES (?, ?)",
+            (ip, time.time() + duration))
+
+    def unblock(self, ip: str):
+        self._conn().execute("DELETE FROM blocklist WHERE ip = ?", (ip,))
+
+    def items(self):
+        return self._conn().execute(
+            "SELECT ip, until FROM blocklist WHERE until > ? ORDER BY until DESC",
+            (time.time(),)).fetchall()
+
+
+class SqliteScriptStore(_SqliteState):
+    """Mitigation script templates by incident signature, persisted across
+    restarts and shared by every process that opens the same file (the
+    on-disk layer of firewall.ScriptCache)."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mitigation_templates (
+            signature TEXT PRIMARY KEY,
+            template TEXT NOT NULL,
+            created REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def get(self, signature: str, max_age: float):
+        row = self._conn().execute(
+            "SELECT template FROM mitigation_templates WHERE signature = ? AND created > ?",
+            (signature, time.time() - max_age)).fetchone()
+        return row[0] if row else None
+
+    def put(self, signature: str, template: str, max_age: float):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO mitigation_templates (signature, template, created) VALUES (?, ?, ?)",
+            (signature, template, now))
+        # Writes are rare (one per new attack signature); prune as we go
+        conn.execute("DELETE FROM mitigation_templates WHERE created <= ?", (now - max_age,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT count(*) FROM mitigation_templates").fetchone()[0]
@@ -0,0 +1,117 @@
+"""Single-flight: concurrent calls with the same key share one execution.
+
+The first caller for a key (the leader) runs the function; callers that
+arrive while it is in flight wait for its result instead of starting their
+own, each for at most its own timeout. Nothing is remembered once the call
+completes (that is what the verdict cache is for).
+
+SingleFlight is for threads; AsyncSingleFlight for coroutines, and
+deduplicates per event loop.
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread-safe single-flight. `leaders` counts executions, `shared`
+    callers that reused one, `timeouts` waiters that gave up."""
+
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout: float = None):
+        """Return fn(), or the result of the identical call already in
+        flight. Waiters raise TimeoutError after `timeout` seconds and
+        re-raise the leader's exception if it failed."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+        if not call.done.wait(timeout):
+            self.timeouts += 1
+            raise TimeoutError('single-flight wait timed out')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self) -> dict:
+        return {
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'timeouts': self.timeouts,
+            'in_flight': len(self._calls),
+        }
+
+
+class AsyncSingleFlight:
+    """Single-flight for coroutines; same contract as SingleFlight.do,
+    with `fn` returning an awaitable. Calls are keyed per running loop,
+    since futures cannot be awaited across loops."""
+
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+        self._calls = {}
+
+    async def do(self, key, fn, timeout: float = None):
+        loop = asyncio.get_running_loop()
+        slot = (loop, key)
+        fut = self._calls.get(slot)
+        if fut is None:
+            fut = self._calls[slot] = loop.create_future()
+            self.leaders += 1
+            try:
+                result = await fn()
+            except BaseException as e:
+                # Waiters must not inherit the leader's cancellation
+                fut.set_exception(e if isinstance(e, Exception) else RuntimeError('single-flight leader cancelled'))
+                fut.exception()  # retrieved here, so an unwaited failure is not logged
+                raise
+            else:
+                fut.set_result(result)
+                return result
+            finally:
+                del self._calls[slot]
+        self.shared += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError('single-flight wait timed out') from None
+
+    def stats(self) -> dict:
+        return {
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'timeouts': self.timeouts,
+            'in_flight': len(self._calls),
+        }
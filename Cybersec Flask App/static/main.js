@@ -7,4 +7,129 @@ if (f) {
     const data = await res.json();
     document.querySelector('#probeOut').textContent = JSON.stringify(data, null, 2);
   });
-}
\ No newline at end of file
+}
+// Incident details are fetched the first time a row is expanded.
+// `toggle` does not bubble, so listen in the capture phase.
+document.addEventListener('toggle', async (e) => {
+  const d = e.target;
+  if (!d.dataset || !d.dataset.incident || !d.open || d.dataset.loaded) return;
+  d.dataset.loaded = '1';
+  const res = await fetch(`/dashboard/incident/${d.dataset.incident}`);
+  const data = res.ok ? await res.json() : {};
+  d.querySelectorAll('[data-field]').forEach((el) => {
+    el.textContent = data[el.dataset.field] || '';
+  });
+}, true);
+
+// Live dashboard: apply incidents, verdict updates and blocklist changes
+// pushed over /dashboard/stream instead of re-rendering the page.
+const incidents = document.querySelector('#incidents[data-last-event]');
+if (incidents && window.EventSource) {
+  const pageSize = parseInt(incidents.dataset.pageSize, 10);
+  const blocklistEl = document.querySelector('#blocklist');
+  const status = document.querySelector('#liveStatus');
+  const list = (v) => (Array.isArray(v) ? v.join(',') : v || '');
+  const el = (tag, cls, text) => {
+    const n = document.createElement(tag);
+    if (cls) n.className = cls;
+    if (text !== undefined) n.textContent = text;
+    return n;
+  };
+  const findRow = (ref) => (ref ? incidents.querySelector(`tr[data-ref="${CSS.escape(ref)}"]`) : null);
+
+  const fillAi = (td, verdict, confidence, categories) => {
+    td.replaceChildren(
+      `${verdict || ''} ${(confidence || 0).toFixed(2)}`,
+      el('br'),
+      el('span', 'text-slate-500', list(categories)),
+    );
+  };
+
+  const addIncident = (i) => {
+    if (findRow(i.ref)) return;
+    incidents.querySelectorAll('[data-empty]').forEach((n) => n.remove());
+    const row = el('tr', 'border-t');
+    row.dataset.ref = i.ref;
+    row.append(
+      el('td', 'py-2 pr-4 whitespace-nowrap', i.ts),
+      el('td', 'py-2 pr-4 font-mono', i.ip),
+      el('td', 'py-2 pr-4', `${i.method} ${i.path}`),
+      el('td', 'py-2 pr-4', `${(i.heuristic_score || 0).toFixed(2)} (${list(i.heuristic_hits)})`),
+    );
+    const ai = el('td', 'py-2 pr-4');
+    ai.dataset.col = 'ai';
+    fillAi(ai, i.ai_verdict, i.ai_confidence, i.ai_categories);
+    const action = el('td', 'py-2 pr-4', i.action);
+    action.dataset.col = 'action';
+    row.append(ai, action);
+
+    const detailsRow = el('tr', 'bg-slate-50');
+    const cell = el('td', 'p-3');
+    cell.colSpan = 6;
+    const details = el('details');
+    details.dataset.loaded = '1';
+    details.append(el('summary', 'cursor-pointer text-slate-700', 'Details & Mitigation Script'));
+    const grid = el('div', 'grid md:grid-cols-2 gap-3 mt-2');
+    for (const [label, field] of [['Surface', 'surface'], ['Mitigation', 'mitigation_script']]) {
+      const pre = el('pre', 'bg-white border rounded-xl p-3 overflow-x-auto');
+      const value = el('span', '', i[field] || '');
+      value.dataset.field = field;
+      pre.append(el('strong', '', label), '\\n', value);
+      grid.append(pre);
+    }
+    details.append(grid);
+    cell.append(details);
+    detailsRow.append(cell);
+
+    incidents.prepend(row, detailsRow);
+    while (incidents.rows.length > pageSize * 2) incidents.lastElementChild.remove();
+  };
+
+  const updateIncident = ({ ref, fields }) => {
+    const row = findRow(ref);
+    if (!row) return;
+    if ('ai_verdict' in fields) {
+      fillAi(row.querySelector('[data-col="ai"]'), fields.ai_verdict, fields.ai_confidence, fields.ai_categories);
+    }
+    if ('action' in fields) row.querySelector('[data-col="action"]').textContent = fields.action;
+    const details = row.nextElementSibling;
+    if ('mitigation_script' in fields && details && details.querySelector('[data-loaded]')) {
+      details.querySelector('[data-field="mitigation_script"]').textContent = fields.mitigation_script;
+    }
+  };
+
+  const setBlocked = (ip, blocked) => {
+    if (!blocklistEl) return;
+    const existing = blocklistEl.querySelector(`li[data-ip="${CSS.escape(ip)}"]`);
+    if (!blocked) {
+      if (existing) existing.remove();
+      if (!blocklistEl.children.length) {
+        const empty = el('li', 'text-slate-500', 'No IPs blocked.');
+        empty.dataset.empty = '';
+        blocklistEl.append(empty);
+      }
+      return;
+    }
+    if (existing) return;
+    blocklistEl.querySelectorAll('[data-empty]').forEach((n) => n.remove());
+    const li = el('li', 'flex items-center justify-between');
+    li.dataset.ip = ip;
+    const form = el('form');
+    form.method = 'post';
+    form.action = `/dashboard/unblock/${ip}`;
+    form.append(el('button', 'text-xs px-2 py-1 rounded bg-emerald-600 text-white', 'Unblock'));
+    li.append(el('span', 'font-mono', ip), form);
+    blocklistEl.prepend(li);
+  };
+
+  const source = new EventSource(`/dashboard/stream?last_id=${incidents.dataset.lastEvent}`);
+  source.addEventListener('incident', (e) => addIncident(JSON.parse(e.data)));
+  source.addEventListener('update', (e) => updateIncident(JSON.parse(e.data)));
+  source.addEventListener('block', (e) => setBlocked(JSON.parse(e.data).ip, true));
+  source.addEventListener('unblock', (e) => setBlocked(JSON.parse(e.data).ip, false));
+  source.addEventListener('reset', () => window.location.reload());
+  if (status) {
+    source.onopen = () => { status.textContent = '● live'; };
+    source.onerror = () => { status.textContent = '○ reconnecting'; };
+  }
+}
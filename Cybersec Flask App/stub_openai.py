@@ -0,0 +1,150 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Answers AIGuard prompts (single and batched) with verdicts derived from the
+heuristic detectors, and anything else (mitigation prompts) with a short
+script. Used by test.py and the benchmarks; point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 and any OPENAI_API_KEY.
+
+    python stub_openai.py --port 8099 --delay 0.5
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from detectors import heuristic_assess
+
+
+def _verdict(features):
+    heur = heuristic_assess(features.get('surface', ''), features.get('headers', {}).get('User-Agent', ''))
+    malicious = heur['score'] >= 0.35
+    return {
+        'verdict': 'MALICIOUS' if malicious else 'BENIGN',
+        'confidence': 0.9 if malicious else 0.8,
+        'categories': heur['hits'],
+        'explanation': 'stub verdict from heuristic signatures',
+    }
+
+
+def _answer(messages):
+    user = messages[-1]['content']
+    for marker in ('RequestFeaturesBatch:\n', 'RequestFeatures:\n'):
+        if marker in user:
+            payload = json.loads(user.split(marker, 1)[1])
+            if isinstance(payload, list):
+                return json.dumps({'results': [dict(_verdict(f), id=f.get('id')) for f in payload]})
+            return json.dumps(_verdict(payload))
+    return "#!/usr/bin/env bash\n# stub mitigation script\niptables -I INPUT -s \"$IP\" -j DROP\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            server.items.append(body)
+        if server.delay:
+            time.sleep(server.delay)
+        if server.fail:
+            self.send_response(500)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"error": {"message": "stub failure"}}')
+            return
+        content = _answer(body.get('messages', []))
+        resp = json.dumps({
+            'id': f'chatcmpl-stub-{server.calls}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The benchmarks open up to thousands of connections at once
+    request_queue_size = 1024
+
+
+class StubOpenAI:
+    """Threaded stub server; use as a context manager.
+
+    `calls` counts completions requests, `delay` adds upstream latency and
+    `fail` makes every request return HTTP 500.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        self.server = _Server((host, port), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.calls = 0
+        self.server.items = []
+        self.server.delay = delay
+        self.server.fail = False
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    @property
+    def delay(self):
+        return self.server.delay
+
+    @delay.setter
+    def delay(self, value):
+        self.server.delay = value
+
+    @property
+    def fail(self):
+        return self.server.fail
+
+    @fail.setter
+    def fail(self, value):
+        self.server.fail = value
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    stub = StubOpenAI(port=args.port, delay=args.delay)
+    print(f"Stub OpenAI listening on {stub.base_url}")
+    stub.server.serve_forever()
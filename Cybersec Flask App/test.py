@@ -0,0 +1,952 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from datetime import datetime
+
+from flask import Flask, request
+
+from ai_guard import AIGuard, fingerprint
+from blocklist import Blocklist
+from breaker import CircuitBreaker
+from cache import TTLCache
+from detectors import DEFAULT_RULE_PACK, SignatureEngine, scan_request
+from events import EventBus, format_sse
+from firewall import MitigationGenerator, ScriptCache, incident_signature
+from incident_log import INCIDENT_COLUMNS, INSERT_SQL, ROLLUP_SCHEMA, IncidentWriter, apply_rollups
+from local_model import LocalModel, LocalGuard, load_examples
+from metrics import Metrics, _count, _value
+from pipeline import AIPipeline
+from profiler import BehaviorProfiler
+from rate_limit import TokenBucketLimiter, GCRALimiter, SlidingWindowLimiter
+from retention import IncidentArchive, Compactor
+from rule_packs import RulePackStore
+from shared_state import SqliteTokenBucketLimiter
+from singleflight import AsyncSingleFlight, SingleFlight
+from stub_openai import StubOpenAI
+
+
+def features(i, payload):
+    return {
+        'ip': f'198.51.100.{i % 250}',
+        'method': 'GET',
+        'path': '/echo',
+        'query': {'msg': [payload]},
+        'headers': {'User-Agent': 'Mozilla/5.0'},
+        'body_len': 0,
+        'surface': f"method=GET\npath=/echo\nquery=msg={payload}\nip=198.51.100.{i % 250}\nua=Mozilla/5.0",
+    }
+
+
+# app.py builds its singletons on import; point them at a scratch database
+APP_DIR = tempfile.TemporaryDirectory()
+
+
+def load_app():
+    if 'app' not in sys.modules:
+        os.environ['INCIDENT_DB_PATH'] = os.path.join(APP_DIR.name, 'incidents.db')
+        os.environ['INCIDENT_COMPACT_SECONDS'] = '0'
+    import app
+    return app
+
+
+class StubAI:
+    """Stands in for app.ai_guard and app.mitigator; every call waits for
+    `release` so tests can look at the request before the AI answers."""
+
+    def __init__(self, verdict='MALICIOUS'):
+        self.verdict = verdict
+        self.release = threading.Event()
+
+    def classify(self, features, deadline=None):
+        self.release.wait(5)
+        return {'verdict': self.verdict, 'confidence': 0.99, 'categories': ['XSS'], 'explanation': 'stub'}
+
+    def should_block(self, ai_result):
+        return ai_result['verdict'] == 'MALICIOUS'
+
+    def generate(self, incident, deadline=None):
+        self.release.wait(5)
+        return f"# block {incident['ip']}"
+
+    async def classify_async(self, features, deadline=None):
+        return self.classify(features, deadline)
+
+    async def generate_async(self, incident, deadline=None):
+        return self.generate(incident, deadline)
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        # Switch threads as often as possible to provoke lost updates.
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def hammer(self, limiter, key, threads=32, calls=200):
+        limiters = limiter if isinstance(limiter, list) else [limiter]
+        admitted = []
+        barrier = threading.Barrier(threads)
+
+        def worker(limiter):
+            barrier.wait()
+            n = sum(limiter.allow(key) for _ in range(calls))
+            admitted.append(n)
+
+        pool = [threading.Thread(target=worker, args=(limiters[i % len(limiters)],)) for i in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        return sum(admitted)
+
+    def test_concurrent_single_key_admits_exactly_burst(self):
+        for shards in (1, 16):
+            limiter = TokenBucketLimiter(per_minute=0, burst=25, shards=shards)
+            self.assertEqual(self.hammer(limiter, '203.0.113.7'), 25)
+
+    def test_alternative_engines_admit_exactly_their_budget(self):
+        # Negligible refill over the test's lifetime.
+        self.assertEqual(self.hammer(GCRALimiter(per_minute=1e-6, burst=25), 'k'), 25)
+        self.assertEqual(self.hammer(SlidingWindowLimiter(per_minute=25), 'k'), 25)
+
+    def test_shared_limiter_leases_without_overspending(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'state.db')
+        # Two "workers" on one file
+        workers = [SqliteTokenBucketLimiter(path, per_minute=0, burst=25, lease=4) for _ in range(2)]
+        self.assertEqual(self.hammer(workers, '203.0.113.7', threads=8, calls=50), 25)
+        # Leases and local denials keep almost every call off the file
+        self.assertLess(sum(w.shared_calls for w in workers), 50)  # of 400
+
+    def test_keys_are_independent(self):
+        limiter = TokenBucketLimiter(per_minute=0, burst=3, shards=4)
+        self.assertEqual([limiter.allow('a') for _ in range(4)], [True, True, True, False])
+        self.assertTrue(limiter.allow('b'))
+
+    def test_memory_is_capped(self):
+        limiter = TokenBucketLimiter(per_minute=0, burst=1, max_keys=64, shards=4)
+        for i in range(10_000):
+            limiter.allow(f"10.0.{i >> 8}.{i & 255}")
+        self.assertLessEqual(len(limiter), 64)
+        self.assertGreater(limiter.evicted, 0)
+
+
+
+class BlocklistTest(unittest.TestCase):
+
+    def test_longest_prefix_match(self):
+        bl = Blocklist()
+        bl.block('10.0.0.0/8', 60)
+        bl.block('10.1.2.0/24', 60)
+        bl.block('2001:db8::/32', 60)
+        self.assertEqual(bl.match('10.1.2.3'), '10.1.2.0/24')
+        self.assertEqual(bl.match('10.9.9.9'), '10.0.0.0/8')
+        self.assertTrue(bl.is_blocked('2001:DB8:0::1'))
+        self.assertFalse(bl.is_blocked('11.0.0.1'))
+        bl.unblock('10.1.2.0/24')
+        self.assertEqual(bl.match('10.1.2.3'), '10.0.0.0/8')
+
+    def test_entries_expire_without_lookups(self):
+        bl = Blocklist()
+        for i in range(100):
+            bl.block(f'192.0.2.{i}', 0.05)
+        bl.block('198.51.100.0/24', 0.05)
+        time.sleep(0.1)
+        bl.block('203.0.113.1', 60)  # any write drains the expiry heap
+        self.assertEqual(len(bl), 1)
+        self.assertEqual([ip for ip, _ in bl.items()], ['203.0.113.1'])
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_scans_and_brute_force_score_while_browsing_does_not(self):
+        profiler = BehaviorProfiler(scan_paths=50, auth_failures=20)
+
+        def run(ip, paths, status):
+            for path in paths:
+                result = profiler.observe(ip, path)
+                profiler.record_status(ip, status)
+            return result
+
+        browse = run('198.51.100.7', [f'/page/{i % 10}' for i in range(200)], 200)
+        self.assertLess(browse['score'], 0.8)
+        self.assertNotIn('SCANNER', browse['hits'])
+        scan = run('203.0.113.5', [f'/admin{i}.php' for i in range(80)], 404)
+        self.assertGreaterEqual(scan['score'], 0.8)
+        self.assertIn('SCANNER', scan['hits'])
+        brute = run('203.0.113.6', ['/login'] * 25, 401)
+        self.assertIn('AUTH_BRUTE_FORCE', brute['hits'])
+        # A scan spread thinly over a /24 is caught on the network profile,
+        # when that is enabled
+        profiler.network_scale = 4.0
+        for i in range(250):
+            spread = run(f'192.0.2.{i}', [f'/x{i}a', f'/x{i}b'], 404)
+        self.assertIn('SCANNER_NETWORK', spread['hits'])
+
+    def test_slow_benign_network_traffic_never_blocks(self):
+        now = [0.0]
+        profiler = BehaviorProfiler(network_scale=4.0, clock=lambda: now[0])
+        # A /24 browsing and mistyping passwords for 13 hours
+        for i in range(380):
+            now[0] += 13 * 3600 / 380
+            ip = f'10.1.2.{i % 40}'
+            if i % 19 < 4:
+                result = profiler.observe(ip, '/login')
+                profiler.record_status(ip, 401)
+            else:
+                result = profiler.observe(ip, f'/page/{i}')
+                profiler.record_status(ip, 200)
+            self.assertLess(result['score'], 0.8)
+        self.assertLess(profiler.observe('10.1.2.99', '/')['score'], 0.8)
+        # The same traffic in one burst is still caught on the /24
+        for i in range(80):
+            profiler.observe(f'10.1.2.{i % 40}', '/login')
+            profiler.record_status(f'10.1.2.{i % 40}', 401)
+        self.assertIn('AUTH_BRUTE_FORCE_NETWORK', profiler.observe('10.1.2.99', '/')['hits'])
+
+    def test_memory_is_capped(self):
+        profiler = BehaviorProfiler(max_profiles=64, shards=4)
+        for i in range(5000):
+            profiler.observe(f'2001:db8::{i:x}', '/')
+        self.assertLessEqual(len(profiler), 64)
+        self.assertGreater(profiler.stats()['evicted'], 0)
+
+
+class AsyncGuardTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.core = load_app()
+
+    def setUp(self):
+        self.ai = StubAI()
+        self.pipeline = AIPipeline(max_workers=2, max_pending=8)
+        self.addCleanup(self.pipeline.shutdown)
+        self.addCleanup(self.ai.release.set)
+        for name, value in (('ai_guard', self.ai), ('mitigator', self.ai), ('pipeline', self.pipeline),
+                            ('blocklist', Blocklist()), ('limiter', TokenBucketLimiter(6000, 1000)),
+                            ('profiler', None)):
+            patcher = mock.patch.object(self.core, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.core.app.test_client()
+
+    def get(self, url, ip):
+        return self.client.get(url, headers={'X-Forwarded-For': ip})
+
+    def incident(self, ip):
+        """Latest incident for `ip`, once the pipeline and writer are idle."""
+        while self.core.pipeline.pending:
+            time.sleep(0.001)
+        self.core.incident_writer.flush()
+        with sqlite3.connect(self.core.DB_PATH) as db:
+            db.row_factory = sqlite3.Row
+            return db.execute("SELECT * FROM incidents WHERE ip = ? ORDER BY id DESC", (ip,)).fetchone()
+
+    def test_pipeline_rejects_jobs_past_max_pending(self):
+        pipeline = AIPipeline(max_workers=1, max_pending=2)
+        release = threading.Event()
+        self.assertTrue(pipeline.submit(release.wait))
+        self.assertTrue(pipeline.submit(lambda: 1 / 0))
+        self.assertFalse(pipeline.submit(release.wait))
+        release.set()
+        pipeline.shutdown()
+        self.assertEqual(pipeline.stats(), {'pending': 0, 'submitted': 2, 'rejected': 1, 'failed': 1})
+
+    def test_allowed_request_returns_before_verdict_and_is_blocked_after(self):
+        ip = '198.51.100.20'
+        response = self.get('/?force_ai=1', ip)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.ai.release.is_set())
+        self.assertFalse(self.core.is_blocked(ip))
+        self.ai.release.set()
+        row = self.incident(ip)
+        self.assertEqual((row['ai_verdict'], row['action'], row['mitigation_script']),
+                         ('MALICIOUS', 'blocked', f'# block {ip}'))
+        self.assertTrue(self.core.is_blocked(ip))
+        self.assertEqual(self.get('/', ip).status_code, 302)
+
+    def test_benign_verdict_leaves_request_allowed(self):
+        self.ai.verdict = 'BENIGN'
+        self.ai.release.set()
+        ip = '198.51.100.21'
+        self.get('/?force_ai=1', ip)
+        row = self.incident(ip)
+        self.assertEqual((row['ai_verdict'], row['action'], row['mitigation_script']), ('BENIGN', 'allowed', ''))
+        self.assertFalse(self.core.is_blocked(ip))
+
+    def test_full_queue_falls_back_to_heuristics(self):
+        self.core.pipeline = AIPipeline(max_workers=1, max_pending=1)
+        self.addCleanup(self.core.pipeline.shutdown)
+        self.core.pipeline.submit(self.ai.release.wait)
+        ip = '198.51.100.22'
+        response = self.get('/?q=<script>alert(1)</script>&r=../../etc/passwd&s=1 UNION SELECT 2', ip)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.core.is_blocked(ip))
+        self.ai.release.set()
+        row = self.incident(ip)
+        self.assertEqual((row['ai_verdict'], row['ai_explanation'], row['mitigation_script']),
+                         ('UNKNOWN', 'AI queue full; decided by heuristics only.', '(auto) temporary IP block'))
+
+    def test_behavior_block_generates_script_in_background(self):
+        profiler = mock.Mock()
+        profiler.observe.return_value = {'score': 1.0, 'hits': ['SCANNER'], 'paths': 80,
+                                         'not_found': 80, 'auth_failures': 0, 'rate': 1.0}
+        self.core.profiler = profiler
+        ip = '198.51.100.23'
+        self.assertEqual(self.get('/', ip).status_code, 302)
+        self.assertFalse(self.ai.release.is_set())
+        self.core.incident_writer.flush()
+        with sqlite3.connect(self.core.DB_PATH) as db:
+            pending = db.execute("SELECT mitigation_script FROM incidents WHERE ip = ?", (ip,)).fetchone()
+        self.assertEqual(pending, ('(pending)',))
+        self.ai.release.set()
+        row = self.incident(ip)
+        self.assertEqual((row['action'], row['mitigation_script']), ('blocked', f'# block {ip}'))
+
+
+class AsgiGuardTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.core = load_app()
+        import asgi_guard
+        cls.asgi = asgi_guard
+        cls.app = asgi_guard.GuardMiddleware(asgi_guard.WsgiToAsgi(cls.core.app, threads=4))
+        echo = Flask(__name__)
+        echo.add_url_rule('/echo', 'echo', lambda: request.get_data(), methods=['POST'])
+        cls.echo = asgi_guard.GuardMiddleware(asgi_guard.WsgiToAsgi(echo, threads=4))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.inner.executor.shutdown()
+        cls.echo.inner.executor.shutdown()
+
+    def setUp(self):
+        ai = StubAI()
+        ai.release.set()
+        self.limiter = mock.Mock(wraps=TokenBucketLimiter(6000, 1000))
+        for name, value in (('ai_guard', ai), ('mitigator', ai), ('blocklist', Blocklist()),
+                            ('limiter', self.limiter), ('profiler', None)):
+            patcher = mock.patch.object(self.core, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def call(app, path, query=b'', headers=(), body=(b'',), method='GET', ip='198.51.100.40'):
+        """Run one request through `app`; (status, headers, body)."""
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': query,
+            'headers': [(b'x-forwarded-for', ip.encode())] + list(headers),
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+            'http_version': '1.1', 'scheme': 'http',
+        }
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body) - 1}
+                    for i, chunk in enumerate(body)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(app(scope, receive, send))
+        return sent[0]['status'], dict(sent[0]['headers']), b''.join(m.get('body', b'') for m in sent[1:])
+
+    def test_blocked_ip_and_attack_are_redirected(self):
+        self.core.block_ip('198.51.100.41')
+        status, headers, _ = self.call(self.app, '/', ip='198.51.100.41')
+        self.assertEqual((status, headers[b'location']), (302, b'/blocked'))
+        query = b'q=<script>alert(1)</script>&r=../../etc/passwd&s=1%20UNION%20SELECT%202'
+        status, headers, _ = self.call(self.app, '/', query)
+        self.assertEqual((status, headers[b'location']), (302, b'/blocked'))
+        self.assertTrue(self.core.is_blocked('198.51.100.40'))
+
+    def test_malformed_content_length_is_rejected(self):
+        for value in (b'+5', b'1_0', b' 5'):
+            status, _, body = self.call(self.echo, '/echo', headers=[(b'content-length', value)],
+                                        body=(b'hello',), method='POST')
+            self.assertEqual((status, body), (400, b'Bad Request'), value)
+
+    def test_scanned_body_is_replayed_to_the_app(self):
+        payload = b'a=' + b'x' * 100_000 + b'&b=benign'
+        chunks = tuple(payload[i:i + 4096] for i in range(0, len(payload), 4096))
+        status, _, body = self.call(
+            self.echo, '/echo', method='POST', body=chunks,
+            headers=[(b'content-length', str(len(payload)).encode()),
+                     (b'content-type', b'application/x-www-form-urlencoded')])
+        self.assertEqual((status, body), (200, payload))
+
+    def test_guarded_request_skips_the_flask_guard(self):
+        status, _, _ = self.call(self.app, '/echo', b'msg=hi')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.limiter.allow.call_count, 1)
+
+    def test_safe_paths_pass_unscreened(self):
+        self.core.block_ip('198.51.100.42')
+        status, _, _ = self.call(self.app, '/blocked', b'q=<script>alert(1)</script>', ip='198.51.100.42')
+        self.assertEqual(status, 200)
+        self.limiter.allow.assert_not_called()
+
+
+class LocalModelTest(unittest.TestCase):
+
+    def test_learns_verdicts_and_escalates_when_unsure(self):
+        attacks = ["' or 1=1 --", "union select password from users", "<script>alert(1)</script>",
+                   "../../etc/passwd", "; cat /etc/shadow"]
+        benign = ["hello world", "shoes size 42", "contact us", "weather today", "order history"]
+        surfaces = [f"method=GET\npath=/q\nquery=q={q}\nip=10.0.0.{i}" for i, q in enumerate(attacks + benign)]
+        labels = [1] * len(attacks) + [0] * len(benign)
+        guard = LocalGuard(LocalModel.train(surfaces, labels, bits=14), low=0.2, high=0.8)
+        for surface, label in zip(surfaces, labels):
+            verdict = guard.classify(surface)
+            self.assertIsNotNone(verdict)
+            self.assertEqual(verdict['verdict'], 'MALICIOUS' if label else 'BENIGN')
+        self.assertIsNone(LocalGuard(guard.model, low=0.0, high=1.0).classify(surfaces[0]))
+
+
+class SignatureEngineTest(unittest.TestCase):
+
+    # The single-regex-per-category matcher the rule pack replaced
+    OLD_CATEGORIES = {
+        'SQLI': re.compile(r"(\bOR\b|\bAND\b).*?=|\bUNION\b|--|#|/\*|\bSELECT\b|\bDROP\b|\bINSERT\b|\bUPDATE\b", re.I),
+        'XSS': re.compile(r"<\s*script|onerror\s*=|onload\s*=|javascript:\\S|<\s*img|<\s*svg|<\s*iframe", re.I),
+        'LFI': re.compile(r"\.\./|\.\.\\|/etc/passwd|\\boot\.ini", re.I),
+        'RCE': re.compile(r"(;|\|\||&&)\s*(cat|ls|id|uname|curl|wget|sh|bash)\b|`[^`]+`|\$\([^\)]+\)", re.I),
+        'SSRF': re.compile(r"https?://(127\.0\.0\.1|0\.0\.0\.0|localhost|169\.254\.169\.254|\[::1\])", re.I),
+    }
+    OLD_SCANNER_UA = re.compile(r"sqlmap|nikto|nmap|curl|wget|acunetix|nessus", re.I)
+
+    FRAGMENTS = ['or', 'AND', ' ', '=', 'union', '--', '#', '/*', 'select', 'drop', 'insert',
+                 'update', '<', 'script', 'onerror', 'onload', 'javascript:', '\\s', 'img',
+                 'svg', 'iframe', '../', '..\\', '/etc/passwd', '\\boot.ini', ';', '||', '&&',
+                 'cat', 'ls', 'id', 'uname', 'curl', 'wget', 'sh', 'bash', '`', '$(', ')',
+                 'http://', 'https://', '127.0.0.1', 'localhost', '169.254.169.254', '[::1]',
+                 '0.0.0.0', 'x', '\n', '_', '9', 'Or1', 'ORDER']
+
+    def old_assess(self, surface, user_agent):
+        hits = [name for name, pattern in self.OLD_CATEGORIES.items() if pattern.search(surface)]
+        score = 0.35 * len(hits)
+        if self.OLD_SCANNER_UA.search(user_agent):
+            hits.append('SCANNER')
+            score += 0.3
+        return {'score': min(1.0, score), 'hits': hits}
+
+    def test_matches_the_old_patterns(self):
+        engine = SignatureEngine.from_file(DEFAULT_RULE_PACK)
+        rng = random.Random(0)
+        for _ in range(20000):
+            surface = ''.join(rng.choice(self.FRAGMENTS) for _ in range(rng.randint(1, 8)))
+            user_agent = ' '.join(rng.choice(['Mozilla/5.0', 'sqlmap', 'Nikto', 'curl', '-'])
+                                  for _ in range(2))
+            expected = self.old_assess(surface, user_agent)
+            got = engine.assess(surface, user_agent)
+            self.assertEqual(got['hits'], expected['hits'], repr(surface))
+            self.assertAlmostEqual(got['score'], expected['score'], msg=repr(surface))
+
+    def test_crafted_inputs_take_linear_time(self):
+        engine = SignatureEngine.from_file(DEFAULT_RULE_PACK)
+        for surface in ("select" + " x" * 20000, "=" * 40000, "or x" * 10000, "`" * 40000):
+            start = time.perf_counter()
+            engine.assess(surface, '-')
+            self.assertLess(time.perf_counter() - start, 0.25, surface[:12])
+
+
+class SurfaceScanTest(unittest.TestCase):
+
+    def scan(self, body, content_type, chunk_size=7, max_body=1 << 20):
+        app = Flask(__name__)
+        with app.test_request_context('/', method='POST', data=body, content_type=content_type):
+            surface, heur = scan_request(request, max_body=max_body, chunk_size=chunk_size)
+            return surface, heur, request.get_data()
+
+    def test_large_body_is_scanned_and_replayed(self):
+        body = b'a=' + b'x' * 100_000 + b'&q=%27%20OR%201%3D1%20--'
+        surface, heur, replayed = self.scan(body, 'application/x-www-form-urlencoded')
+        self.assertIn('SQLI', heur['hits'])
+        self.assertEqual(replayed, body)
+        self.assertLess(len(surface), 5000)
+
+    def test_json_escapes_are_decoded_across_chunks(self):
+        body = b'{"x": "\\u003cscript\\u003ealert(1)\\u003c/script\\u003e"}'
+        for chunk_size in (1, 5, 64):
+            _, heur, _ = self.scan(body, 'application/json', chunk_size)
+            self.assertIn('XSS', heur['hits'])
+
+    def test_scan_stops_at_cap(self):
+        body = b'x' * 10_000 + b'../../../etc/passwd'
+        _, heur, replayed = self.scan(body, 'text/plain', 1024, max_body=4096)
+        self.assertEqual(heur['hits'], [])
+        self.assertEqual(replayed, body)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_concurrent_counts_render_exactly(self):
+        metrics = Metrics()
+        requests = metrics.counter('requests_total', 'Requests.', 'outcome')
+        latency = metrics.histogram('guard_seconds', 'Guard latency.')
+
+        def worker():
+            for i in range(1000):
+                requests.inc('blocked' if i % 4 == 0 else 'allowed')
+                latency.observe_ns(1500 + i)
+
+        pool = [threading.Thread(target=worker) for _ in range(8)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        text = metrics.render()
+        self.assertIn('aiguard_requests_total{outcome="allowed"} 6000\n', text)
+        self.assertIn('aiguard_requests_total{outcome="blocked"} 2000\n', text)
+        self.assertIn('aiguard_guard_seconds_count 8000\n', text)
+
+
+    def test_counter_position_is_read_from_repr(self):
+        counter = _count()
+        for _ in range(3):
+            next(counter)
+        self.assertEqual(repr(counter), 'count(3)')
+        self.assertEqual(_value(counter), 3)
+        self.assertEqual(_value(itertools.count(2**70)), 2**70)
+        with self.assertRaises(ValueError):
+            _value(itertools.count(0, 2))
+
+class RulePackTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'pack.json')
+        with open(DEFAULT_RULE_PACK) as f:
+            self.pack = json.load(f)
+        self.write(self.pack, mtime_ns=1_000_000_000)
+
+    def write(self, pack, mtime_ns):
+        with open(self.path, 'w') as f:
+            json.dump(pack, f)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_reloads_on_content_change_only(self):
+        store = RulePackStore(self.path, check_interval=0)
+        engine = store.current()
+        self.assertEqual(store.reloads, 1)
+        # Touched but identical: re-read, not recompiled
+        os.utime(self.path, ns=(2_000_000_000, 2_000_000_000))
+        self.assertIs(store.current(), engine)
+        self.assertEqual(store.reloads, 1)
+        self.write(dict(self.pack, version='next'), mtime_ns=3_000_000_000)
+        self.assertEqual(store.current().version, 'next')
+        self.assertEqual(store.reloads, 2)
+
+    def test_broken_pack_keeps_previous_engine(self):
+        store = RulePackStore(self.path, check_interval=0)
+        engine = store.current()
+        with open(self.path, 'w') as f:
+            f.write('{"categories": ')
+        os.utime(self.path, ns=(2_000_000_000, 2_000_000_000))
+        self.assertIs(store.current(), engine)
+        self.assertIsNotNone(store.last_error)
+        self.assertEqual(engine.assess("q=<script>alert(1)</script>", '-')['hits'], ['XSS'])
+
+
+class IncidentWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'incidents.db')
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(self.db.close)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"CREATE TABLE incidents (id INTEGER PRIMARY KEY, {', '.join(INCIDENT_COLUMNS)})")
+        self.db.executescript(ROLLUP_SCHEMA)
+
+    def writer(self, **kwargs):
+        writer = IncidentWriter(self.path, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    @staticmethod
+    def row(i, action='allowed'):
+        row = dict.fromkeys(INCIDENT_COLUMNS, '')
+        return tuple(dict(row, ts='2026-01-01T10:00:00', ip=f'198.51.100.{i % 2}',
+                          action=action, ref=f'r{i}').values())
+
+    def stall(self, writer):
+        """Hold the database lock until the writer thread is stuck on its
+        first insert, so later inserts pile up in the queue."""
+        self.db.execute("BEGIN EXCLUSIVE")
+        writer.insert(self.row(0))
+        while writer.stats()['queued']:
+            time.sleep(0.001)
+
+    def test_flush_commits_inserts_updates_and_rollups(self):
+        writer = self.writer()
+        for i in range(10):
+            writer.insert(self.row(i))
+        writer.update('r3', {'action': 'blocked', 'ignored': 'x'})
+        writer.flush()
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM incidents").fetchone()[0], 10)
+        self.assertEqual(self.db.execute("SELECT action FROM incidents WHERE ref = 'r3'").fetchone()[0], 'blocked')
+        self.assertEqual(self.db.execute("SELECT SUM(incidents), SUM(blocked) FROM rollup_ip").fetchone(), (10, 1))
+        self.assertEqual(writer.stats()['written'], 10)
+
+    def test_bad_row_does_not_stop_the_writer(self):
+        writer = self.writer()
+        bad = list(self.row(0))
+        bad[INCIDENT_COLUMNS.index('ts')] = None
+        writer.insert(tuple(bad))
+        writer.flush()
+        writer.insert(self.row(1))
+        flushed = threading.Thread(target=writer.flush, daemon=True)
+        flushed.start()
+        flushed.join(5)
+        self.assertFalse(flushed.is_alive())
+        self.assertEqual(self.db.execute("SELECT ref FROM incidents").fetchall(), [('r1',)])
+
+    def test_full_queue_drops_inserts(self):
+        writer = self.writer(batch_size=1, max_queue=4)
+        self.stall(writer)
+        for i in range(1, 11):
+            writer.insert(self.row(i))
+        self.db.execute("COMMIT")
+        writer.flush()
+        self.assertEqual((writer.written, writer.dropped), (5, 6))
+
+    def test_sampling_thins_inserts_past_high_water(self):
+        writer = self.writer(batch_size=1, max_queue=8, overflow='sample', sample_rate=0.5)
+        self.stall(writer)
+        # 6 fill the queue to its high-water mark; of the next 6 every
+        # second is offered, and the last of those no longer fits
+        for i in range(1, 13):
+            writer.insert(self.row(i))
+        self.db.execute("COMMIT")
+        writer.flush()
+        self.assertEqual((writer.written, writer.sampled_out, writer.dropped), (9, 3, 1))
+
+
+class EventBusTest(unittest.TestCase):
+
+    def test_resume_from_last_event_id(self):
+        bus = EventBus(size=3)
+        for i in range(5):
+            bus.publish('incident', {'n': i})
+        self.assertEqual([e[0] for e in bus.since(3)], [4, 5])
+        self.assertEqual(bus.since(5), [])
+        # Ids 2 and 3 already fell out of the ring, or came from before a restart
+        self.assertIsNone(bus.since(1))
+        self.assertIsNone(bus.since(9))
+        self.assertEqual(format_sse(*bus.since(4)[0]), 'id: 5\nevent: incident\ndata: {"n": 4}\n\n')
+
+    def test_wait_wakes_on_publish(self):
+        bus = EventBus()
+        self.assertEqual(bus.wait(0, timeout=0.01), [])
+        threading.Timer(0.05, bus.publish, ('block', {'ip': '203.0.113.1'})).start()
+        t0 = time.monotonic()
+        self.assertEqual([e[:2] for e in bus.wait(0, timeout=5)], [(1, 'block')])
+        self.assertLess(time.monotonic() - t0, 1)
+
+
+class RetentionTest(unittest.TestCase):
+
+    def test_old_incidents_are_archived_compressed_and_expired(self):
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'incidents.db')
+        db = sqlite3.connect(path)
+        db.execute(f"CREATE TABLE incidents (id INTEGER PRIMARY KEY, {', '.join(INCIDENT_COLUMNS)})")
+        db.executescript(ROLLUP_SCHEMA)
+        script = 'iptables -I INPUT -s "$IP" -j DROP'
+        row = dict.fromkeys(INCIDENT_COLUMNS, '')
+        for i, ts in enumerate(['2026-01-01T10:00:00', '2026-01-02T10:00:00',
+                                '2026-01-02T11:00:00', '2026-01-03T09:00:00']):
+            db.execute(INSERT_SQL, tuple(dict(row, ts=ts, surface=f'q=<script>{i}', mitigation_script=script).values()))
+        db.commit()
+
+        archive = IncidentArchive(os.path.join(tmp.name, 'archive'))
+        compactor = Compactor(path, archive, hot_hours=12, retention_days=1, batch_size=2)
+        report = compactor.run_once(now=datetime(2026, 1, 3, 12))
+        self.assertEqual(report['moved'], 3)
+        self.assertEqual(report['dropped_days'], ['2026-01-01'])
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM incidents").fetchone()[0], 1)
+        self.assertEqual(archive.days(), ['2026-01-02'])
+        self.assertEqual(compactor.scripts_stored, 2)  # one per archive day
+        restored = archive.get(3)
+        self.assertEqual((restored['surface'], restored['mitigation_script']), ('q=<script>2', script))
+        self.assertIsNone(archive.get(1))
+        db.close()
+
+    def test_training_examples_include_archived_days(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'incidents.db')
+        db = sqlite3.connect(path)
+        self.addCleanup(db.close)
+        db.execute(f"CREATE TABLE incidents (id INTEGER PRIMARY KEY, {', '.join(INCIDENT_COLUMNS)})")
+        db.executescript(ROLLUP_SCHEMA)
+        row = dict.fromkeys(INCIDENT_COLUMNS, '')
+        for ts, surface, verdict, explanation in [
+                ('2026-01-01T10:00:00', 'q=<script>', 'MALICIOUS', ''),
+                ('2026-01-02T10:00:00', 'q=hello', 'BENIGN', ''),
+                ('2026-01-02T11:00:00', 'q=maybe', 'MALICIOUS', 'Local model (p=0.95).'),
+                ('2026-01-03T11:00:00', '(rate limit exceeded)', 'MALICIOUS', ''),
+                ('2026-01-03T11:30:00', 'q=../etc/passwd', 'MALICIOUS', '')]:
+            db.execute(INSERT_SQL, tuple(dict(row, ts=ts, surface=surface, ai_verdict=verdict,
+                                              ai_confidence=0.9, ai_explanation=explanation).values()))
+        db.commit()
+        Compactor(path, IncidentArchive(os.path.join(tmp.name, 'archive')),
+                  hot_hours=12, retention_days=0).run_once(now=datetime(2026, 1, 3, 12))
+        self.assertEqual(sorted(load_examples(path)),
+                         [('q=../etc/passwd', 1), ('q=<script>', 1), ('q=hello', 0)])
+        self.assertEqual(load_examples(path, archive_dir=''), [('q=../etc/passwd', 1)])
+
+    def test_ip_rollup_is_capped_and_expired(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'incidents.db')
+        db = sqlite3.connect(path)
+        self.addCleanup(db.close)
+        db.execute(f"CREATE TABLE incidents (id INTEGER PRIMARY KEY, {', '.join(INCIDENT_COLUMNS)})")
+        db.executescript(ROLLUP_SCHEMA)
+        row = dict.fromkeys(INCIDENT_COLUMNS, '')
+        # One spoofed address per incident, a stale one, and a persistent attacker
+        rows = [dict(row, ts='2026-01-03T10:00:00', ip=f'10.0.{i >> 8}.{i & 255}') for i in range(500)]
+        rows.append(dict(row, ts='2025-11-01T10:00:00', ip='192.0.2.1'))
+        rows += [dict(row, ts='2026-01-03T11:00:00', ip='203.0.113.9')] * 3
+        with db:
+            apply_rollups(db, [tuple(r.values()) for r in rows])
+
+        compactor = Compactor(path, IncidentArchive(os.path.join(tmp.name, 'archive')),
+                              retention_days=30, max_rollup_ips=100)
+        self.assertEqual(compactor.run_once(now=datetime(2026, 1, 3, 12))['rollup_ips_pruned'], 402)
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM rollup_ip").fetchone()[0], 100)
+        self.assertEqual(db.execute("SELECT ip FROM rollup_ip ORDER BY incidents DESC LIMIT 1").fetchone()[0],
+                         '203.0.113.9')
+
+
+class VerdictCacheTest(unittest.TestCase):
+
+    def test_lru_eviction_and_ttl(self):
+        cache = TTLCache(maxsize=2, ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now least recent
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.evictions, 1)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 1)  # expired entries go on lookup
+
+    def test_fingerprint_collapses_ids_and_addresses(self):
+        def item(ip, path, query):
+            return dict(features(0, ''), ip=ip, path=path, query=query,
+                        surface=f"method=GET\npath={path}\nquery=...\nip={ip}\nua=Mozilla/5.0")
+
+        uuid = '3f2b8c1e-9d4a-4e7b-8c6f-1a2b3c4d5e6f'
+        base = fingerprint(item('198.51.100.1', '/users/17', {'id': ['5'], 'q': ["' OR 1=1"]}))
+        self.assertEqual(base, fingerprint(item('203.0.113.9', '/users/2048', {'q': ["' OR 1=1"], 'id': ['99']})))
+        self.assertEqual(fingerprint(item('x', f'/files/{uuid}', {})),
+                         fingerprint(item('y', f'/files/{uuid.upper().replace("3F", "AB")}', {})))
+        self.assertNotEqual(base, fingerprint(item('198.51.100.1', '/users/17', {'id': ['5'], 'q': ['hello']})))
+
+    def test_cached_verdict_skips_upstream(self):
+        stub = StubOpenAI().start()
+        self.addCleanup(stub.stop)
+        guard = AIGuard(api_key='test', model='stub', base_url=stub.base_url, cache=TTLCache(100, 60))
+        for i in range(5):
+            self.assertEqual(guard.classify(features(i, f"' OR {i}={i} --"))['verdict'], 'MALICIOUS')
+        self.assertEqual(stub.calls, 1)
+        self.assertEqual(guard.cache.stats()['hits'], 4)
+
+
+class AIGuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubOpenAI().start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def guard(self, **kwargs):
+        return AIGuard(api_key='test', model='stub', base_url=self.stub.base_url, **kwargs)
+
+    def classify_concurrently(self, guard, items):
+        results = [None] * len(items)
+        barrier = threading.Barrier(len(items))
+
+        def worker(i):
+            barrier.wait()
+            results[i] = guard.classify(items[i])
+
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(len(items))]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        return results
+
+    def test_single_request_shape(self):
+        result = self.guard().classify(features(1, "<script>alert(1)</script>"))
+        self.assertEqual(set(result), {'verdict', 'confidence', 'categories', 'explanation'})
+        self.assertEqual(result['verdict'], 'MALICIOUS')
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_batching_coalesces_concurrent_requests(self):
+        guard = self.guard(batch_size=32, batch_wait=0.2)
+        items = [features(i, f"hello {i}" if i % 2 else f"' OR {i}={i} --") for i in range(64)]
+        results = self.classify_concurrently(guard, items)
+        self.assertEqual([r['verdict'] for r in results],
+                         ['MALICIOUS' if i % 2 == 0 else 'BENIGN' for i in range(64)])
+        self.assertLessEqual(self.stub.calls, 4)
+
+    def test_singleflight_shares_one_upstream_call(self):
+        self.stub.delay = 0.3
+        guard = self.guard(singleflight=SingleFlight())
+        # Same payload from different addresses: one fingerprint
+        results = self.classify_concurrently(guard, [features(i, "' OR 1=1 --") for i in range(32)])
+        self.assertEqual({r['verdict'] for r in results}, {'MALICIOUS'})
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(guard.singleflight.stats()['shared'], 31)
+
+    def test_singleflight_waiter_times_out_to_unknown(self):
+        self.stub.delay = 0.5
+        guard = self.guard(singleflight=SingleFlight())
+        leader = threading.Thread(target=guard.classify, args=(features(1, 'x'),))
+        leader.start()
+        time.sleep(0.1)
+        result = guard.classify(features(2, 'x'), deadline=time.monotonic() + 0.05)
+        leader.join()
+        self.assertEqual(result['verdict'], 'UNKNOWN')
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_async_singleflight_shares_one_upstream_call(self):
+        self.stub.delay = 0.3
+        guard = self.guard()
+        flight = AsyncSingleFlight()
+
+        async def classify(i):
+            item = features(i, '<script>alert(1)</script>')
+            return await flight.do(fingerprint(item), lambda: asyncio.to_thread(guard.classify, item))
+
+        async def main():
+            return await asyncio.gather(*(classify(i) for i in range(32)))
+
+        results = asyncio.run(main())
+        self.assertEqual({r['verdict'] for r in results}, {'MALICIOUS'})
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_mitigation_templates_are_cached_per_signature(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'scripts.db')
+
+        def generator():
+            return MitigationGenerator('test', 'stub', base_url=self.stub.base_url, cache=ScriptCache(path=path))
+
+        def incident(ip, user_id, hits=('SQLI',)):
+            return {'ip': ip, 'path': f'/users/{user_id}', 'method': 'GET',
+                    'heuristic_hits': list(hits), 'ai': {'categories': ['SQLI']}}
+
+        gen = generator()
+        first = gen.generate(incident('198.51.100.1', 1))
+        self.assertEqual(gen.generate(incident('198.51.100.2', 2)), first)
+        self.assertEqual(self.stub.calls, 1)
+        gen.generate(incident('198.51.100.3', 3, hits=('SQLI', 'SCANNER')))
+        self.assertEqual(self.stub.calls, 2)
+        # Templates are re-rendered per address and survive a restart
+        gen.cache.set(incident_signature(incident('x', 4)), 'iptables -I INPUT -s {{IP}} -j DROP')
+        restarted = generator()
+        self.assertEqual(restarted.generate(incident('203.0.113.9', 5)), 'iptables -I INPUT -s 203.0.113.9 -j DROP')
+        self.assertEqual(self.stub.calls, 2)
+        self.assertEqual(restarted.cache.stats()['disk_hits'], 1)
+
+    def test_async_guard_shares_classifications_and_templates(self):
+        self.stub.delay = 0.3
+        guard = self.guard(cache=TTLCache(100, 60), singleflight=SingleFlight())
+        gen = MitigationGenerator('test', 'stub', base_url=self.stub.base_url,
+                                  cache=ScriptCache(), singleflight=SingleFlight())
+
+        async def main():
+            verdicts = await asyncio.gather(*(
+                guard.classify_async(features(i, '<script>alert(1)</script>')) for i in range(32)))
+            scripts = await asyncio.gather(*(
+                gen.generate_async({'ip': f'198.51.100.{i}', 'path': '/echo', 'method': 'GET',
+                                    'heuristic_hits': ['XSS'], 'ai': verdicts[i]}) for i in range(32)))
+            return verdicts, scripts
+
+        verdicts, scripts = asyncio.run(main())
+        self.assertEqual({v['verdict'] for v in verdicts}, {'MALICIOUS'})
+        self.assertEqual(self.stub.calls, 2)
+        self.assertEqual(len(set(scripts)), 1)  # the stub script has no address
+        # The sync path reuses what the async one cached
+        self.assertEqual(guard.classify(features(99, '<script>alert(1)</script>'))['verdict'], 'MALICIOUS')
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_async_waiters_survive_a_cancelled_leader(self):
+        self.stub.delay = 0.5
+        guard = self.guard(singleflight=SingleFlight())
+        gen = MitigationGenerator('test', 'stub', base_url=self.stub.base_url,
+                                  cache=ScriptCache(), singleflight=SingleFlight())
+        incident = {'path': '/echo', 'method': 'GET', 'heuristic_hits': ['XSS'], 'ai': {'categories': ['XSS']}}
+
+        async def follow(leader_call, waiter_call):
+            leader = asyncio.ensure_future(leader_call)
+            await asyncio.sleep(0.1)
+            waiter = asyncio.ensure_future(waiter_call)
+            await asyncio.sleep(0.05)
+            leader.cancel()  # e.g. its client disconnected
+            return await waiter
+
+        async def main():
+            verdict = await follow(guard.classify_async(features(1, '<script>')),
+                                   guard.classify_async(features(2, '<script>')))
+            script = await follow(gen.generate_async(dict(incident, ip='198.51.100.1')),
+                                  gen.generate_async(dict(incident, ip='198.51.100.2')))
+            return verdict, script
+
+        verdict, script = asyncio.run(main())
+        self.assertEqual(verdict['verdict'], 'UNKNOWN')
+        self.assertIn('198.51.100.2', script)  # the baseline template
+
+    def test_breaker_opens_and_skips_upstream(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        guard = self.guard(breaker=breaker, call_timeout=0.1)
+        self.stub.delay = 0.5
+        for i in range(2):
+            self.assertTrue(guard.classify(features(i, 'x'))['explanation'].startswith('AI error'))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        calls = self.stub.calls
+        t0 = time.monotonic()
+        result = guard.classify(features(3, 'x'))
+        self.assertLess(time.monotonic() - t0, 0.05)
+        self.assertEqual(result['verdict'], 'UNKNOWN')
+        self.assertEqual(self.stub.calls, calls)
+        # After the reset timeout a single probe closes the circuit again.
+        self.stub.delay = 0.0
+        time.sleep(0.25)
+        self.assertEqual(guard.classify(features(4, 'x'))['verdict'], 'BENIGN')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
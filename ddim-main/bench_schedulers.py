@@ -0,0 +1,186 @@
+"""Wall-clock time versus sample quality for the schedulers in scheduler.py.
+
+Every scheduler samples from the same initial noise at each step count,
+with the same timestep spacing (--timestep_spacing, trailing by default).
+Quality is measured as the RMSE (in [0, 1] pixel units) to a reference
+sample from the same noise: DDIM with eta = 0 and --reference_steps
+steps, which approximates the exact solution of the sampling ODE.
+
+With --pretrained_model_path the trained UNet is sampled and timed
+directly. Without it, the model is the exact noise prediction for a
+mixture of isotropic Gaussians (std --component_std) centred on the
+images in --images, which has a closed form and a smooth sampling ODE.
+Wall-clock time is then the measured scheduler overhead plus the number of
+model evaluations times the measured cost of one forward pass of the
+default UNet at --resolution with random weights.
+
+    python bench_schedulers.py --steps 10 20 50 100
+    python bench_schedulers.py --pretrained_model_path trained_models/ddpm-model-1.pth --reference_steps 250
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from model import UNet
+from scheduler import SCHEDULERS, DDIMScheduler
+from utils import normalize_to_neg_one_to_one
+
+
+class MixtureDenoiser:
+    """Exact noise prediction, with UNet's call signature, for data drawn
+    from N(image, std^2 I) with the image picked uniformly from `images`
+    (N, C, H, W) in [-1, 1]."""
+
+    def __init__(self, images, alphas_cumprod, std=0.3):
+        self.images = images
+        self.std = std
+        self.in_channels = images.shape[1]
+        self.sample_size = images.shape[-1]
+        self.alphas_cumprod = torch.as_tensor(alphas_cumprod,
+                                              dtype=torch.float32)
+
+    def __call__(self, sample, timesteps):
+        alpha_prod = self.alphas_cumprod[int(timesteps)]
+        # x_t = sqrt(a) x_0 + sqrt(1 - a) eps given a component is
+        # N(sqrt(a) image, variance I)
+        variance = alpha_prod * self.std**2 + 1 - alpha_prod
+        data = self.images.flatten(1)
+        dist = torch.cdist(sample.flatten(1), alpha_prod**0.5 * data)**2
+        weights = torch.softmax(-dist / (2 * variance), dim=1)
+        mean = (weights @ data).view_as(sample)
+        pred_original_sample = mean + alpha_prod**0.5 * self.std**2 / variance * (
+            sample - alpha_prod**0.5 * mean)
+        noise = (sample - alpha_prod**0.5 * pred_original_sample) / (
+            1 - alpha_prod)**0.5
+        return {"sample": noise}
+
+
+def load_images(pattern, resolution):
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        image = Image.open(path).convert("RGB").resize(
+            (resolution, resolution), Image.BICUBIC)
+        images.append(torch.from_numpy(np.asarray(image)).permute(2, 0, 1))
+    if not images:
+        raise ValueError(f"No images match {pattern}")
+    return normalize_to_neg_one_to_one(torch.stack(images).float() / 255)
+
+
+def sample(scheduler, model, steps, args):
+    generator = torch.manual_seed(args.seed)
+    start = time.perf_counter()
+    images = scheduler.generate(model,
+                                batch_size=args.batch_size,
+                                generator=generator,
+                                eta=0.0,
+                                num_inference_steps=steps,
+                                output_type="numpy",
+                                device=args.device)["sample_pt"]
+    return images.cpu(), time.perf_counter() - start
+
+
+def rmse(a, b):
+    return (a - b).pow(2).flatten(1).mean(1).sqrt()
+
+
+def unet_eval_seconds(args, repeats=3):
+    unet = UNet(3, image_size=args.resolution,
+                hidden_dims=[64, 128, 256, 512]).to(args.device).eval()
+    x = torch.randn(args.batch_size, 3, args.resolution,
+                    args.resolution, device=args.device)
+    with torch.no_grad():
+        unet(x, 500)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            unet(x, 500)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    torch.set_grad_enabled(False)
+    reference_scheduler = DDIMScheduler(num_train_timesteps=args.n_train_timesteps,
+                                        beta_schedule="cosine")
+    if args.pretrained_model_path:
+        model = UNet(3, image_size=args.resolution,
+                     hidden_dims=[64, 128, 256, 512])
+        model.load_state_dict(
+            torch.load(args.pretrained_model_path,
+                       map_location=args.device)["model_state"])
+        model = model.to(args.device).eval()
+        data, unet_seconds = None, None
+    else:
+        data = load_images(args.images, args.resolution)
+        model = MixtureDenoiser(data.to(args.device),
+                                reference_scheduler.alphas_cumprod,
+                                args.component_std)
+        unet_seconds = unet_eval_seconds(args)
+
+    reference, _ = sample(reference_scheduler, model, args.reference_steps, args)
+    # One spacing for every scheduler, so rows differ only in the solver
+    spacing = {} if args.timestep_spacing == "default" else {
+        "timestep_spacing": args.timestep_spacing
+    }
+
+    results = []
+    for name in args.schedulers:
+        for steps in args.steps:
+            scheduler = SCHEDULERS[name](num_train_timesteps=args.n_train_timesteps,
+                                         beta_schedule="cosine", **spacing)
+            images, seconds = sample(scheduler, model, steps, args)
+            row = {
+                "scheduler": name,
+                "steps": steps,
+                "timestep_spacing": scheduler.timestep_spacing,
+                "rmse_reference": round(rmse(images, reference).mean().item(), 5),
+            }
+            if data is None:
+                row["wall_s"] = round(seconds, 3)
+            else:
+                row["scheduler_s"] = round(seconds, 4)
+                row["wall_s"] = round(seconds + steps * unet_seconds, 3)
+            results.append(row)
+            print(json.dumps(row))
+
+    report = {
+        "model": args.pretrained_model_path or
+        f"mixture of {len(data)} images, std {args.component_std}",
+        "resolution": args.resolution,
+        "batch_size": args.batch_size,
+        "reference_steps": args.reference_steps,
+        "unet_eval_s": unet_seconds and round(unet_seconds, 4),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schedulers", nargs="+", default=list(SCHEDULERS),
+                        choices=list(SCHEDULERS))
+    parser.add_argument("--steps", nargs="+", type=int, default=[10, 20, 50, 100])
+    parser.add_argument("--reference_steps", type=int, default=1000)
+    parser.add_argument("--n_train_timesteps", type=int, default=1000)
+    parser.add_argument("--pretrained_model_path", type=str, default=None)
+    parser.add_argument("--images", type=str,
+                        default=os.path.join(os.path.dirname(__file__), "test", "*.jpg"))
+    parser.add_argument("--component_std", type=float, default=0.3)
+    parser.add_argument("--timestep_spacing", type=str, default="trailing",
+                        choices=["leading", "trailing", "default"],
+                        help="Spacing for all schedulers; 'default' keeps each "
+                        "scheduler's own (leading for DDIM, trailing otherwise)")
+    parser.add_argument("--resolution", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None)
+
+    main(parser.parse_args())
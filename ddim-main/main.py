@@ -1,7 +1,7 @@
 import argparse
 import torch
 from model import UNet
-from scheduler import DDIMScheduler
+from scheduler import SCHEDULERS
 from utils import _grayscale_to_rgb, save_images, normalize_to_neg_one_to_one
 from dataset import DiffusionDataset
 from torchinfo import summary
@@ -36,7 +36,7 @@ def main(args):
     if args.mode == "train":
 
         model = UNet(3, image_size=args.resolution, hidden_dims=[64, 128, 256, 512])
-        noise_scheduler = DDIMScheduler(num_train_timesteps=n_timesteps,
+        noise_scheduler = SCHEDULERS[args.scheduler](num_train_timesteps=n_timesteps,
                                     beta_schedule="cosine")
         if args.pretrained_model_path:
             pretrained = torch.load(args.pretrained_model_path)["model_state"]
@@ -160,7 +160,7 @@ def main(args):
             raise ValueError("Pretrained model path is required for inference mode.")
         
         model = UNet(3, image_size=args.resolution, hidden_dims=[64, 128, 256, 512])
-        noise_scheduler = DDIMScheduler(num_train_timesteps=n_timesteps,
+        noise_scheduler = SCHEDULERS[args.scheduler](num_train_timesteps=n_timesteps,
                                     beta_schedule="cosine")
 
         # if device == "cpu":
@@ -257,6 +257,11 @@ if __name__ == "__main__":
                         default=100,
                         type=int,
                         help='Number of inference steps')
+    parser.add_argument('--scheduler',
+                        default='ddim',
+                        choices=list(SCHEDULERS),
+                        help='Sampler: ddim, dpm (DPM-Solver++ 2M) or plms; '
+                        'dpm and plms need only 10-20 inference steps')
 
 
     args = parser.parse_args()
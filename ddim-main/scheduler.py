@@ -29,7 +29,8 @@ class DDIMScheduler:
                  beta_end=0.02,
                  beta_schedule="cosine",
                  clip_sample=True,
-                 set_alpha_to_one=True):
+                 set_alpha_to_one=True,
+                 timestep_spacing="leading"):
 
         if beta_schedule == "linear":
             self.betas = np.linspace(beta_start,
@@ -45,7 +46,16 @@ class DDIMScheduler:
             raise NotImplementedError(
                 f"{beta_schedule} does is not implemented for {self.__class__}")
 
+        if timestep_spacing not in ("leading", "trailing"):
+            raise NotImplementedError(
+                f"{timestep_spacing} timestep spacing is not implemented for {self.__class__}")
+
         self.num_train_timesteps = num_train_timesteps
+        # "leading" samples from step_ratio * (num_inference_steps - 1) down
+        # to 0; "trailing" from the last train timestep down to
+        # step_ratio - 1, so sampling starts from pure noise whatever the
+        # number of steps, which few-step sampling depends on.
+        self.timestep_spacing = timestep_spacing
         self.clip_sample = clip_sample
         self.alphas = 1.0 - self.betas
         self.alphas_cumprod = np.cumprod(self.alphas, axis=0)
@@ -68,69 +78,120 @@ class DDIMScheduler:
 
         return variance
 
-    def set_timesteps(self, num_inference_steps, offset=0):
+    def set_timesteps(self, num_inference_steps, offset=0, device=None):
         self.num_inference_steps = num_inference_steps
-        self.timesteps = np.arange(0, 1000,
-                                   1000 // num_inference_steps)[::-1].copy()
+        step_ratio = self.num_train_timesteps // num_inference_steps
+        if self.timestep_spacing == "trailing":
+            self.timesteps = np.arange(self.num_train_timesteps - 1, -1,
+                                       -step_ratio)
+        else:
+            self.timesteps = np.arange(0, self.num_train_timesteps,
+                                       step_ratio)[::-1].copy()
         self.timesteps += offset
 
+        # Per-timestep coefficients of step(), indexed by the train
+        # timestep t (prev timestep t - step_ratio), computed once in float64
+        t = torch.arange(self.num_train_timesteps)
+        alphas_cumprod = torch.as_tensor(self.alphas_cumprod,
+                                         dtype=torch.float64)
+        alpha_prod_t = alphas_cumprod[t]
+        prev_t = t - step_ratio
+        alpha_prod_t_prev = torch.where(
+            prev_t >= 0, alphas_cumprod[prev_t.clamp(min=0)],
+            torch.as_tensor(self.final_alpha_cumprod, dtype=torch.float64))
+        beta_prod_t = 1 - alpha_prod_t
+        self._alpha_prod_t = alpha_prod_t
+        self._alpha_prod_t_prev = alpha_prod_t_prev
+        # σ_t² at eta = 1, see formula (16)
+        self._variance = (1 - alpha_prod_t_prev) / beta_prod_t * (
+            1 - alpha_prod_t / alpha_prod_t_prev)
+        self._device = device
+        self._coefficients = {}
+
+    def coefficients(self, eta=1.0, device=None, dtype=torch.float32):
+        """Table of shape (num_train_timesteps, 7) with the per-timestep
+        coefficients of step() for this eta, on `device`:
+        1/sqrt(a_t), sqrt(1 - a_t)/sqrt(a_t) (predicted x_0 from x_t and
+        the noise), the x_0 and x_t weights of the update when the noise is
+        re-derived from the clipped x_0, the x_0 and noise weights when it
+        is not, and sigma_t. Built once per (eta, device, dtype)."""
+        if self.num_inference_steps is None:
+            raise RuntimeError(
+                "set_timesteps must be called before stepping")
+        device = torch.device(device or self._device or "cpu")
+        if device.index is None and device.type != "cpu":
+            # "cuda" and sample.device ("cuda:0") must share one table
+            device = torch.empty(0, device=device).device
+        key = (float(eta), device, dtype)
+        table = self._coefficients.get(key)
+        if table is None:
+            sqrt_alpha_t = self._alpha_prod_t**0.5
+            sqrt_beta_t = (1 - self._alpha_prod_t)**0.5
+            sqrt_alpha_prev = self._alpha_prod_t_prev**0.5
+            std_dev_t = eta * self._variance**0.5
+            # "direction pointing to x_t" of formula (12)
+            direction = (1 - self._alpha_prod_t_prev -
+                         std_dev_t**2).clamp(min=0)**0.5
+            table = torch.stack([
+                1 / sqrt_alpha_t,
+                sqrt_beta_t / sqrt_alpha_t,
+                sqrt_alpha_prev - direction * sqrt_alpha_t / sqrt_beta_t,
+                direction / sqrt_beta_t,
+                sqrt_alpha_prev,
+                direction,
+                std_dev_t,
+            ], dim=1).to(device=device, dtype=dtype)
+            self._coefficients[key] = table
+        return table
+
     def step(
         self,
         model_output: Union[torch.FloatTensor, np.ndarray],
-        timestep: int,
+        timestep: Union[int, torch.Tensor],
         sample: Union[torch.FloatTensor, np.ndarray],
         eta: float = 1.0,
         use_clipped_model_output: bool = True,
         generator=None,
     ):
-        # 1. get previous step value (=t-1)
-        prev_timestep = timestep - self.num_train_timesteps // self.num_inference_steps
-
-        # 2. compute alphas, betas
-        alpha_prod_t = self.alphas_cumprod[timestep]
-        alpha_prod_t_prev = self.alphas_cumprod[
-            prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
-        beta_prod_t = 1 - alpha_prod_t
-
-        # 3. compute predicted original sample from predicted noise also called
-        # "predicted x_0" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
-        pred_original_sample = (sample - beta_prod_t**
-                                (0.5) * model_output) / alpha_prod_t**(0.5)
+        """x_t -> x_t-1 of formula (12) from https://arxiv.org/pdf/2010.02502.pdf.
+
+        `timestep` is an int for the whole batch or a tensor with one
+        timestep per sample, so samples at different noise levels can be
+        stepped together.
+        """
+        if not torch.is_tensor(model_output):
+            return self.step(torch.from_numpy(model_output), timestep,
+                             torch.from_numpy(sample), eta,
+                             use_clipped_model_output, generator).numpy()
+
+        table = self.coefficients(eta, sample.device, sample.dtype)
+        if torch.is_tensor(timestep) and timestep.ndim > 0:
+            coef = table[timestep.to(table.device, torch.long)]
+        else:
+            # An int index is a view: no host-to-device copy
+            coef = table[int(timestep)][None]
+        coef = coef.reshape(coef.shape + (1, ) * (sample.ndim - 1))
+        coef = coef.unbind(1)
 
-        # 4. Clip "predicted x_0"
+        # predicted x_0 from predicted noise, formula (12)
+        pred_original_sample = sample * coef[0] - model_output * coef[1]
         if self.clip_sample:
-            pred_original_sample = clip(pred_original_sample, -1, 1)
-
-        # 5. compute variance: "sigma_t(η)" -> see formula (16)
-        # σ_t = sqrt((1 − α_t−1)/(1 − α_t)) * sqrt(1 − α_t/α_t−1)
-        variance = self._get_variance(timestep, prev_timestep)
-        std_dev_t = eta * variance**(0.5)
+            pred_original_sample = pred_original_sample.clamp_(-1, 1)
 
         if use_clipped_model_output:
-            # the model_output is always re-derived from the clipped x_0 in Glide
-            model_output = (sample - alpha_prod_t**
-                            (0.5) * pred_original_sample) / beta_prod_t**(0.5)
-
-        # 6. compute "direction pointing to x_t" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
-        pred_sample_direction = (1 - alpha_prod_t_prev -
-                                 std_dev_t**2)**(0.5) * model_output
-
-        # 7. compute x_t without "random noise" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
-        prev_sample = alpha_prod_t_prev**(
-            0.5) * pred_original_sample + pred_sample_direction
+            # the noise is re-derived from the clipped x_0 as in Glide,
+            # which folds into the weights of x_0 and x_t
+            prev_sample = torch.addcmul(sample * coef[3],
+                                        pred_original_sample, coef[2])
+        else:
+            prev_sample = torch.addcmul(model_output * coef[5],
+                                        pred_original_sample, coef[4])
 
         if eta > 0:
-            device = model_output.device if torch.is_tensor(
-                model_output) else "cpu"
             noise = torch.randn(model_output.shape,
-                                generator=generator).to(device)
-            variance = self._get_variance(timestep,
-                                          prev_timestep)**(0.5) * eta * noise
-
-            if not torch.is_tensor(model_output):
-                variance = variance.numpy()
-
-            prev_sample = prev_sample + variance
+                                generator=generator).to(sample.device)
+            prev_sample = prev_sample.addcmul_(noise.to(sample.dtype),
+                                               coef[6])
 
         return prev_sample
 
@@ -165,7 +226,7 @@ class DDIMScheduler:
         )
         image = image.to(device)
 
-        self.set_timesteps(num_inference_steps)
+        self.set_timesteps(num_inference_steps, device=device)
 
         for t in tqdm(self.timesteps):
             # 1. predict noise model_output
@@ -190,3 +251,239 @@ class DDIMScheduler:
 
     def __len__(self):
         return self.num_train_timesteps
+
+
+def _continues(last_timestep, timesteps, step_ratio):
+    """Per sample, whether the previous step ended at `timesteps`, i.e. the
+    multistep history applies. `last_timestep` is None, an int or a tensor
+    for the same samples in the same order."""
+    if last_timestep is None:
+        return torch.zeros(timesteps.shape, dtype=torch.bool, device=timesteps.device)
+    return torch.as_tensor(last_timestep, device=timesteps.device) == timesteps + step_ratio
+
+
+class DPMSolverMultistepScheduler(DDIMScheduler):
+    """DPM-Solver++(2M) (https://arxiv.org/abs/2211.01095): a second order
+    multistep solver of the diffusion ODE in x_0 prediction, one model
+    evaluation per step. Keeps the previous step's predicted x_0; the first
+    step and the final one (to alpha = 1) are first order, which is DDIM
+    with eta = 0.
+
+    Same interface as DDIMScheduler, including per-sample timesteps;
+    the history is then kept per sample, so the batch must keep its order
+    from one step to the next. The sampler is deterministic, so `eta` and
+    `use_clipped_model_output` are accepted and ignored. Uses trailing
+    timestep spacing by default.
+    """
+
+    def __init__(self, *args, timestep_spacing="trailing", **kwargs):
+        super().__init__(*args, timestep_spacing=timestep_spacing, **kwargs)
+
+    def set_timesteps(self, num_inference_steps, offset=0, device=None):
+        super().set_timesteps(num_inference_steps, offset, device)
+        step_ratio = self.num_train_timesteps // num_inference_steps
+
+        alpha_t = self._alpha_prod_t**0.5
+        sigma_t = (1 - self._alpha_prod_t)**0.5
+        alpha_prev = self._alpha_prod_t_prev**0.5
+        sigma_prev = (1 - self._alpha_prod_t_prev)**0.5
+        # half log-SNR; +inf at alpha = 1
+        lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
+        lambda_prev = torch.log(alpha_prev) - torch.log(sigma_prev)
+        h = lambda_prev - lambda_t
+        # step size of the previous step, which ended at t
+        t = torch.arange(self.num_train_timesteps)
+        last_t = t + step_ratio
+        has_last = (last_t < self.num_train_timesteps) & torch.isfinite(h)
+        h_last = lambda_t - lambda_t[last_t.clamp(max=self.num_train_timesteps - 1)]
+        r = h_last / h
+
+        first_order = alpha_prev * -torch.expm1(-h)
+        d = torch.where(has_last, 1 / (2 * r), torch.zeros_like(r))
+        self._table = torch.stack([
+            1 / alpha_t,
+            sigma_t / alpha_t,
+            sigma_prev / sigma_t,
+            first_order,
+            first_order * (1 + d),
+            -first_order * d,
+        ], dim=1).to(dtype=torch.float32)
+        self._step_ratio = step_ratio
+        self._tables = {}
+        # history: the x_0 predicted at the previous timestep
+        self.last_timestep = None
+        self.last_pred_original_sample = None
+
+    def step(
+        self,
+        model_output: Union[torch.FloatTensor, np.ndarray],
+        timestep: Union[int, torch.Tensor],
+        sample: Union[torch.FloatTensor, np.ndarray],
+        eta: float = 0.0,
+        use_clipped_model_output: bool = True,
+        generator=None,
+    ):
+        if not torch.is_tensor(model_output):
+            return self.step(torch.from_numpy(model_output), timestep,
+                             torch.from_numpy(sample), eta,
+                             use_clipped_model_output, generator).numpy()
+
+        key = (sample.device, sample.dtype)
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables[key] = self._table.to(device=sample.device,
+                                                       dtype=sample.dtype)
+        if torch.is_tensor(timestep) and timestep.ndim > 0:
+            return self._step_per_sample(model_output,
+                                         timestep.to(table.device, torch.long),
+                                         sample, table)
+        timestep = int(timestep)
+        if torch.is_tensor(self.last_timestep):
+            return self._step_per_sample(
+                model_output,
+                torch.full(sample.shape[:1], timestep, device=table.device),
+                sample, table)
+        coef = table[timestep]
+
+        pred_original_sample = sample * coef[0] - model_output * coef[1]
+        if self.clip_sample:
+            pred_original_sample = pred_original_sample.clamp_(-1, 1)
+
+        if self.last_timestep == timestep + self._step_ratio:
+            # x_t-1 = sigma_t-1 / sigma_t * x_t + first_order * D, with D the
+            # x_0 extrapolated from this step and the previous one
+            prev_sample = torch.addcmul(sample * coef[2],
+                                        pred_original_sample, coef[4])
+            prev_sample = prev_sample.add_(self.last_pred_original_sample *
+                                           coef[5])
+        else:
+            prev_sample = torch.addcmul(sample * coef[2],
+                                        pred_original_sample, coef[3])
+
+        self.last_timestep = timestep
+        self.last_pred_original_sample = pred_original_sample
+        return prev_sample
+
+    def _step_per_sample(self, model_output, timesteps, sample, table):
+        coef = table[timesteps]
+        coef = coef.reshape(coef.shape + (1, ) * (sample.ndim - 1)).unbind(1)
+
+        pred_original_sample = sample * coef[0] - model_output * coef[1]
+        if self.clip_sample:
+            pred_original_sample = pred_original_sample.clamp_(-1, 1)
+
+        second_order = _continues(self.last_timestep, timesteps, self._step_ratio)
+        if second_order.any():
+            second_order = second_order.reshape(coef[0].shape)
+            prev_sample = torch.addcmul(
+                sample * coef[2], pred_original_sample,
+                torch.where(second_order, coef[4], coef[3]))
+            prev_sample = prev_sample.addcmul_(
+                self.last_pred_original_sample,
+                torch.where(second_order, coef[5], torch.zeros_like(coef[5])))
+        else:
+            prev_sample = torch.addcmul(sample * coef[2],
+                                        pred_original_sample, coef[3])
+
+        self.last_timestep = timesteps
+        self.last_pred_original_sample = pred_original_sample
+        return prev_sample
+
+
+class PLMSScheduler(DDIMScheduler):
+    """Pseudo linear multistep (PLMS) sampler of PNDM
+    (https://arxiv.org/abs/2202.09778): a fourth order Adams-Bashforth
+    combination of the last four noise predictions, transferred with the
+    DDIM (eta = 0) update. One model evaluation per step; the first three
+    steps warm up with the lower order formulas instead of Runge-Kutta
+    steps.
+
+    Same interface as DDIMScheduler, including per-sample timesteps;
+    the history is then kept per sample, so the batch must keep its order
+    from one step to the next. The sampler is deterministic, so `eta` is
+    accepted and ignored. Uses trailing timestep spacing by default.
+    """
+
+    def __init__(self, *args, timestep_spacing="trailing", **kwargs):
+        super().__init__(*args, timestep_spacing=timestep_spacing, **kwargs)
+
+    # Adams-Bashforth weights, newest noise prediction first
+    COEFFICIENTS = (
+        (1.0, ),
+        (3 / 2, -1 / 2),
+        (23 / 12, -16 / 12, 5 / 12),
+        (55 / 24, -59 / 24, 37 / 24, -9 / 24),
+    )
+
+    def set_timesteps(self, num_inference_steps, offset=0, device=None):
+        super().set_timesteps(num_inference_steps, offset, device)
+        self._step_ratio = self.num_train_timesteps // num_inference_steps
+        # history: noise predictions of the previous steps, newest last
+        self.last_timestep = None
+        self.ets = []
+        # per-sample steps: how many of `ets` each sample's history spans
+        self._orders = None
+
+    def step(
+        self,
+        model_output: Union[torch.FloatTensor, np.ndarray],
+        timestep: Union[int, torch.Tensor],
+        sample: Union[torch.FloatTensor, np.ndarray],
+        eta: float = 0.0,
+        use_clipped_model_output: bool = True,
+        generator=None,
+    ):
+        if not torch.is_tensor(model_output):
+            return self.step(torch.from_numpy(model_output), timestep,
+                             torch.from_numpy(sample), eta,
+                             use_clipped_model_output, generator).numpy()
+
+        if torch.is_tensor(timestep) and timestep.ndim > 0:
+            timestep = timestep.to(sample.device, torch.long)
+        elif torch.is_tensor(self.last_timestep):
+            timestep = torch.full(sample.shape[:1], int(timestep),
+                                  device=sample.device)
+        else:
+            timestep = int(timestep)
+        if torch.is_tensor(timestep):
+            combined = self._combine_per_sample(model_output, timestep)
+        else:
+            if self.last_timestep != timestep + self._step_ratio:
+                self.ets = []
+            self.ets = self.ets[-3:] + [model_output]
+            weights = self.COEFFICIENTS[len(self.ets) - 1]
+            combined = model_output * weights[0]
+            for weight, et in zip(weights[1:], reversed(self.ets[:-1])):
+                combined = combined.add_(et, alpha=weight)
+        self.last_timestep = timestep
+        return super().step(combined,
+                            timestep,
+                            sample,
+                            eta=0.0,
+                            use_clipped_model_output=use_clipped_model_output)
+
+    def _combine_per_sample(self, model_output, timesteps):
+        continues = _continues(self.last_timestep, timesteps, self._step_ratio)
+        if not continues.any():
+            self.ets = []
+        orders = len(self.ets) if self._orders is None else self._orders
+        orders = torch.where(continues, torch.as_tensor(orders) + 1, 1).clamp(max=4)
+        self.ets = self.ets[-3:] + [model_output]
+        self._orders = orders
+        # Row n - 1 holds the order n weights, zero-padded: entries older
+        # than a sample's own history get weight 0
+        weights = torch.tensor([w + (0.0, ) * (4 - len(w)) for w in self.COEFFICIENTS],
+                               dtype=model_output.dtype,
+                               device=model_output.device)[orders - 1]
+        weights = weights.reshape(weights.shape + (1, ) * (model_output.ndim - 1))
+        combined = model_output * weights[:, 0]
+        for k, et in enumerate(reversed(self.ets[:-1]), start=1):
+            combined = combined.addcmul_(et, weights[:, k])
+        return combined
+
+
+SCHEDULERS = {
+    "ddim": DDIMScheduler,
+    "dpm": DPMSolverMultistepScheduler,
+    "plms": PLMSScheduler,
+}
@@ -0,0 +1,143 @@
+import itertools
+import unittest
+
+import torch
+
+from scheduler import DDIMScheduler, DPMSolverMultistepScheduler, PLMSScheduler
+from utils import clip
+
+
+def reference_step(scheduler, model_output, timestep, sample, eta,
+                   use_clipped_model_output, generator):
+    """DDIMScheduler.step as it was before the coefficient tables: formula
+    (12) of https://arxiv.org/pdf/2010.02502.pdf evaluated term by term."""
+    prev_timestep = timestep - scheduler.num_train_timesteps // scheduler.num_inference_steps
+    alpha_prod_t = scheduler.alphas_cumprod[timestep]
+    alpha_prod_t_prev = scheduler.alphas_cumprod[
+        prev_timestep] if prev_timestep >= 0 else scheduler.final_alpha_cumprod
+    beta_prod_t = 1 - alpha_prod_t
+    pred_original_sample = (sample - beta_prod_t**(0.5) * model_output) / alpha_prod_t**(0.5)
+    if scheduler.clip_sample:
+        pred_original_sample = clip(pred_original_sample, -1, 1)
+    variance = scheduler._get_variance(timestep, prev_timestep)
+    std_dev_t = eta * variance**(0.5)
+    if use_clipped_model_output:
+        model_output = (sample - alpha_prod_t**(0.5) * pred_original_sample) / beta_prod_t**(0.5)
+    pred_sample_direction = (1 - alpha_prod_t_prev - std_dev_t**2)**(0.5) * model_output
+    prev_sample = alpha_prod_t_prev**(0.5) * pred_original_sample + pred_sample_direction
+    if eta > 0:
+        noise = torch.randn(model_output.shape, generator=generator)
+        prev_sample = prev_sample + std_dev_t * noise
+    return prev_sample
+
+
+class DDIMStepTest(unittest.TestCase):
+
+    def test_matches_reference_formula(self):
+        shape = (2, 3, 8, 8)
+        for schedule, steps, eta, clip_sample, clipped_output in itertools.product(
+                ("cosine", "linear"), (10, 50), (0.0, 0.5), (True, False), (True, False)):
+            with self.subTest(schedule=schedule, steps=steps, eta=eta,
+                              clip_sample=clip_sample, clipped_output=clipped_output):
+                scheduler = DDIMScheduler(beta_schedule=schedule, clip_sample=clip_sample)
+                scheduler.set_timesteps(steps)
+                inputs = torch.Generator().manual_seed(0)
+                sample = torch.randn(shape, generator=inputs)
+                for t in scheduler.timesteps:
+                    # Both step from the same x_t, so errors do not compound
+                    model_output = torch.randn(shape, generator=inputs)
+                    expected = reference_step(scheduler, model_output, int(t), sample, eta,
+                                              clipped_output, torch.Generator().manual_seed(int(t)))
+                    sample = scheduler.step(model_output, t, sample, eta, clipped_output,
+                                            generator=torch.Generator().manual_seed(int(t)))
+                    self.assertTrue(torch.allclose(sample, expected.float(), rtol=1e-5, atol=1e-5),
+                                    f"t={t}: {(sample - expected).abs().max()}")
+
+    def test_per_sample_timesteps_match_stepping_alone(self):
+        scheduler = DDIMScheduler()
+        scheduler.set_timesteps(50)
+        generator = torch.Generator().manual_seed(0)
+        sample = torch.randn((4, 3, 8, 8), generator=generator)
+        model_output = torch.randn((4, 3, 8, 8), generator=generator)
+        timesteps = torch.tensor([980, 500, 20, 0])
+        stepped = scheduler.step(model_output, timesteps, sample, eta=0.0)
+        for i, t in enumerate(timesteps):
+            alone = scheduler.step(model_output[i:i + 1], int(t), sample[i:i + 1], eta=0.0)
+            self.assertTrue(torch.allclose(stepped[i:i + 1], alone))
+
+    def test_numpy_inputs_round_trip(self):
+        scheduler = DDIMScheduler()
+        scheduler.set_timesteps(10)
+        sample = torch.randn(1, 3, 8, 8)
+        model_output = torch.randn(1, 3, 8, 8)
+        out = scheduler.step(model_output.numpy(), 900, sample.numpy(), eta=0.0)
+        self.assertTrue(torch.allclose(torch.from_numpy(out),
+                                       scheduler.step(model_output, 900, sample, eta=0.0)))
+
+    def test_coefficient_tables_are_cached_per_device(self):
+        scheduler = DDIMScheduler()
+        scheduler.set_timesteps(10)
+        self.assertIs(scheduler.coefficients(0.0, "cpu"),
+                      scheduler.coefficients(0.0, torch.device("cpu")))
+
+
+def toy_model(sample, timesteps):
+    """A deterministic stand-in for the UNet's noise prediction, with one
+    timestep per sample or one for all."""
+    t = torch.as_tensor(timesteps, dtype=sample.dtype).reshape(-1, 1, 1, 1)
+    return torch.sin(sample) * (t / 1000 + 0.5)
+
+
+class MultistepTest(unittest.TestCase):
+
+    @staticmethod
+    def run_steps(scheduler, sample, steps):
+        scheduler.set_timesteps(steps)
+        for t in scheduler.timesteps:
+            sample = scheduler.step(toy_model(sample, int(t)), t, sample)
+        return sample
+
+    def test_per_sample_timesteps_keep_per_sample_history(self):
+        for cls in (DPMSolverMultistepScheduler, PLMSScheduler):
+            with self.subTest(scheduler=cls.__name__):
+                scheduler = cls()
+                noise = torch.randn((2, 3, 8, 8), generator=torch.Generator().manual_seed(0))
+                expected = [self.run_steps(scheduler, noise[i:i + 1], 20) for i in range(2)]
+
+                # Sample 1 starts 3 steps after sample 0. Outside its own
+                # run a sample is restarted from its noise at the first
+                # timestep, which breaks its history, and the result dropped.
+                scheduler.set_timesteps(20)
+                timesteps, lag = list(scheduler.timesteps), 3
+                sample = noise.clone()
+                results = [None, None]
+                for i in range(len(timesteps) + lag):
+                    steps = [i, i - lag]
+                    t = torch.tensor([timesteps[j] if 0 <= j < len(timesteps) else timesteps[0]
+                                      for j in steps])
+                    for k, j in enumerate(steps):
+                        if not 0 < j < len(timesteps):
+                            sample[k] = noise[k]
+                    sample = scheduler.step(toy_model(sample, t), t, sample)
+                    for k, j in enumerate(steps):
+                        if j == len(timesteps) - 1:
+                            results[k] = sample[k:k + 1].clone()
+                for result, alone in zip(results, expected):
+                    self.assertTrue(torch.allclose(result, alone, atol=1e-6),
+                                    f"{(result - alone).abs().max()}")
+
+    def test_numpy_inputs_round_trip(self):
+        for cls in (DPMSolverMultistepScheduler, PLMSScheduler):
+            with self.subTest(scheduler=cls.__name__):
+                noise = torch.randn((1, 3, 8, 8), generator=torch.Generator().manual_seed(0))
+                scheduler = cls()
+                scheduler.set_timesteps(10)
+                sample = noise.numpy()
+                for t in scheduler.timesteps:
+                    sample = scheduler.step(toy_model(torch.from_numpy(sample), int(t)).numpy(), t, sample)
+                self.assertTrue(torch.allclose(torch.from_numpy(sample),
+                                               self.run_steps(cls(), noise, 10)))
+
+
+if __name__ == "__main__":
+    unittest.main()